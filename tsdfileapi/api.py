@@ -10,10 +10,12 @@ designed for the University of Oslo's Services for Sensitive Data (TSD).
 """
 
 import base64
+import glob
 import logging
 import os
 import pwd
 import datetime
+import email.utils
 import hashlib
 import subprocess
 import stat
@@ -22,11 +24,16 @@ import fileinput
 import json
 import re
 import sqlite3
+import tarfile
+import threading
 import time
+import zipfile
 
 from uuid import uuid4
+from urllib.parse import quote
 from sys import argv
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 import magic
@@ -39,8 +46,11 @@ from pandas import DataFrame
 from termcolor import colored
 from tornado.escape import json_decode, url_unescape, url_escape
 from tornado import gen
+from tornado.concurrent import Future
 from tornado.httpclient import AsyncHTTPClient
-from tornado.ioloop import IOLoop
+from tornado.http1connection import HTTP1Connection
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.options import parse_command_line, define, options
 from tornado.web import Application, RequestHandler, stream_request_body, \
                         HTTPError, MissingArgumentError
@@ -49,16 +59,69 @@ from auth import process_access_token
 from utils import call_request_hook, sns_dir, \
                   check_filename, _IS_VALID_UUID, \
                   md5sum, tenant_from_url, create_cluster_dir_if_not_exists, \
-                  move_data_to_folder
+                  move_data_to_folder, merge_tree, sendfile, parse_byte_ranges, \
+                  accepted_encodings, stream_compressor, zstandard
 from db import sqlite_init, SqliteBackend, postgres_init, PostgresBackend
-from resumables import SerialResumable
+from resumables import SerialResumable, BackgroundMerger, ResumableNotFound, collect_garbage
 from pgp import _import_keys
 from rmq import PikaClient
+import etags
+import metrics
+from egress import EgressScheduler
+from filecache import OpenFileCache
+from metacache import FileMetadataCache
+from snapshots import DirectorySnapshots, InvalidCursor, ListingQuery, View
+from pagecache import ExportAdvice, UploadAdvice
+from changes import ChangeFeeds
+from catalog import FileCatalogs
 
 
 _RW______ = stat.S_IREAD | stat.S_IWRITE
 _RW_RW___ = _RW______ | stat.S_IRGRP | stat.S_IWGRP
 _IS_VALID_UUID = re.compile(r'([a-f\d0-9-]{32,36})')
+_DECODABLE_CONTENT_TYPES = [
+    'application/aes',
+    'application/aes-octet-stream',
+    'application/tar',
+    'application/tar.gz',
+    'application/tar.aes',
+    'application/tar.gz.aes',
+    'application/gz',
+    'application/gz.aes',
+    'application/octet-stream+nacl',
+]
+_MAGIC = threading.local()
+_LISTING_BATCH = 256
+
+
+def _mtime_etag(mtime):
+    # the cheap Etag, used until a content digest is available
+    return hashlib.md5(str(mtime).encode('utf-8')).hexdigest()
+
+
+def _export_catalog_root(backend, tenant, path):
+    """
+    The export directory of the backend, whose file catalog is used
+    for lookups, if path is in it, otherwise None: files uploaded to
+    an import directory which is not exported are not catalogued.
+
+    """
+    export_dir = options.config['backends']['disk'][backend].get('export_path')
+    if not export_dir:
+        return None
+    export_dir = os.path.normpath(export_dir.replace(options.tenant_string_pattern, tenant))
+    path = os.path.normpath(path)
+    if path == export_dir or path.startswith(export_dir + '/'):
+        return export_dir
+    return None
+
+
+def _detect_mime_type(filename):
+    # python-magic serialises calls on a shared instance,
+    # so each thread uses its own, to detect in parallel
+    if not hasattr(_MAGIC, 'instance'):
+        _MAGIC.instance = magic.Magic(mime=True)
+    return _MAGIC.instance.from_file(filename)
 
 
 def read_config(filename):
@@ -116,6 +179,73 @@ def set_config():
         )
     )
     define('rabbitmq', _config.get('rabbitmq', {}))
+    define('resumables_gc', _config.get('resumables_gc', {}))
+    define('resumable_merger', BackgroundMerger(
+            ThreadPoolExecutor(_config.get('resumable_merge_workers', 4))
+        )
+    )
+    define('upload_executor', ThreadPoolExecutor(_config.get('upload_workers', 4)))
+    define('export_executor', ThreadPoolExecutor(_config.get('export_workers', 8)))
+    define('sendfile_executor', ThreadPoolExecutor(_config.get('export_sendfile_workers', 4)))
+    define('export_max_ranges', _config.get('export_max_ranges', 16))
+    define('archive_executor', ThreadPoolExecutor(_config.get('export_archive_workers', 4)))
+    define('listing_executor', ThreadPoolExecutor(_config.get('listing_workers', 16)))
+    define('listing_tree_max_depth', _config.get('listing_tree_max_depth', 16))
+    define('export_compression', _config.get('export_compression', {}))
+    define('batch', _config.get('batch', {}))
+    define('export_etags', _config.get('export_etags', {}))
+    define('page_cache', _config.get('page_cache', {}))
+    _egress_config = _config.get('export_egress', {})
+    if _egress_config.get('enabled', False):
+        define('export_egress', EgressScheduler(
+                rate=_egress_config.get('rate', 0),
+                burst=_egress_config.get('burst', 1),
+                quantum=_egress_config.get('quantum', _config['export_chunk_size']),
+                tenants=_egress_config.get('tenants', {}),
+                default_weight=_egress_config.get('default_weight', 1),
+                default_rate=_egress_config.get('default_rate', 0),
+                max_metric_tenants=_egress_config.get('max_metric_tenants', 100),
+            )
+        )
+    else:
+        define('export_egress', EgressScheduler())
+    _metadata_cache_config = _config.get('file_metadata_cache', {})
+    define('file_metadata_cache', FileMetadataCache(
+            _metadata_cache_config.get('max_entries', 10000) if _metadata_cache_config.get('enabled', False) else 0
+        )
+    )
+    _snapshot_config = _config.get('listing_snapshots', {})
+    define('listing_snapshots', DirectorySnapshots(
+            _snapshot_config.get('ttl', 60),
+            _snapshot_config.get('max_snapshots', 64),
+            options.listing_executor
+        )
+    )
+    define('change_feed', _config.get('change_feed', {}))
+    define('change_feeds', ChangeFeeds(
+            options.change_feed.get('max_events', 10000),
+            options.change_feed.get('inotify', True),
+            options.change_feed.get('max_watches', 8192),
+            options.listing_executor
+        )
+    )
+    _catalog_config = _config.get('file_catalog', {})
+    define('file_catalog', _catalog_config)
+    define('file_catalogs', FileCatalogs(
+            _catalog_config.get('enabled', False),
+            _detect_mime_type,
+            ThreadPoolExecutor(_catalog_config.get('workers', 1)),
+            path=_catalog_config.get('path'),
+            journal_mode=_catalog_config.get('journal_mode')
+        )
+    )
+    _file_cache_config = _config.get('export_file_cache', {})
+    define('export_file_cache', OpenFileCache(
+            _file_cache_config.get('max_entries', 256) if _file_cache_config.get('enabled', False) else 0,
+            _file_cache_config.get('max_idle', 30)
+        )
+    )
+    define('etag_executor', ThreadPoolExecutor(options.export_etags.get('workers', 2)))
     define('maintenance_mode_enabled', False)
     options.logging = _config.get('log_level', 'info')
 
@@ -331,7 +461,7 @@ class AuthRequestHandler(RequestHandler):
                         return False
         return True
 
-    def handle_mq_publication(self, mq_config=None, data=None):
+    def handle_mq_publication(self, mq_config=None, data=None, method=None):
         """
         Publish a message to RabbitMQ, as the result of a HTTP request.
         NB: The API assumes that a vhost has been created.
@@ -344,6 +474,8 @@ class AuthRequestHandler(RequestHandler):
             version: str, e.g. v1, optional
             routing_key: str, period separated string, e.g. k.v1.foo, optional
         data: dict, no structure required
+        method: str, optional, the HTTP method the message is for,
+            if not the method of the request
 
         Implementation
         --------------
@@ -383,7 +515,8 @@ class AuthRequestHandler(RequestHandler):
             return
         if not mq_config.get('enabled'):
             return
-        if not mq_config.get('methods').get(self.request.method):
+        method = method or self.request.method
+        if not mq_config.get('methods').get(method):
             return
         try:
             default_version = 'v1'
@@ -404,7 +537,7 @@ class AuthRequestHandler(RequestHandler):
             self.pika_client.publish_message(
                 exchange=ex,
                 routing_key=rkey,
-                method=self.request.method,
+                method=method,
                 uri=uri,
                 version=ver,
                 data=data
@@ -515,6 +648,7 @@ class GenericFormDataHandler(AuthRequestHandler):
                 tenant_dir = sns_dir(self.tenant_dir_pattern, tenant, self.request.uri, options.tenant_string_pattern)
             else:
                 tenant_dir = self.tenant_dir_pattern.replace(options.tenant_string_pattern, tenant)
+            self.tenant_dir = tenant_dir
             self.path = os.path.normpath(tenant_dir + '/' + filename)
             # add the partial file indicator, check existence
             self.path_part = self.path + '.' + str(uuid4()) + '.part'
@@ -558,6 +692,13 @@ class GenericFormDataHandler(AuthRequestHandler):
                                           as_sudo=self.request_hook['sudo'])
             except Exception as e:
                 logging.error(e)
+            try:
+                for path in self.new_paths:
+                    catalog_root = _export_catalog_root(self.backend, self.tenant, path)
+                    if catalog_root:
+                        options.file_catalogs.record(catalog_root, path)
+            except Exception as e:
+                logging.error(e)
 
 
 
@@ -631,6 +772,9 @@ class ResumablesHandler(AuthRequestHandler):
     - md5sum of the last chunk
     - previos offset in bytes
     - next offset in bytes (total size of merged file)
+    - received offset in bytes (total size of stored chunks)
+    - merged offset in bytes (which lags the received offset
+      when the backend merges chunks in the background)
 
     There are two possible scenarios: 1) the client knows the upload_id
     associated with the file which needs to be resumed, or 2) the client
@@ -650,6 +794,23 @@ class ResumablesHandler(AuthRequestHandler):
     then choose to resume the one with the most data, and delete the
     remaining ones.
 
+    Verification
+    ------------
+    The server records the sha256 digest of each chunk when it
+    is merged. With an upload_id, and tree=true, the Merkle tree
+    over those digests is returned, so clients can compare it to
+    their own, and resume from the first chunk which differs. The
+    root is also returned when the upload is ended.
+
+    Offset-based uploads
+    --------------------
+    Instead of numbering chunks, clients can send an Upload-Offset
+    header with each PATCH, and no chunk parameter. Chunks can then
+    have any size, and are accepted if the offset matches the number
+    of bytes already stored (409 otherwise). New uploads start at
+    offset 0, and end with chunk=end, as usual. The current offset
+    is returned by HEAD, in the Upload-Offset header.
+
     """
 
     def initialize(self, backend):
@@ -703,16 +864,41 @@ class ResumablesHandler(AuthRequestHandler):
             res = SerialResumable(self.tenant_dir, self.requestor)
             if not filename:
                 info = res.list_all(self.tenant_dir, self.requestor)
+            elif upload_id and self.get_query_argument('tree', None) == 'true':
+                info = res.merkle_tree(upload_id)
             else:
                 info = res.info(self.tenant_dir, secured_filename, upload_id, self.requestor)
             self.set_status(200)
             self.write(info)
+        except ResumableNotFound as e:
+            logging.error('resumable not found: %s', e)
+            self.set_status(404)
+            self.write(self.message)
         except Exception as e:
             logging.error(e)
             self.set_status(400)
             self.write(self.message)
 
 
+    def head(self, tenant, filename):
+        """
+        Report the number of bytes stored for a resumable in the
+        Upload-Offset header, with a single db read, so clients
+        can continue offset-based uploads cheaply.
+
+        """
+        try:
+            check_filename(url_unescape(filename), disallowed_start_chars=options.start_chars)
+            upload_id = url_unescape(self.get_query_argument('id'))
+            res = SerialResumable(self.tenant_dir, self.requestor)
+            self.set_header('Upload-Offset', res.upload_offset(upload_id))
+            self.set_header('Cache-Control', 'no-store')
+            self.set_status(200)
+        except Exception as e:
+            logging.error(e)
+            self.set_status(404)
+
+
     def delete(self, tenant, filename):
         self.message = {'message': 'cannot delete resumable'}
         try:
@@ -767,6 +953,9 @@ class StreamHandler(AuthRequestHandler):
     call put, post, patch
     11. close the file
     12. if PATCH, either merge the new chunk or finalise the resumable
+        (with async_merge enabled, the chunk is recorded and queued
+        for merging, and finalising waits for the queue to drain,
+        resumables with custom content types are decoded before finalising)
 
     call on_finish, or on_connection_close
     13. rename the file
@@ -793,12 +982,17 @@ class StreamHandler(AuthRequestHandler):
         return decr_aes_key
 
 
-    def start_openssl_proc(self, output_file=None, base64=True):
+    def openssl_cmd(self, output_file=None, base64=True):
         cmd = ['openssl', 'enc', '-aes-256-cbc', '-d'] + self.aes_decryption_args_from_headers()
         if output_file is not None:
             cmd = cmd + ['-out', output_file]
         if base64:
             cmd = cmd + ['-a']
+        return cmd
+
+
+    def start_openssl_proc(self, output_file=None, base64=True):
+        cmd = self.openssl_cmd(output_file=output_file, base64=base64)
         return subprocess.Popen(cmd,
                                 stdin=subprocess.PIPE,
                                 stdout=subprocess.PIPE if output_file is None else None)
@@ -883,6 +1077,90 @@ class StreamHandler(AuthRequestHandler):
             raise Exception
 
 
+    def decode_resumable(self, content_type, encoded, target, cmd=None):
+        """
+        Decode a merged resumable which was uploaded with a custom content type.
+
+        Chunks of such uploads are stored as sent, since decoder state
+        cannot survive between requests, so decoding is done once, when
+        the client ends the upload. This blocks, so call it in an executor.
+
+        Parameters
+        ----------
+        content_type: str, the custom content type of the upload
+        encoded: str, path to the merged data, as sent by the client
+        target: str, path to the decoded file, or directory for tar types
+        cmd: list, openssl command, for encrypted content types
+
+        """
+        def check(*procs):
+            for proc in procs:
+                if proc.wait() != 0:
+                    raise Exception(f'could not decode {encoded}: {proc.args[0]} failed')
+        is_tar = content_type.startswith('application/tar')
+        if is_tar:
+            tarflags = '-xzf' if 'gz' in content_type else '-xf'
+            decoder = ['tar', '-C', target, tarflags, '-']
+        else:
+            decoder = ['gunzip', '-c', '-']
+        with open(encoded, 'rb') as fin:
+            if content_type in ['application/aes', 'application/aes-octet-stream']:
+                check(subprocess.Popen(cmd + ['-out', target], stdin=fin))
+            elif content_type in ['application/tar', 'application/tar.gz']:
+                check(subprocess.Popen(decoder, stdin=fin))
+            elif content_type == 'application/gz':
+                with open(target, 'wb') as fout:
+                    check(subprocess.Popen(decoder, stdin=fin, stdout=fout))
+            elif content_type in ['application/tar.aes', 'application/tar.gz.aes',
+                                  'application/gz.aes']:
+                with open(target if not is_tar else os.devnull, 'wb') as fout:
+                    openssl_proc = subprocess.Popen(cmd, stdin=fin, stdout=subprocess.PIPE)
+                    decoder_proc = subprocess.Popen(decoder, stdin=openssl_proc.stdout, stdout=fout)
+                    openssl_proc.stdout.close()
+                    check(decoder_proc, openssl_proc)
+            elif content_type == 'application/octet-stream+nacl':
+                with open(target, 'wb') as fout:
+                    for block in iter(lambda: fin.read(self.nacl_chunksize), b''):
+                        fout.write(libnacl.crypto_stream_xor(block, self.nacl_nonce, self.nacl_key))
+        if not is_tar:
+            os.chmod(target, _RW______)
+
+
+    @gen.coroutine
+    def decode_completed_resumable(self, filename):
+        """
+        Replace the merged resumable data with its decoded version, in an executor.
+        For tar content types, the archive is extracted into a temporary directory,
+        and only moved into the tenant directory if extraction succeeds.
+
+        """
+        content_type = self.resumable_content_type
+        merged = os.path.normpath(f'{self.tenant_dir}/{filename}.{self.upload_id}')
+        cmd = None
+        if content_type == 'application/octet-stream+nacl':
+            self.handle_nacl_stream(self.request.headers)
+        elif 'aes' in content_type:
+            cmd = self.openssl_cmd(base64=content_type != 'application/aes-octet-stream')
+        decoded = f'{merged}.{uuid4()}.part'
+        try:
+            if content_type.startswith('application/tar'):
+                os.makedirs(decoded)
+                yield IOLoop.current().run_in_executor(
+                    None, self.decode_resumable, content_type, merged, decoded, cmd
+                )
+                yield IOLoop.current().run_in_executor(None, merge_tree, decoded, self.tenant_dir)
+                return
+            yield IOLoop.current().run_in_executor(
+                None, self.decode_resumable, content_type, merged, decoded, cmd
+            )
+            os.rename(decoded, merged)
+        finally:
+            if os.path.isdir(decoded):
+                shutil.rmtree(decoded)
+            elif os.path.lexists(decoded):
+                os.remove(decoded)
+
+
     def initialize(self, backend):
         try:
             self.backend = backend
@@ -899,6 +1177,7 @@ class StreamHandler(AuthRequestHandler):
             self.group_config = options.config['backends']['disk'][backend]['group_logic']
             self.check_tenant = options.config['backends']['disk'][backend].get('check_tenant')
             self.mq_config = options.config['backends']['disk'][backend].get('mq')
+            self.async_merge = options.config['backends']['disk'][backend].get('async_merge', False)
         except AssertionError as e:
             self.backend = backend
             logging.error('URI does not contain a valid tenant')
@@ -921,12 +1200,17 @@ class StreamHandler(AuthRequestHandler):
         """
         try:
             self.completed_resumable_file = False
+            self.completed_resumable_filename = None
             self.target_file = None
+            self.upload_advice = None
             self.custom_content_type = None
+            self.resumable_content_type = None
             self.path = None
             self.path_part = None
             self.chunk_order_correct = True
+            self.content_type_mismatch = False
             self.chunk_num = None
+            self.upload_offset = None
             self.on_finish_called = False
             filemodes = {'PUT': 'wb+', 'PATCH': 'wb+'}
             try:
@@ -990,16 +1274,36 @@ class StreamHandler(AuthRequestHandler):
                         self.res = SerialResumable(self.tenant_dir, self.requestor)
                         url_chunk_num = url_unescape(self.get_query_argument('chunk'))
                         url_upload_id = url_unescape(self.get_query_argument('id'))
-                        self.chunk_num, \
-                            self.upload_id, \
-                            self.completed_resumable_file, \
-                            self.chunk_order_correct, \
-                            filename = self.res.prepare(self.tenant_dir, filename,
-                                                        url_chunk_num, url_upload_id,
-                                                        self.group_name, self.requestor)
+                        upload_offset = self.request.headers.get('Upload-Offset')
+                        if upload_offset is not None and url_chunk_num != 'end':
+                            self.chunk_num, \
+                                self.upload_id, \
+                                self.completed_resumable_file, \
+                                self.chunk_order_correct, \
+                                filename, \
+                                self.upload_offset = self.res.prepare_offset(self.tenant_dir, filename,
+                                                                             int(upload_offset), url_upload_id,
+                                                                             self.group_name, self.requestor)
+                        else:
+                            self.chunk_num, \
+                                self.upload_id, \
+                                self.completed_resumable_file, \
+                                self.chunk_order_correct, \
+                                filename = self.res.prepare(self.tenant_dir, filename,
+                                                            url_chunk_num, url_upload_id,
+                                                            self.group_name, self.requestor)
                         if not self.chunk_order_correct:
                             logging.error('incorrect chunk order')
                             raise Exception
+                        # the custom content type is fixed by the first chunk
+                        decodable_type = content_type if content_type in _DECODABLE_CONTENT_TYPES else None
+                        if self.chunk_num == 1:
+                            self.res.record_content_type(self.upload_id, decodable_type)
+                        self.resumable_content_type = self.res.content_type(self.upload_id, default=decodable_type)
+                        if self.chunk_num != 'end' and self.resumable_content_type != decodable_type:
+                            logging.error('content type %s does not match the one of the first chunk', content_type)
+                            self.content_type_mismatch = True
+                            raise Exception
                     # 3.4 ensure we do not write to active file
                     self.path = os.path.normpath(self.tenant_dir + '/' + filename)
                     self.path_part = self.path + '.' + str(uuid4()) + '.part'
@@ -1019,7 +1323,13 @@ class StreamHandler(AuthRequestHandler):
                     # 3.6 rename
                     self.path, self.path_part = self.path_part, self.path
                     # 3.7 invoke custom content type handlers, if relevant
-                    if content_type == 'application/aes':
+                    # resumables are stored as sent, and decoded when they end
+                    if self.request.method == 'PATCH':
+                        self.custom_content_type = None
+                        if not self.completed_resumable_file:
+                            self.target_file = self.res.open_file(self.path, filemode)
+                            self.upload_advice = UploadAdvice(options.page_cache, self.target_file)
+                    elif content_type == 'application/aes':
                         self.handle_aes(content_type)
                     elif content_type == 'application/aes-octet-stream':
                         self.handle_aes_octet_stream(content_type)
@@ -1036,14 +1346,10 @@ class StreamHandler(AuthRequestHandler):
                         self.target_file = open(self.path, filemode)
                         os.chmod(self.path, _RW______)
                     else: # 3.8 no custom content type
-                        if self.request.method != 'PATCH':
-                            self.custom_content_type = None
-                            self.target_file = open(self.path, filemode)
-                            os.chmod(self.path, _RW______)
-                        elif self.request.method == 'PATCH':
-                            self.custom_content_type = None
-                            if not self.completed_resumable_file:
-                                self.target_file = self.res.open_file(self.path, filemode)
+                        self.custom_content_type = None
+                        self.target_file = open(self.path, filemode)
+                        os.chmod(self.path, _RW______)
+                        self.upload_advice = UploadAdvice(options.page_cache, self.target_file)
                 except KeyError:
                     raise Exception('No content-type - do not know what to do with data')
             # 3.9 handle any errors
@@ -1062,6 +1368,12 @@ class StreamHandler(AuthRequestHandler):
             if self.chunk_order_correct is False:
                 self.set_status(200)
                 info = 'chunk_order_incorrect'
+                if self.upload_offset is not None:
+                    info = 'upload_offset_mismatch'
+                    self.set_header('Upload-Offset', self.upload_offset)
+            elif self.content_type_mismatch:
+                self.set_status(200)
+                info = 'content_type_mismatch'
             self.finish({'message': info})
 
 
@@ -1073,6 +1385,8 @@ class StreamHandler(AuthRequestHandler):
                     self.res.add_chunk(self.target_file, chunk)
                 else:
                     self.target_file.write(chunk)
+                if self.upload_advice:
+                    self.upload_advice.wrote(len(chunk))
             elif self.custom_content_type == 'application/octet-stream+nacl':
                 for byte in chunk:
                     self.nacl_stream_buffer += bytes([byte])
@@ -1111,8 +1425,12 @@ class StreamHandler(AuthRequestHandler):
             os.rename(self.path, self.path_part)
             self.send_error("something went wrong")
 
+    @gen.coroutine
     def put(self, tenant, uri_filename=None):
         if not self.custom_content_type:
+            if self.upload_advice.pending:
+                yield IOLoop.current().run_in_executor(options.upload_executor,
+                                                       self.upload_advice.flushed)
             self.target_file.close()
             os.rename(self.path, self.path_part)
         elif self.custom_content_type == 'application/octet-stream+nacl':
@@ -1147,22 +1465,66 @@ class StreamHandler(AuthRequestHandler):
         self.write({'message': 'data streamed'})
 
 
+    @gen.coroutine
     def patch(self, tenant, uri_filename=None):
         if not self.completed_resumable_file:
-            self.res.close_file(self.target_file)
+            if self.upload_advice.pending:
+                yield IOLoop.current().run_in_executor(options.upload_executor,
+                                                       self.upload_advice.flushed)
+            if self.async_merge:
+                # chunks merged in the background must be on disk before we reply
+                yield options.resumable_merger.close_file(self.target_file)
+            else:
+                self.res.close_file(self.target_file)
             # if the path to which we want to rename the file exists
             # then we have been writing the same chunk concurrently
             # from two different processes, so we should not do it
             if not os.path.lexists(self.path_part):
                 os.rename(self.path, self.path_part)
-                filename = os.path.basename(self.path_part).split('.chunk')[0]
-                self.res.merge_chunk(self.tenant_dir, os.path.basename(self.path_part), self.upload_id, self.requestor)
+                chunk_filename = os.path.basename(self.path_part)
+                filename = chunk_filename.split('.chunk')[0]
+                chunk_size = os.stat(self.path_part).st_size
+                if self.async_merge:
+                    self.res.record_received_chunk(self.upload_id, self.chunk_num, chunk_size)
+                    options.resumable_merger.submit(self.tenant_dir, chunk_filename,
+                                                    self.upload_id, self.requestor)
+                else:
+                    self.res.merge_chunk(self.tenant_dir, chunk_filename, self.upload_id, self.requestor)
+                if self.upload_offset is not None:
+                    self.set_header('Upload-Offset', self.upload_offset + chunk_size)
             else:
                 self.write({'message': 'chunk_order_incorrect'})
         else:
+            filename = os.path.basename(self.path_part).split('.chunk')[0]
+            merged = yield options.resumable_merger.merge_pending(
+                self.tenant_dir, filename, self.upload_id, self.requestor
+            )
+            if not merged:
+                logging.error('could not merge all received chunks for %s', self.upload_id)
+                # clients resume from the merged offset
+                merged_offset, max_chunk = self.res.merged_state(self.upload_id)
+                self.set_header('Upload-Offset', merged_offset)
+                self.write({'message': 'chunk_merge_incomplete', 'id': self.upload_id,
+                            'max_chunk': max_chunk, 'merged_offset': merged_offset})
+                return
+            merkle_root = self.res.merkle_tree(self.upload_id)['root']
+            if self.resumable_content_type:
+                try:
+                    yield self.decode_completed_resumable(filename)
+                except Exception as e:
+                    # the resumable is left as is, so clients can try again
+                    logging.error(e)
+                    self.write({'message': 'resumable_decoding_failed'})
+                    return
             self.completed_resumable_filename = self.res.finalise(self.tenant_dir, os.path.basename(self.path_part),
                                                                    self.upload_id, self.requestor)
+            if self.resumable_content_type and self.resumable_content_type.startswith('application/tar'):
+                os.remove(self.completed_resumable_filename) # already extracted
             filename = os.path.basename(self.completed_resumable_filename)
+            self.set_status(201)
+            self.write({'filename': filename, 'id': self.upload_id, 'max_chunk': self.chunk_num,
+                        'merkle_root': merkle_root})
+            return
         self.set_status(201)
         self.write({'filename': filename, 'id': self.upload_id, 'max_chunk': self.chunk_num})
 
@@ -1189,22 +1551,38 @@ class StreamHandler(AuthRequestHandler):
         resource_created = (
             self.request.method == 'PUT' or (
                 self.request.method == 'PATCH' and
-                self.chunk_num == 'end'
+                self.chunk_num == 'end' and
+                self.completed_resumable_filename
             )
         )
         if resource_created:
+            resource_path = None
+            content_type = self.custom_content_type or self.resumable_content_type or ''
+            # tar uploads are extracted into the tenant directory,
+            # so there is no single resource, and the archive is gone
+            extracted = content_type.startswith('application/tar')
             try:
                 # switch path variables back
                 if not self.completed_resumable_file:
                     path, path_part = self.path_part, self.path
                 else:
                     path = self.completed_resumable_filename
-                resource_path = move_data_to_folder(path, self.resource_dir)
+                if not extracted:
+                    resource_path = move_data_to_folder(path, self.resource_dir)
             except Exception as e:
                 logging.info('could not move data to destination folder')
                 logging.info(e)
             try:
-                if self.request_hook['enabled']:
+                if extracted:
+                    # the extracted files are not known, so rescan
+                    options.change_feeds.reset(self.tenant_dir)
+                    catalog_root = _export_catalog_root(self.backend, self.tenant, self.tenant_dir)
+                    if catalog_root:
+                        options.file_catalogs.reconcile(catalog_root)
+            except Exception as e:
+                logging.error(e)
+            try:
+                if self.request_hook['enabled'] and resource_path:
                     if self.backend == 'cluster' and self.tenant == 'p01':
                         pass # TODO: remove special case
                     else:
@@ -1216,6 +1594,17 @@ class StreamHandler(AuthRequestHandler):
             except Exception as e:
                 logging.info('problem calling request hook')
                 logging.info(e)
+            try:
+                if resource_path:
+                    digest = None
+                    if options.export_etags.get('enabled', False):
+                        digest = etags.schedule_digest(resource_path, options.etag_executor)
+                    options.change_feeds.notify(resource_path, 'created')
+                    catalog_root = _export_catalog_root(self.backend, self.tenant, resource_path)
+                    if catalog_root:
+                        options.file_catalogs.record(catalog_root, resource_path, digest)
+            except Exception as e:
+                logging.error(e)
             try:
                 message_data = {
                     'path': resource_path,
@@ -1267,6 +1656,76 @@ class StreamHandler(AuthRequestHandler):
             logging.error(e)
 
 
+class _ArchiveWriter(object):
+
+    """
+    Unseekable file object for tarfile and zipfile, which hands
+    data written in a worker thread over to the IOLoop. At most
+    maxsize blocks are queued, so the thread waits while the
+    client is slow, and stops writing if it is cancelled.
+
+    """
+
+    def __init__(self, loop, blocksize, maxsize=4):
+        self.loop = loop
+        self.blocksize = blocksize
+        self.chunks = tornado.queues.Queue()
+        self.slots = threading.BoundedSemaphore(maxsize)
+        self.cancelled = False
+        self.buffer = bytearray()
+        self.position = 0
+
+    def _put(self, data):
+        while not self.slots.acquire(timeout=1):
+            if self.cancelled:
+                raise IOError('archive export cancelled')
+        if self.cancelled:
+            raise IOError('archive export cancelled')
+        self.loop.add_callback(self.chunks.put_nowait, data)
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        if len(self.buffer) >= self.blocksize:
+            self._put(bytes(self.buffer))
+            self.buffer = bytearray()
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        try:
+            if self.buffer:
+                self._put(bytes(self.buffer))
+                self.buffer = bytearray()
+        finally:
+            self.loop.add_callback(self.chunks.put_nowait, None)
+
+
+def _archive_stopped(producer):
+    error = None if producer.cancelled() else producer.exception()
+    if error:
+        logging.info('archive export stopped: %s', error)
+
+
+def _write_archive(writer, archive_format, members):
+    try:
+        if archive_format == 'tar':
+            with tarfile.open(fileobj=writer, mode='w|') as archive:
+                for path, arcname in members:
+                    archive.add(path, arcname=arcname, recursive=False)
+        elif archive_format == 'zip':
+            with zipfile.ZipFile(writer, mode='w', allowZip64=True) as archive:
+                for path, arcname in members:
+                    archive.write(path, arcname=arcname)
+    finally:
+        writer.close()
+
+
 @stream_request_body
 class ProxyHandler(AuthRequestHandler):
 
@@ -1282,6 +1741,9 @@ class ProxyHandler(AuthRequestHandler):
         self.has_posix_ownership = options.config['backends']['disk'][backend]['has_posix_ownership']
         self.check_tenant = options.config['backends']['disk'][backend].get('check_tenant')
         self.mq_config = options.config['backends']['disk'][backend].get('mq')
+        self.export_sendfile = options.config['backends']['disk'][backend].get('export_sendfile', False)
+        self.sendfile_used = False
+        self.export_accel_redirect = options.config['backends']['disk'][backend].get('export_accel_redirect', {})
         try:
             missing_group_config = {
                 'enabled': False,
@@ -1432,6 +1894,8 @@ class ProxyHandler(AuthRequestHandler):
                     headers['Aes-Key'] = self.request.headers['Aes-Key']
                 if 'Aes-Iv' in header_keys:
                     headers['Aes-Iv'] = self.request.headers['Aes-Iv']
+                if 'Upload-Offset' in header_keys:
+                    headers['Upload-Offset'] = self.request.headers['Upload-Offset']
                 headers['Content-Type'] = content_type
             except Exception as e:
                 self.error = 'Could not prepare headers for async request handling'
@@ -1440,12 +1904,9 @@ class ProxyHandler(AuthRequestHandler):
                 raise e
             # 8. Build URL
             # 8.1 collect params
-            try:
-                upload_id, chunk_num = None, None
-                chunk_num = url_unescape(self.get_query_argument('chunk'))
-                upload_id = url_unescape(self.get_query_argument('id'))
-            except Exception:
-                pass
+            # chunk is absent for offset-based resumables
+            chunk_num = self.get_query_argument('chunk', None)
+            upload_id = self.get_query_argument('id', None)
             # 8.2 enfore group logic, if enabled
             if self.group_config['enabled']:
                 # 8.2.1 if a directory is present, and not the same as the group
@@ -1512,11 +1973,18 @@ class ProxyHandler(AuthRequestHandler):
         body = response.body
         try:
             resp = json.loads(response.body)
-            if resp['message'] == 'chunk_order_incorrect':
+            if resp['message'] in ('chunk_order_incorrect', 'chunk_merge_incomplete',
+                                   'content_type_mismatch', 'resumable_decoding_failed'):
                 code = 400
                 body = resp
+            elif resp['message'] == 'upload_offset_mismatch':
+                code = 409
+                body = resp
         except Exception:
             pass
+        upload_offset = response.headers.get('Upload-Offset')
+        if upload_offset is not None:
+            self.set_header('Upload-Offset', upload_offset)
         self.set_status(code)
         self.write(body)
 
@@ -1532,39 +2000,67 @@ class ProxyHandler(AuthRequestHandler):
             - file size does not exceed max allowed for export
             - MIME types conform to allowed types, if policy enabled
 
+        Verdicts are cached, see FileMetadataCache.
+
         Returns
         -------
         (bool, <str,None>, <int,None>),
         (is_conformant, mime-type, size)
 
         """
+        status, message = self.export_policy_verdict(policy_config, filename, tenant, size, mime_type)
+        if not status:
+            self.message = message
+        return status
+
+
+    def export_policy_verdict(self, policy_config, filename, tenant, size, mime_type):
+        """
+        Like enforce_export_policy, without setting self.message,
+        so that it can be used from threads.
+
+        Returns
+        -------
+        (bool, <str,None>), (is_conformant, message)
+
+        """
+        key = (id(policy_config), tenant, os.path.basename(filename), size, mime_type)
+        verdict = options.file_metadata_cache.verdict(key)
+        if verdict is None:
+            verdict = self._check_export_policy(policy_config, filename, tenant, size, mime_type)
+            options.file_metadata_cache.set_verdict(key, verdict)
+        return verdict
+
+
+    def _check_export_policy(self, policy_config, filename, tenant, size, mime_type):
         status = False # until proven otherwise
+        message = None
         try:
             file = os.path.basename(filename)
             check_filename(file, disallowed_start_chars=options.start_chars)
         except Exception as e:
-            self.message = 'Illegal export filename: %s' % file
-            logging.error(self.message)
-            return status
+            message = 'Illegal export filename: %s' % file
+            logging.error(message)
+            return status, message
         if tenant in policy_config.keys():
             policy = policy_config[tenant]
         else:
             policy = policy_config['default']
         if not policy['enabled']:
             status = True
-            return status
+            return status, message
         if '*' in policy['allowed_mime_types']:
             status = True
         else:
             status = True if mime_type in policy['allowed_mime_types'] else False
             if not status:
-                self.message = 'not allowed to export file with MIME type: %s' % mime_type
-                logging.error(self.message)
+                message = 'not allowed to export file with MIME type: %s' % mime_type
+                logging.error(message)
         if policy['max_size'] and size > policy['max_size']:
             logging.error('%s tried to export a file exceeding the maximum size limit', self.requestor)
-            self.message = 'File size exceeds maximum allowed for %s' % tenant
+            message = 'File size exceeds maximum allowed for %s' % tenant
             status = False
-        return status
+        return status, message
 
 
     def get_file_metadata(self, filename):
@@ -1577,34 +2073,183 @@ class ProxyHandler(AuthRequestHandler):
                 # to be able to stat files down the tree
                 # where someone else is owner of dir
                 subprocess.call(['sudo', 'chmod', 'o+x', filename])
-        if os.path.isdir(filename):
-            return os.stat(filename).st_size, 'directory'
-        mime_type = magic.from_file(filename_raw_utf8, mime=True)
-        size = os.stat(filename).st_size
-        return size, mime_type
+        st = os.stat(filename)
+        if stat.S_ISDIR(st.st_mode):
+            return st.st_size, 'directory'
+        mime_type = options.file_metadata_cache.mime_type(st)
+        if mime_type is None:
+            catalogued = options.file_catalogs.lookup(self.export_dir, filename, st)
+            if catalogued and catalogued['mime_type']:
+                mime_type = catalogued['mime_type']
+                options.file_metadata_cache.set_mime_type(st, mime_type)
+                return st.st_size, mime_type
+            mime_type = _detect_mime_type(filename_raw_utf8)
+            # only cache the result if the file did not change meanwhile
+            current = os.stat(filename)
+            if current.st_mtime_ns == st.st_mtime_ns and current.st_size == st.st_size:
+                options.file_metadata_cache.set_mime_type(st, mime_type)
+            st = current
+        return st.st_size, mime_type
+
+
+    def list_file_entry(self, path, name, tenant, default_owner, baseuri):
+        """
+        Collect the metadata of a file in a listing, in the listing
+        thread pool, since stat, MIME type detection, ownership lookups,
+        and permission changes are slow on network file systems.
+
+        Directories are listed with the size, and file_count, of the
+        files in and below them, if known from the file catalog.
+
+        Returns
+        -------
+        dict, or None if the file no longer exists
+
+        """
+        filepath = os.path.join(path, name)
+        try:
+            path_stat = os.stat(filepath)
+        except FileNotFoundError:
+            return None
+        size, mime_type = self.get_file_metadata(filepath)
+        status, reason = self.export_policy_verdict(self.export_policy, filepath, tenant, size, mime_type)
+        file_count = None
+        if mime_type == 'directory':
+            totals = options.file_catalogs.directory_size(self.export_dir, filepath)
+            if totals:
+                size, file_count = totals
+        latest = path_stat.st_mtime
+        date_time = str(datetime.datetime.fromtimestamp(latest).isoformat())
+        if self.has_posix_ownership:
+            try:
+                owner = pwd.getpwuid(path_stat.st_uid).pw_name
+            except KeyError:
+                try:
+                    default_owner_id = pwd.getpwnam(default_owner).pw_uid
+                    group_id = path_stat.st_gid
+                    os.chown(group_folder, file_api_user_id, group_id)
+                    owner = default_owner
+                except (KeyError, Exception) as e:
+                    logging.error(e)
+                    logging.error(f'could not reset owner of {filepath} to default')
+                    owner = 'nobody'
+        else:
+            owner = options.api_user
+        entry = {'filename': name,
+                 'size': size,
+                 'modified_date': date_time,
+                 'href': '%s/%s' % (baseuri, url_escape(name)),
+                 'exportable': status,
+                 'reason': reason,
+                 'mime-type': mime_type,
+                 'owner': owner}
+        if file_count is not None:
+            entry['file_count'] = file_count
+        return entry
+
+
+    def _stat_entries(self, path, names):
+        stats = {}
+        for name in names:
+            try:
+                st = os.stat(os.path.join(path, name))
+            except FileNotFoundError:
+                continue
+            stats[name] = (st.st_size, st.st_mtime)
+        return stats
+
+
+    def _mime_type_entries(self, path, names):
+        mime_types = {}
+        for name in names:
+            try:
+                mime_types[name] = self.get_file_metadata(os.path.join(path, name))[1]
+            except FileNotFoundError:
+                continue
+        return mime_types
+
+
+    @gen.coroutine
+    def listing_view(self, snapshot, query):
+        """
+        Filter, and sort, the entries of a snapshot, collecting sizes,
+        modification times, and MIME types as needed, in batches, in
+        the listing thread pool. Views are cached with the snapshot.
 
+        Returns
+        -------
+        View
+
+        """
+        view = snapshot.views.get(query.key)
+        if view:
+            return view
+        loop = IOLoop.current()
+        def batches(names):
+            return [names[i:i + _LISTING_BATCH] for i in range(0, len(names), _LISTING_BATCH)]
+        names = [name for name in snapshot.names if query.matches_name(name)]
+        if query.needs_stats:
+            missing = [name for name in names if name not in snapshot.stats]
+            results = yield [
+                loop.run_in_executor(options.listing_executor, self._stat_entries, snapshot.path, batch)
+                for batch in batches(missing)
+            ]
+            for stats in results:
+                snapshot.stats.update(stats)
+            names = [name for name in names
+                     if name in snapshot.stats and query.matches_stat(*snapshot.stats[name])]
+        if query.mime_type:
+            results = yield [
+                loop.run_in_executor(options.listing_executor, self._mime_type_entries, snapshot.path, batch)
+                for batch in batches(names)
+            ]
+            mime_types = {}
+            for result in results:
+                mime_types.update(result)
+            names = [name for name in names
+                     if name in mime_types and query.matches_mime_type(mime_types[name])]
+        view = View(snapshot, query, names)
+        snapshot.views[query.key] = view
+        return view
 
+
+    @gen.coroutine
     def list_files(self, path, tenant):
         """
-        Lists files in the export directory.
+        Lists files in the export directory, in name order,
+        or filtered, and sorted, as requested, see ListingQuery.
+
+        Pages are slices of a sorted snapshot of the directory,
+        see DirectorySnapshots. The first page is requested without
+        a cursor, and the page field in the response links to the next
+        one, with a cursor, or is None on the last page. Pages can also
+        be requested by number, with page=<n>.
+
+        Metadata for the entries in a page is collected concurrently,
+        see matching_entry, and returned in order.
+
+        With format=ndjson the whole listing is streamed instead,
+        see send_ndjson.
 
         Returns
         -------
         dict
 
         """
+        if self.get_query_argument('format', None) == 'ndjson':
+            yield self.send_ndjson(path, tenant)
+            return
         current_page = 0
         pagination_value = 100
+        cursor = self.get_query_argument('cursor', None)
         try:
-            current_page = int(self.get_query_argument('page'))
-            pagination_value = int(self.get_query_argument('per_page'))
-        except HTTPError as e:
-            pass # use default value
+            current_page = int(self.get_query_argument('page', 0))
+            pagination_value = int(self.get_query_argument('per_page', 100))
         except ValueError:
             self.set_status(400)
             self.message = 'next values must be integers'
             raise Exception
-        if current_page < 0:
+        if current_page < 0 or pagination_value < 1:
             self.set_status(400)
             self.message = 'next values are natural numbers'
             raise Exception
@@ -1612,107 +2257,160 @@ class ProxyHandler(AuthRequestHandler):
             self.set_status(400)
             self.message = 'per_page cannot exceed 1000'
             raise Exception
-        # arbitrary order
-        # if not returning what you want
-        # then try next page
-        dir_map = os.scandir(path)
-        paginate = False
-        files = []
-        start_at = (current_page * pagination_value) - 1
+        try:
+            query = ListingQuery(self.get_query_argument)
+        except ValueError as e:
+            self.set_status(400)
+            self.message = 'invalid listing query: %s' % e
+            raise Exception
+        # continuations reuse their snapshot, other pages must be current
+        snapshot = yield options.listing_snapshots.get(tenant, path, current=not cursor)
+        view = yield self.listing_view(snapshot, query)
+        if cursor:
+            try:
+                start_at = view.position(cursor)
+            except InvalidCursor as e:
+                self.set_status(400)
+                self.message = e.message
+                raise Exception
+        else:
+            start_at = current_page * pagination_value
         stop_at = start_at + pagination_value
-        # only materialise the necessary entries
-        for num, entry in enumerate(dir_map):
-            if num <= start_at:
-                continue
-            elif num <= stop_at and num >= start_at:
-                files.append(entry)
-            elif num == stop_at + 1:
-                paginate = True
-                break # there is more
+        files = view.names[start_at:stop_at]
+        paginate = stop_at < len(view.names)
         if len(files) == 0:
             self.write({'files': [], 'page': None})
         else:
-            if paginate and not current_page:
-                next_page = 1
-            elif paginate:
-                next_page = str(current_page) + 1
-            else:
-                next_page = None
             baseuri = self.request.uri.split('?')[0]
-            nextref = f'{baseuri}?next={next_page}' if next_page else None
+            if paginate:
+                arguments = ''.join(f'&{k}={url_escape(v)}' for k, v in query.arguments.items())
+                nextref = f'{baseuri}?cursor={view.cursor(stop_at)}&per_page={pagination_value}{arguments}'
+            else:
+                nextref = None
             if self.export_max and len(files) > self.export_max:
                 self.set_status(400)
                 self.message = 'too many files, create a zip archive'
                 raise Exception
-            names = []
-            times = []
-            exportable = []
-            reasons = []
-            sizes = []
-            mimes = []
-            owners = []
             default_owner = options.default_file_owner.replace(options.tenant_string_pattern, tenant)
-            for file in files:
-                filepath = file.path
-                try:
-                    size, mime_type = self.get_file_metadata(filepath)
-                    status = self.enforce_export_policy(self.export_policy, filepath, tenant, size, mime_type)
-                    if status:
-                        reason = None
-                    else:
-                        reason = self.message
-                except Exception as e:
-                    logging.error(e)
-                    logging.error('could not enforce export policy when listing dir')
-                    raise Exception
-                path_stat = file.stat()
-                latest = path_stat.st_mtime
-                date_time = str(datetime.datetime.fromtimestamp(latest).isoformat())
-                if self.has_posix_ownership:
-                    try:
-                        owner = pwd.getpwuid(path_stat.st_uid).pw_name
-                    except KeyError:
-                        try:
-                            default_owner_id = pwd.getpwnam(default_owner).pw_uid
-                            group_id = path_stat.st_gid
-                            os.chown(group_folder, file_api_user_id, group_id)
-                            owner = default_owner
-                        except (KeyError, Exception) as e:
-                            logging.error(e)
-                            logging.error(f'could not reset owner of {filepath} to default')
-                            owner = 'nobody'
-                else:
-                    owner = options.api_user
-                names.append(os.path.basename(filepath))
-                times.append(date_time)
-                exportable.append(status)
-                reasons.append(reason)
-                sizes.append(size)
-                mimes.append(mime_type)
-                owners.append(owner)
-            file_info = []
-            for f, t, e, r, s, m, o in zip(names, times, exportable, reasons, sizes, mimes, owners):
-                href = '%s/%s' % (self.request.uri, url_escape(f))
-                file_info.append({'filename': f,
-                                  'size': s,
-                                  'modified_date': t,
-                                  'href': href,
-                                  'exportable': e,
-                                  'reason': r,
-                                  'mime-type': m,
-                                  'owner': o})
+            try:
+                entries = yield [
+                    IOLoop.current().run_in_executor(
+                        options.listing_executor, self.matching_entry,
+                        path, name, tenant, default_owner, baseuri, query
+                    )
+                    for name in files
+                ]
+            except Exception as e:
+                logging.error(e)
+                logging.error('could not enforce export policy when listing dir')
+                raise Exception
+            # entries removed, or changed, since the snapshot was taken are None
+            file_info = [entry for entry in entries if entry]
             logging.info('%s listed %s', self.requestor, path)
             self.write({'files': file_info, 'page': nextref})
 
 
+    def scandir_batches(self, path, query):
+        """
+        Names in the directory which match the name filter, in
+        directory order, in batches. Only a batch is held at a time.
+
+        """
+        batch = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if query.matches_name(entry.name):
+                    batch.append(entry.name)
+                    if len(batch) >= _LISTING_BATCH:
+                        yield batch
+                        batch = []
+        if batch:
+            yield batch
+
+
+    def matching_entry(self, path, name, tenant, default_owner, baseuri, query):
+        """
+        A listing entry, see list_file_entry, or None if the file
+        no longer exists, or does not match the query. The file is
+        stat'ed again, since stats in a snapshot can be stale.
+
+        """
+        if query.needs_stats:
+            try:
+                st = os.stat(os.path.join(path, name))
+            except FileNotFoundError:
+                return None
+            if not query.matches_stat(st.st_size, st.st_mtime):
+                return None
+        entry = self.list_file_entry(path, name, tenant, default_owner, baseuri)
+        if entry and not query.matches_mime_type(entry['mime-type']):
+            return None
+        return entry
+
+
+    @gen.coroutine
+    def send_ndjson(self, path, tenant):
+        """
+        Stream the listing of a directory as newline delimited JSON,
+        one entry per line, without pagination. Each batch of entries
+        is collected concurrently, and flushed to the client before
+        the next is collected, so slow clients slow down the listing.
+
+        Listings in directory order are read with scandir, one batch
+        at a time. Sorted listings need all names, and are streamed
+        from a current snapshot of the directory, see listing_view.
+
+        """
+        try:
+            query = ListingQuery(self.get_query_argument)
+        except ValueError as e:
+            self.set_status(400)
+            self.message = 'invalid listing query: %s' % e
+            raise Exception
+        loop = IOLoop.current()
+        if 'order' in query.arguments:
+            snapshot = yield options.listing_snapshots.get(tenant, path, current=True)
+            view = yield self.listing_view(snapshot, query)
+            names = view.names
+            batches = iter([names[i:i + _LISTING_BATCH] for i in range(0, len(names), _LISTING_BATCH)])
+        else:
+            batches = self.scandir_batches(path, query)
+        baseuri = self.request.uri.split('?')[0]
+        default_owner = options.default_file_owner.replace(options.tenant_string_pattern, tenant)
+        self.set_header('Content-Type', 'application/x-ndjson')
+        count = 0
+        while True:
+            batch = yield loop.run_in_executor(options.listing_executor, next, batches, None)
+            if batch is None:
+                break
+            entries = yield [
+                loop.run_in_executor(
+                    options.listing_executor, self.matching_entry,
+                    path, name, tenant, default_owner, baseuri, query
+                )
+                for name in batch
+            ]
+            lines = [json.dumps(entry) + '\n' for entry in entries if entry]
+            if lines:
+                self.write(''.join(lines))
+                count += len(lines)
+                yield self.flush()
+        metrics.incr('listing', 'ndjson')
+        logging.info('%s listed %d entries in %s', self.requestor, count, path)
+
+
     def compute_etag(self):
         """
         If there is a file resource, compute the Etag header.
-        Custom values: md5sum of string value of last modified
-        time of file. Client can get this value before staring
-        a download, and then if they need to resume for some
-        reason, check that the resource has not changed in
-        the meantime. It is also cheap to compute.
+        Client can get this value before staring a download,
+        and then if they need to resume for some reason, check
+        that the resource has not changed in the meantime.
+
+        If export_etags are enabled, and the content digest of
+        the file has been resolved (see resolve_etag), this is
+        the quoted sha256 of the content. Otherwise it is the
+        md5sum of string value of last modified time of file,
+        which is cheap to compute.
 
         Note, since this is a strong validator/Etag, nginx will
         strip it from the headers if it has been configured with
@@ -1720,10 +2418,10 @@ class ProxyHandler(AuthRequestHandler):
 
         """
         try:
+            if getattr(self, 'content_digest', None):
+                return '"%s"' % self.content_digest
             if self.filepath:
-                mtime = os.stat(self.filepath).st_mtime
-                etag = hashlib.md5(str(mtime).encode('utf-8')).hexdigest()
-                return etag
+                return _mtime_etag(os.stat(self.filepath).st_mtime)
         except (Exception, AttributeError) as e:
             return None
         else:
@@ -1731,48 +2429,558 @@ class ProxyHandler(AuthRequestHandler):
 
 
     @gen.coroutine
-    def get(self, tenant, filename=None):
+    def resolve_etag(self):
         """
-        List the export dir, or serve a file, asynchronously.
+        Look up the content digest of the file, cached in an xattr,
+        or compute it in the etag thread pool, if export_etags are
+        enabled. Large files are hashed in the background, and use
+        the cheap Etag until that is done.
 
-        1. check token claims
-        2. check the tenant
+        """
+        self.content_digest = None
+        if not options.export_etags.get('enabled', False):
+            return
+        try:
+            catalogued = yield IOLoop.current().run_in_executor(
+                options.listing_executor, options.file_catalogs.lookup,
+                self.export_dir, self.filepath, os.stat(self.filepath)
+            )
+            if catalogued and catalogued['digest']:
+                self.content_digest = catalogued['digest']
+                return
+            self.content_digest = yield etags.content_digest(
+                self.filepath, options.etag_executor,
+                options.export_etags.get('max_sync_size', 268435456)
+            )
+        except Exception as e:
+            logging.error(e)
+            logging.error('could not get content digest for %s', self.filepath)
 
-        If listing the dir:
 
-        3. run the list_files method
+    def set_validators(self, mtime=None):
+        """
+        Set Etag, and Last-Modified headers, and report whether
+        the client already has this version of the file, according
+        to If-None-Match, or else If-Modified-Since.
 
-        If serving a file:
+        Returns
+        -------
+        bool
+
+        """
+        etag = self.compute_etag()
+        if mtime is None:
+            mtime = int(os.stat(self.filepath).st_mtime)
+        self.set_header('Etag', etag)
+        self.set_header('Last-Modified', datetime.datetime.utcfromtimestamp(mtime))
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            provided = [ e.strip() for e in if_none_match.split(',') ]
+            provided = [ e[2:] if e.startswith('W/') else e for e in provided ]
+            # compressed representations of the same content
+            current = [etag] + [ '"%s-%s"' % (etag.strip('"'), encoding) for encoding in ('gzip', 'zstd') ]
+            return '*' in provided or any(e in provided for e in current)
+        if_modified_since = self.request.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.mktime_tz(email.utils.parsedate_tz(if_modified_since))
+            except (TypeError, ValueError):
+                return False
+            return mtime <= since
+        return False
 
-        3. check the filename
-        4. check that file exists
-        5. enforce the export policy
-        6. check if a byte range is being requested
-        6. set the mime type
-        7. serve the bytes requested (explicitly, or implicitly), chunked
 
+    def prepare_sendfile(self):
         """
-        self.message = 'Unknown error, please contact TSD'
+        Whether the response body can be sent with os.sendfile: only
+        on plain HTTP/1.x connections (TLS is terminated by nginx).
+
+        Bytes sent with sendfile bypass tornado, which would count
+        them as missing from the Content-Length, so the connection is
+        closed after the response instead. This must be called before
+        the headers are flushed, to announce that to the client.
+
+        """
+        if not self.export_sendfile or not hasattr(os, 'sendfile'):
+            return False
+        connection = self.request.connection
+        if not (isinstance(connection, HTTP1Connection)
+                and type(connection.stream) is IOStream):
+            return False
+        self.set_header('Connection', 'close')
+        self.sendfile_used = True
+        return True
+
+
+    @gen.coroutine
+    def close_after_sendfile(self):
+        stream = self.request.connection.stream
         try:
-            try:
-                self.authnz = self.process_token_and_extract_claims(
-                    check_tenant=self.check_tenant if self.check_tenant is not None else options.check_tenant
-                )
-            except Exception:
-                if not self.message:
-                    self.message = 'Not authorized to export data'
-                self.set_status(401)
-                raise Exception
-            assert options.valid_tenant.match(tenant)
-            self.path = self.export_dir
-            if not filename or os.path.isdir(f'{self.path}/{self.resource}'):
-                if not self.allow_list:
-                    self.message = 'Method not allowed'
-                    self.set_status(403)
-                    raise Exception
-                if filename and os.path.isdir(f'{self.path}/{self.resource}'):
-                    self.path += f'/{self.resource}'
-                self.list_files(self.path, tenant)
+            yield self.flush()
+        except StreamClosedError:
+            pass
+        finally:
+            stream.close()
+
+
+    @gen.coroutine
+    def check_export(self, tenant):
+        """
+        Check that the requested file exists, and that the export
+        policy allows it, setting the response status if not.
+        Metadata is looked up in the listing thread pool.
+
+        Returns
+        -------
+        (int, str), (size, mime_type)
+
+        """
+        if not os.path.lexists(self.filepath):
+            logging.error('%s tried to access a file that does not exist', self.requestor)
+            self.set_status(404)
+            self.message = 'File does not exist'
+            raise Exception
+        try:
+            size, mime_type = yield IOLoop.current().run_in_executor(
+                options.listing_executor, self.get_file_metadata, self.filepath
+            )
+            status = self.enforce_export_policy(self.export_policy, self.filepath, tenant, size, mime_type)
+            assert status
+        except (Exception, AssertionError) as e:
+            logging.error(e)
+            self.set_status(400)
+            raise Exception
+        return size, mime_type
+
+
+    def accel_redirect_available(self):
+        """
+        Whether nginx can send the file instead, from an internal
+        location, after the API has done authorization, and policy
+        checks. nginx handles Range requests, but would evaluate
+        If-Range against its own validators, not our Etag, so those
+        requests are still served by the API.
+
+        """
+        return (self.export_accel_redirect.get('enabled', False)
+                and 'If-Range' not in self.request.headers)
+
+
+    def accel_redirect_uri(self, tenant, filename):
+        location = self.export_accel_redirect['location']
+        location = location.replace(options.tenant_string_pattern, tenant).rstrip('/')
+        return '%s/%s' % (location, quote(filename))
+
+
+    @gen.coroutine
+    def send_file_range(self, fd, offset, count):
+        """
+        Send bytes directly from the file to the socket, without
+        copying them through user space. Each call to sendfile runs
+        in the sendfile thread pool, since reading the file can block,
+        but returns as soon as the socket is full: waiting for the
+        client happens on the IOLoop, so slow clients do not hold
+        threads, and the pool stays small.
+
+        """
+        loop = IOLoop.current()
+        stream = self.request.connection.stream
+        advice = ExportAdvice(options.page_cache, fd, count)
+        # a duplicate, since the IOLoop only allows one handler per fd,
+        # and the stream has its own
+        socket_fd = os.dup(stream.socket.fileno())
+        def send(position, size):
+            advice.reading(position, end)
+            return sendfile(socket_fd, fd.fileno(), position, size)
+        @gen.coroutine
+        def writable():
+            ready = Future()
+            def on_writable(fd, events):
+                if not ready.done():
+                    ready.set_result(None)
+            loop.add_handler(socket_fd, on_writable, IOLoop.WRITE)
+            try:
+                yield gen.with_timeout(datetime.timedelta(seconds=60), ready)
+            finally:
+                loop.remove_handler(socket_fd)
+        # when egress is limited, the range is sent one chunk at a time
+        step = self.CHUNK_SIZE if options.export_egress.limited(self.tenant) else count
+        end = offset + count
+        try:
+            while offset < end:
+                size = min(step, end - offset)
+                yield options.export_egress.acquire(self.tenant, size)
+                while size:
+                    if stream.closed():
+                        raise StreamClosedError()
+                    sent, eof = yield loop.run_in_executor(
+                        options.sendfile_executor, send, offset, size
+                    )
+                    metrics.incr('export', 'sendfile_bytes', sent)
+                    offset += sent
+                    size -= sent
+                    if eof:
+                        raise Exception('%s changed while being sent' % self.filepath)
+                    if size:
+                        yield writable()
+        except Exception:
+            # the response can no longer be completed
+            stream.close()
+            raise
+        finally:
+            os.close(socket_fd)
+        metrics.incr('export', 'sendfile_responses')
+
+
+    @gen.coroutine
+    def send_file_chunks(self, fd, offset, count, compressor=None):
+        """
+        Send bytes from the file, reading them in the export thread pool,
+        so that slow reads (e.g. cold reads from NFS) do not block other
+        requests. The next chunk is read while the current one is flushed,
+        so at most two chunks are held in memory per connection. Reading
+        stops when the client disconnects.
+
+        With a compressor, chunks are compressed in the thread pool too.
+
+        """
+        loop = IOLoop.current()
+        stream = self.request.connection.stream
+        advice = ExportAdvice(options.page_cache, fd, count)
+        end = offset + count
+        def read(position, size):
+            advice.reading(position, end)
+            data = os.pread(fd.fileno(), size, position)
+            return data, compressor.compress(data) if compressor else data
+        def read_ahead(position, remaining):
+            if remaining <= 0 or stream.closed():
+                return None
+            return loop.run_in_executor(options.export_executor, read,
+                                        position, min(self.CHUNK_SIZE, remaining))
+        pending = read_ahead(offset, count)
+        try:
+            while pending is not None:
+                data, output = yield pending
+                pending = None
+                if not data:
+                    break
+                offset += len(data)
+                count -= len(data)
+                pending = read_ahead(offset, count)
+                if output:
+                    yield options.export_egress.acquire(self.tenant, len(output))
+                    self.write(output)
+                    yield self.flush()
+            if compressor:
+                output = compressor.flush()
+                yield options.export_egress.acquire(self.tenant, len(output))
+                self.write(output)
+                yield self.flush()
+        finally:
+            # the file must stay open until reads in progress are done
+            if pending is not None:
+                try:
+                    yield pending
+                except Exception:
+                    pass
+
+
+    def negotiate_compression(self, mime_type, size):
+        """
+        Choose a content coding for a full file export, if compression
+        is enabled, the MIME type is in the configured compressible set,
+        and the client accepts it. Range requests are never compressed.
+
+        Returns
+        -------
+        str, or None
+
+        """
+        config = options.export_compression
+        if not config.get('enabled', False) or 'Range' in self.request.headers:
+            return None
+        if mime_type not in config.get('mime_types', []) or size < config.get('min_size', 1024):
+            return None
+        accepted = accepted_encodings(self.request.headers.get('Accept-Encoding', ''))
+        if 'zstd' in accepted and zstandard:
+            return 'zstd'
+        elif 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+
+    def tree_entries(self, directory, tenant, max_depth):
+        """
+        Entries in and below the directory, down to max_depth levels,
+        in batches, as dicts with a path relative to the directory,
+        type, size, modified_date, and, for files, the Etag which
+        would be returned when exporting them. Reserved resources,
+        files which do not conform to the export policy, symlinks,
+        and special files are skipped, as for archives.
+
+        """
+        batch = []
+        for root, dirs, files in os.walk(directory):
+            relative_root = os.path.relpath(root, directory)
+            depth = 1 if relative_root == '.' else relative_root.count(os.sep) + 2
+            dirs[:] = sorted(d for d in dirs if not os.path.islink(os.path.join(root, d))
+                             and self.is_reserved_resource(root, d))
+            entries = [(d, 'directory') for d in dirs] + [(f, 'file') for f in sorted(files)]
+            if depth >= max_depth:
+                dirs[:] = []
+            for name, kind in entries:
+                path = os.path.join(root, name)
+                try:
+                    st = os.lstat(path)
+                    if kind == 'file':
+                        if not stat.S_ISREG(st.st_mode) or not self.is_reserved_resource(root, name):
+                            continue
+                        size, mime_type = self.get_file_metadata(path)
+                        status, reason = self.export_policy_verdict(self.export_policy, path, tenant, size, mime_type)
+                        if not status:
+                            continue
+                except FileNotFoundError:
+                    continue
+                entry = {
+                    'path': os.path.relpath(path, directory),
+                    'type': kind,
+                    'size': st.st_size,
+                    'modified_date': datetime.datetime.fromtimestamp(st.st_mtime).isoformat(),
+                }
+                if kind == 'file':
+                    entry['etag'] = self.file_etag(path, st)
+                batch.append(entry)
+                if len(batch) >= _LISTING_BATCH:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+
+    def file_etag(self, path, st):
+        """The Etag of a file, if it were exported, without hashing it."""
+        digest = None
+        if options.export_etags.get('enabled', False):
+            digest = etags.cached_digest(path, st)
+            if not digest:
+                catalogued = options.file_catalogs.lookup(self.export_dir, path, st)
+                digest = catalogued and catalogued['digest']
+        return '"%s"' % digest if digest else _mtime_etag(st.st_mtime)
+
+
+    @gen.coroutine
+    def send_tree(self, directory, tenant):
+        """
+        Stream a recursive listing of a directory, see tree_entries,
+        as one JSON document, walking the tree in the listing thread pool.
+
+        """
+        max_depth = options.listing_tree_max_depth
+        try:
+            depth = int(self.get_query_argument('depth', max_depth))
+            assert 0 < depth <= max_depth
+        except (ValueError, AssertionError):
+            self.set_status(400)
+            self.message = 'depth must be between 1 and %d' % max_depth
+            raise Exception
+        loop = IOLoop.current()
+        batches = self.tree_entries(directory, tenant, depth)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write('{"files": [')
+        separator = ''
+        while True:
+            batch = yield loop.run_in_executor(options.listing_executor, next, batches, None)
+            if batch is None:
+                break
+            self.write(separator + ', '.join(json.dumps(entry) for entry in batch))
+            separator = ', '
+            yield self.flush()
+        self.write('], "depth": %d}' % depth)
+        metrics.incr('listing', 'trees')
+
+
+    def archive_members(self, directory, tenant):
+        """
+        Files in and below the directory which may be exported,
+        as (path, name in archive). Reserved resources, files which
+        do not conform to the export policy, symlinks, and special
+        files are skipped.
+
+        """
+        parent = os.path.dirname(directory)
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = sorted(d for d in dirs if not os.path.islink(os.path.join(root, d))
+                             and self.is_reserved_resource(root, d))
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                if os.path.islink(path) or not os.path.isfile(path):
+                    continue
+                if not self.is_reserved_resource(root, name):
+                    continue
+                try:
+                    size, mime_type = self.get_file_metadata(path)
+                    status, reason = self.export_policy_verdict(self.export_policy, path, tenant, size, mime_type)
+                    if not status:
+                        continue
+                except Exception as e:
+                    logging.error(e)
+                    logging.error('could not enforce export policy for %s', path)
+                    continue
+                yield path, os.path.relpath(path, parent)
+
+
+    @gen.coroutine
+    def send_archive(self, directory, archive_format, tenant):
+        """
+        Stream a tar, or zip archive of a directory, built on the fly,
+        in the archive thread pool, without a temporary file on disk.
+        Members are checked while the archive is written, see archive_members.
+
+        """
+        name = os.path.basename(directory)
+        self.set_header('Content-Type', 'application/x-tar' if archive_format == 'tar' else 'application/zip')
+        self.set_header('Content-Disposition', 'attachment; filename="%s.%s"' % (name, archive_format))
+        loop = IOLoop.current()
+        writer = _ArchiveWriter(loop, self.CHUNK_SIZE)
+        producer = loop.run_in_executor(options.archive_executor, _write_archive, writer,
+                                        archive_format, self.archive_members(directory, tenant))
+        try:
+            while True:
+                data = yield writer.chunks.get()
+                if data is None:
+                    break
+                yield options.export_egress.acquire(tenant, len(data))
+                self.write(data)
+                yield self.flush()
+                writer.slots.release()
+            yield producer
+            metrics.incr('export', 'archives')
+        finally:
+            writer.cancelled = True
+            # if the client went away, the producer stops with an error,
+            # which must be retrieved, to not be reported as unhandled
+            producer.add_done_callback(_archive_stopped)
+
+
+    @gen.coroutine
+    def send_byte_ranges(self, fd, client_byte_index_range, size, mime_type):
+        """
+        Serve a Range request with more than one range. Ranges which
+        overlap, or are adjacent, are coalesced, and if more than one
+        remains, they are sent as a multipart/byteranges response.
+        Each part is sent with sendfile, or read ahead, like other exports.
+
+        """
+        if client_byte_index_range.count(',') >= options.export_max_ranges:
+            self.set_status(416)
+            self.message = 'Too many byte ranges requested, maximum: %d' % options.export_max_ranges
+            raise Exception(self.message)
+        try:
+            ranges = parse_byte_ranges(client_byte_index_range, size)
+        except ValueError as e:
+            self.set_status(416)
+            self.message = 'Range request exceeds byte range of resource'
+            raise e
+        self.set_status(206)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+            parts = [(b'', start, end - start + 1)]
+            closing = b''
+        else:
+            boundary = uuid4().hex
+            self.set_header('Content-Type', 'multipart/byteranges; boundary=%s' % boundary)
+            parts = []
+            for start, end in ranges:
+                part_headers = '--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % \
+                               (boundary, mime_type, start, end, size)
+                parts.append((part_headers.encode('utf-8'), start, end - start + 1))
+            closing = ('--%s--\r\n' % boundary).encode('utf-8')
+        separator = b'\r\n' if closing else b''
+        content_length = sum(len(part_headers) + count + len(separator)
+                             for part_headers, start, count in parts) + len(closing)
+        self.set_header('Content-Length', content_length)
+        use_sendfile = self.prepare_sendfile()
+        yield self.flush()
+        for part_headers, start, count in parts:
+            if part_headers:
+                self.write(part_headers)
+                yield self.flush()
+            if use_sendfile:
+                yield self.send_file_range(fd, start, count)
+            else:
+                yield self.send_file_chunks(fd, start, count)
+            if separator:
+                self.write(separator)
+        if closing:
+            self.write(closing)
+            yield self.flush()
+
+
+    @gen.coroutine
+    def get(self, tenant, filename=None):
+        """
+        List the export dir, or serve a file, asynchronously.
+
+        1. check token claims
+        2. check the tenant
+
+        If exporting a dir, with format=tar or format=zip:
+
+        3. stream an archive of the exportable files in the dir
+
+        If listing the dir:
+
+        3. run the list_files method, or send_tree, with recursive=true
+
+        If serving a file:
+
+        3. check the filename
+        4. check that file exists
+        5. enforce the export policy
+        6. check if a byte range is being requested
+        6. set the mime type
+        7. serve the bytes requested (explicitly, or implicitly), chunked,
+           compressed, if negotiated, see negotiate_compression,
+           reading ahead in a thread pool, or with sendfile, if enabled for the backend, or let nginx
+           serve them, with X-Accel-Redirect, if enabled for the backend
+
+        """
+        self.message = 'Unknown error, please contact TSD'
+        try:
+            try:
+                self.authnz = self.process_token_and_extract_claims(
+                    check_tenant=self.check_tenant if self.check_tenant is not None else options.check_tenant
+                )
+            except Exception:
+                if not self.message:
+                    self.message = 'Not authorized to export data'
+                self.set_status(401)
+                raise Exception
+            assert options.valid_tenant.match(tenant)
+            self.path = self.export_dir
+            archive_format = self.get_query_argument('format', None)
+            if filename and archive_format in ('tar', 'zip') and os.path.isdir(f'{self.path}/{self.resource}'):
+                if not self.allow_export:
+                    self.message = 'Method not allowed'
+                    self.set_status(403)
+                    raise Exception
+                directory = os.path.normpath(f'{self.path}/{self.resource}')
+                yield self.send_archive(directory, archive_format, tenant)
+                logging.info('user: %s, exported %s archive of: %s', self.requestor, archive_format, directory)
+                return
+            if not filename or os.path.isdir(f'{self.path}/{self.resource}'):
+                if not self.allow_list:
+                    self.message = 'Method not allowed'
+                    self.set_status(403)
+                    raise Exception
+                if filename and os.path.isdir(f'{self.path}/{self.resource}'):
+                    self.path += f'/{self.resource}'
+                if self.get_query_argument('recursive', None) == 'true':
+                    yield self.send_tree(os.path.normpath(self.path), tenant)
+                    logging.info('%s listed the tree of %s', self.requestor, self.path)
+                    return
+                yield self.list_files(self.path, tenant)
                 return
             if not self.allow_export:
                 self.message = 'Method not allowed'
@@ -1785,30 +2993,55 @@ class ProxyHandler(AuthRequestHandler):
                 self.set_status(403)
                 raise Exception
             self.filepath = '%s/%s' % (self.path, secured_filename)
-            if not os.path.lexists(self.filepath):
-                logging.error('%s tried to access a file that does not exist', self.requestor)
-                self.set_status(404)
-                self.message = 'File does not exist'
-                raise Exception
-            try:
-                size, mime_type = self.get_file_metadata(self.filepath)
-                status = self.enforce_export_policy(self.export_policy, self.filepath, tenant, size, mime_type)
-                assert status
-            except (Exception, AssertionError) as e:
-                logging.error(e)
-                self.set_status(400)
-                raise Exception
+            if self.accel_redirect_available():
+                # nginx opens, and sends the file, so it is only checked here
+                size, mime_type = yield self.check_export(tenant)
+                yield self.resolve_etag()
+                self.set_header('Content-Type', mime_type)
+                if self.set_validators():
+                    self.set_status(304)
+                    metrics.incr('export', 'not_modified')
+                    return
+                self.set_header('Accept-Ranges', 'bytes')
+                self.set_header('X-Accel-Redirect', self.accel_redirect_uri(tenant, secured_filename))
+                metrics.incr('export', 'accel_redirects')
+                logging.info('user: %s, redirected to file: %s , with MIME type: %s', self.requestor, self.filepath, mime_type)
+                return
+            # files which passed this backend's checks recently are kept open
+            self.open_file = options.export_file_cache.acquire(self.filepath, scope=self.backend)
+            if not self.open_file:
+                size, mime_type = yield self.check_export(tenant)
+                self.open_file = options.export_file_cache.insert(self.filepath, size, mime_type,
+                                                                  scope=self.backend)
+            size, mime_type = self.open_file.size, self.open_file.mime_type
+            self.content_digest = self.open_file.content_digest
+            if not self.content_digest:
+                yield self.resolve_etag()
+                self.open_file.content_digest = self.content_digest
+            fd = self.open_file.file
             self.set_header('Content-Type', mime_type)
-            if 'Range' not in self.request.headers:
+            if self.set_validators(self.open_file.mtime):
+                self.set_status(304)
+                metrics.incr('export', 'not_modified')
+                return
+            encoding = self.negotiate_compression(mime_type, size)
+            if encoding:
+                self.set_header('Content-Encoding', encoding)
+                self.set_header('Vary', 'Accept-Encoding')
+                # a different representation, so a different strong Etag
+                self.set_header('Etag', '"%s-%s"' % (self.compute_etag().strip('"'), encoding))
+                yield self.flush()
+                compressor = stream_compressor(encoding, options.export_compression.get('level', 6))
+                yield self.send_file_chunks(fd, 0, size, compressor)
+                metrics.incr('export', 'compressed_responses')
+            elif 'Range' not in self.request.headers:
                 self.set_header('Content-Length', size)
-                self.flush()
-                fd = open(self.filepath, "rb")
-                data = fd.read(self.CHUNK_SIZE)
-                while data:
-                    self.write(data)
-                    yield self.flush()
-                    data = fd.read(self.CHUNK_SIZE)
-                fd.close()
+                use_sendfile = self.prepare_sendfile()
+                yield self.flush()
+                if use_sendfile:
+                    yield self.send_file_range(fd, 0, size)
+                else:
+                    yield self.send_file_chunks(fd, 0, size)
             elif 'Range' in self.request.headers:
                 if 'If-Range' in self.request.headers:
                     provided_etag = self.request.headers['If-Range']
@@ -1820,12 +3053,12 @@ class ProxyHandler(AuthRequestHandler):
                 # clients specify the range in terms of 0-based index numbers
                 # with an inclusive interval: [start, end]
                 client_byte_index_range = self.request.headers['Range']
-                full_file_size = os.stat(self.filepath).st_size
+                full_file_size = size
+                if ',' in client_byte_index_range:
+                    yield self.send_byte_ranges(fd, client_byte_index_range, full_file_size, mime_type)
+                    logging.info('user: %s, exported byte ranges of file: %s', self.requestor, self.filepath)
+                    return
                 start_and_end = client_byte_index_range.split('=')[-1].split('-')
-                if ',' in start_and_end:
-                    self.set_status(405)
-                    self.message = 'Multipart byte range requests not supported'
-                    raise Exception(self.message)
                 client_start = int(start_and_end[0])
                 cursor_start = client_start
                 try:
@@ -1839,33 +3072,26 @@ class ProxyHandler(AuthRequestHandler):
                 # we must add 1 to calculate the desired amount to read
                 bytes_to_read = client_end - client_start + 1
                 self.set_header('Content-Length', bytes_to_read)
-                self.flush()
-                fd = open(self.filepath, "rb")
-                fd.seek(cursor_start)
-                sent = 0
-                if self.CHUNK_SIZE > bytes_to_read:
-                    self.CHUNK_SIZE = bytes_to_read
-                data = fd.read(self.CHUNK_SIZE)
-                sent = sent + self.CHUNK_SIZE
-                while data and sent <= bytes_to_read:
-                    self.write(data)
-                    yield self.flush()
-                    data = fd.read(self.CHUNK_SIZE)
-                    sent = sent + self.CHUNK_SIZE
-                fd.close()
+                use_sendfile = self.prepare_sendfile()
+                yield self.flush()
+                if use_sendfile:
+                    yield self.send_file_range(fd, cursor_start, bytes_to_read)
+                else:
+                    yield self.send_file_chunks(fd, cursor_start, bytes_to_read)
             logging.info('user: %s, exported file: %s , with MIME type: %s', self.requestor, self.filepath, mime_type)
         except Exception as e:
             logging.error(e)
             logging.error(self.message)
             self.write({'message': self.message})
         finally:
-            try:
-                fd.close()
-            except (OSError, UnboundLocalError) as e:
-                pass
+            if getattr(self, 'open_file', None):
+                options.export_file_cache.release(self.open_file)
+            if self.sendfile_used:
+                yield self.close_after_sendfile()
             self.finish()
 
 
+    @gen.coroutine
     def head(self, tenant, filename):
         """
         Return information about a specific file.
@@ -1902,14 +3128,30 @@ class ProxyHandler(AuthRequestHandler):
                 self.set_status(404)
                 self.message = 'File does not exist'
                 raise Exception
+            loop = IOLoop.current()
             if os.path.isdir(self.filepath):
+                totals = yield loop.run_in_executor(
+                    options.listing_executor, options.file_catalogs.directory_size,
+                    self.path, self.filepath
+                )
+                if totals:
+                    self.set_header('Directory-Size', totals[0])
+                    self.set_header('Directory-File-Count', totals[1])
+                    self.set_status(200)
+                    return
                 self.set_status(403)
                 self.message = 'Cannot perform HEAD on directory'
                 raise Exception
-            size, mime_type = self.get_file_metadata(self.filepath)
+            size, mime_type = yield loop.run_in_executor(
+                options.listing_executor, self.get_file_metadata, self.filepath
+            )
             status = self.enforce_export_policy(self.export_policy, self.filepath, tenant, size, mime_type)
             assert status
             logging.info('user: %s, checked file: %s , with MIME type: %s', self.requestor, self.filepath, mime_type)
+            yield self.resolve_etag()
+            if self.set_validators():
+                self.set_status(304)
+                return
             self.set_header('Content-Length', size)
             self.set_header('Accept-Ranges', 'bytes')
             self.set_status(200)
@@ -1968,6 +3210,8 @@ class ProxyHandler(AuthRequestHandler):
                 if self.has_posix_ownership:
                     subprocess.call(['sudo', 'chmod', 'o-w',  os.path.dirname(self.filepath)])
                 self.message = 'Deleted %s' % self.filepath
+                options.change_feeds.notify(self.filepath, 'deleted')
+                options.file_catalogs.remove(self.export_dir, self.filepath)
             except OSError as e:
                 self.set_status(500)
                 self.message = 'Problem deleting %s' % self.filepath
@@ -1997,6 +3241,365 @@ class ProxyHandler(AuthRequestHandler):
                 logging.error(e)
 
 
+class ChangesHandler(AuthRequestHandler):
+
+    """
+    Changes to files in a tenant's export directory, since a token,
+    see ChangeFeeds. Clients start without a token, list the directory,
+    and then follow the changes, with the token from each response.
+
+    GET /v1/<tenant>/<backend>/changes?since=<token>
+
+        {'changes': [{'path', 'event', 'time'}, ...], 'token': str, 'reset': bool}
+
+    With wait=<seconds>, the request waits for changes, if there are none
+    (long polling), and with Accept: text/event-stream, changes are sent
+    as server-sent events, as they happen, until the client disconnects.
+
+    """
+
+    def initialize(self, backend):
+        self.backend = backend
+        self.backend_config = options.config['backends']['disk'][backend]
+        self.check_tenant = self.backend_config.get('check_tenant')
+        self.allow_list = self.backend_config['allow_list']
+        self.group_config = self.backend_config.get('group_logic', {
+            'enabled': False,
+            'default_url_group': '',
+            'default_memberships': [],
+            'ensure_tenant_in_group_name': False,
+            'valid_group_regex': None,
+            'enforce_membership': False
+        })
+        self.closed = False
+        self.waiter = None
+
+
+    def on_connection_close(self):
+        self.closed = True
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+
+    @gen.coroutine
+    def wait_for_changes(self, seconds):
+        self.waiter = self.feed.wait()
+        try:
+            yield gen.with_timeout(datetime.timedelta(seconds=seconds), self.waiter)
+        except gen.TimeoutError:
+            pass
+        finally:
+            self.feed.cancel(self.waiter)
+
+
+    @gen.coroutine
+    def get(self, tenant):
+        self.message = 'Unknown error, please contact TSD'
+        try:
+            if not options.change_feed.get('enabled', False):
+                self.message = 'Method not allowed'
+                self.set_status(403)
+                raise Exception
+            try:
+                self.authnz = self.process_token_and_extract_claims(
+                    check_tenant=self.check_tenant if self.check_tenant is not None else options.check_tenant
+                )
+            except Exception:
+                if not self.message:
+                    self.message = 'Not authorized to follow changes'
+                self.set_status(401)
+                raise Exception
+            assert options.valid_tenant.match(tenant)
+            if not self.allow_list:
+                self.message = 'Method not allowed'
+                self.set_status(403)
+                raise Exception
+            try:
+                group_name, group_memberships = self.get_group_info(tenant, self.group_config, self.authnz)
+                self.enforce_group_logic(group_name, group_memberships, tenant, self.group_config)
+            except Exception as e:
+                logging.error(e)
+                self.message = 'could not perform group checks'
+                self.set_status(401)
+                raise Exception
+            export_dir = self.backend_config['export_path'].replace(options.tenant_string_pattern, tenant)
+            if not os.path.isdir(export_dir):
+                self.set_status(404)
+                self.message = 'Export directory does not exist'
+                raise Exception
+            max_wait = options.change_feed.get('max_wait', 60)
+            try:
+                wait = min(float(self.get_query_argument('wait', 0)), max_wait)
+            except ValueError:
+                self.set_status(400)
+                self.message = 'wait must be a number of seconds'
+                raise Exception
+            self.feed = yield options.change_feeds.feed(export_dir)
+            token = self.get_query_argument('since', None)
+            if 'text/event-stream' in self.request.headers.get('Accept', ''):
+                yield self.send_events(token or self.feed.token(), max_wait)
+                return
+            if not token:
+                self.write({'changes': [], 'token': self.feed.token(), 'reset': False})
+                return
+            changes, token, reset = self.feed.since(token)
+            if not changes and not reset and wait:
+                yield self.wait_for_changes(wait)
+                changes, token, reset = self.feed.since(token)
+            self.write({'changes': changes, 'token': token, 'reset': reset})
+        except Exception as e:
+            logging.error(e)
+            logging.error(self.message)
+            self.write({'message': self.message})
+
+
+    @gen.coroutine
+    def send_events(self, token, heartbeat):
+        """
+        Send changes as server-sent events, with the token as event id,
+        and a comment as heartbeat, when idle.
+
+        """
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        while not self.closed:
+            changes, token, reset = self.feed.since(token)
+            if reset:
+                self.write('event: reset\nid: %s\ndata: {}\n\n' % token)
+            for change in changes:
+                self.write('id: %s\ndata: %s\n\n' % (token, json.dumps(change)))
+            if not changes and not reset:
+                self.write(': heartbeat\n\n')
+            yield self.flush()
+            yield self.wait_for_changes(heartbeat)
+
+
+class BatchHandler(ProxyHandler):
+
+    """
+    Metadata, or deletion, of many files in a tenant's export directory
+    in one request, authenticated once, with a status per path.
+
+    POST /v1/<tenant>/<backend>/batch
+
+        {'operation': 'metadata' or 'delete', 'paths': [str, ...]}
+
+    Paths are relative to the export directory. The response lists
+    results in the order of the paths:
+
+        {'results': [{'path', 'status', ...}, ...]}
+
+    Metadata results have size, mime-type, exportable, reason, and etag,
+    and delete results have a message. At most batch.max_paths paths
+    are accepted per request. Deleted files are published to the
+    message queue one by one, as if deleted with DELETE requests.
+
+    """
+
+    @gen.coroutine
+    def prepare(self):
+        self.error = None
+        self.body = []
+        try:
+            if options.maintenance_mode_enabled:
+                self.set_status(503)
+                self.error = 'Service temporarily unavailable'
+                raise Exception(self.error)
+            self.request.connection.set_max_body_size(options.batch.get('max_body_size', 16777216))
+            try:
+                self.authnz = self.process_token_and_extract_claims(
+                    check_tenant=self.check_tenant if self.check_tenant is not None else options.check_tenant
+                )
+            except Exception as e:
+                self.error = 'Access token invalid'
+                raise e
+            self.tenant = tenant_from_url(self.request.uri)
+            assert options.valid_tenant.match(self.tenant)
+            group_name, group_memberships = self.get_group_info(self.tenant, self.group_config, self.authnz)
+            self.enforce_group_logic(group_name, group_memberships, self.tenant, self.group_config)
+        except Exception as e:
+            logging.error(e)
+            if self._status_code != 503:
+                self.set_status(401)
+            self.finish({'message': self.error or 'Not authorized'})
+
+
+    def data_received(self, chunk):
+        self.body.append(chunk)
+
+
+    def batch_target(self, path):
+        """
+        The file a path in a batch refers to.
+
+        Returns
+        -------
+        (str, dict), the file path, or None, and an error result, or None
+
+        """
+        if not isinstance(path, str) or not path or path.startswith('/'):
+            return None, {'path': path, 'status': 400, 'message': 'invalid path'}
+        export_dir = os.path.normpath(self.export_dir)
+        filepath = os.path.normpath(f'{export_dir}/{path}')
+        if not filepath.startswith(export_dir + '/') or not self.is_reserved_resource(self.export_dir, path):
+            return None, {'path': path, 'status': 400, 'message': 'reserved resource name'}
+        try:
+            check_filename(os.path.basename(filepath), disallowed_start_chars=options.start_chars)
+        except Exception:
+            return None, {'path': path, 'status': 400, 'message': 'invalid path'}
+        if not os.path.lexists(filepath):
+            return None, {'path': path, 'status': 404, 'message': 'File does not exist'}
+        return filepath, None
+
+
+    def path_metadata(self, path, tenant):
+        """
+        Like HEAD, for one path in a batch, in the listing thread pool.
+        Unlike HEAD, directories are always reported, with status 200,
+        as in listings: with their recursive size, and file_count, when
+        the file catalog knows them, and their own size otherwise.
+
+        """
+        filepath, error = self.batch_target(path)
+        if error:
+            return error
+        try:
+            st = os.stat(filepath)
+            size, mime_type = self.get_file_metadata(filepath)
+            status, reason = self.export_policy_verdict(self.export_policy, filepath, tenant, size, mime_type)
+        except FileNotFoundError:
+            return {'path': path, 'status': 404, 'message': 'File does not exist'}
+        result = {'path': path, 'status': 200, 'size': size, 'mime-type': mime_type,
+                  'exportable': status, 'reason': reason, 'etag': None}
+        if mime_type == 'directory':
+            totals = options.file_catalogs.directory_size(self.export_dir, filepath)
+            if totals:
+                result['size'], result['file_count'] = totals
+        else:
+            result['etag'] = self.file_etag(filepath, st)
+        return result
+
+
+    def delete_files(self, directory, targets):
+        """
+        Like DELETE, for the files in one directory, in the listing
+        thread pool, changing the permissions of the directory once.
+
+        Returns
+        -------
+        list of (path, filepath, dict)
+
+        """
+        results = []
+        if self.has_posix_ownership:
+            subprocess.call(['sudo', 'chmod', 'o+w', directory])
+        try:
+            for path, filepath in targets:
+                if os.path.isdir(filepath):
+                    results.append((path, None, {'path': path, 'status': 403, 'message': 'Cannot delete directory'}))
+                    continue
+                try:
+                    os.remove(filepath)
+                    results.append((path, filepath, {'path': path, 'status': 200, 'message': 'Deleted'}))
+                except FileNotFoundError:
+                    results.append((path, None, {'path': path, 'status': 404, 'message': 'File does not exist'}))
+                except OSError as e:
+                    logging.error(e)
+                    results.append((path, None, {'path': path, 'status': 500, 'message': 'Problem deleting file'}))
+        finally:
+            if self.has_posix_ownership:
+                subprocess.call(['sudo', 'chmod', 'o-w', directory])
+        return results
+
+
+    @gen.coroutine
+    def post(self, tenant):
+        self.message = 'Unknown error, please contact TSD'
+        try:
+            try:
+                batch = json.loads(b''.join(self.body))
+                operation, paths = batch['operation'], batch['paths']
+                assert operation in ('metadata', 'delete') and isinstance(paths, list)
+            except Exception:
+                self.set_status(400)
+                self.message = 'body must be {"operation": "metadata" or "delete", "paths": [...]}'
+                raise Exception
+            max_paths = options.batch.get('max_paths', 1000)
+            if len(paths) > max_paths:
+                self.set_status(413)
+                self.message = 'at most %d paths per batch' % max_paths
+                raise Exception
+            allowed = self.allow_info if operation == 'metadata' else self.allow_delete
+            if not allowed:
+                self.set_status(403)
+                self.message = 'Method not allowed'
+                raise Exception
+            loop = IOLoop.current()
+            if operation == 'metadata':
+                results = yield [
+                    loop.run_in_executor(options.listing_executor, self.path_metadata, path, tenant)
+                    for path in paths
+                ]
+            else:
+                results = yield self.delete_batch(paths)
+            metrics.incr('batch', operation)
+            metrics.incr('batch', '%s_paths' % operation, len(paths))
+            self.write({'results': results})
+        except Exception as e:
+            logging.error(e)
+            logging.error(self.message)
+            self.write({'message': self.message})
+
+
+    @gen.coroutine
+    def delete_batch(self, paths):
+        results = {}
+        self.deleted_paths = []
+        directories = OrderedDict()
+        for i, path in enumerate(paths):
+            filepath, error = self.batch_target(path)
+            if error:
+                results[i] = error
+            else:
+                directories.setdefault(os.path.dirname(filepath), []).append((i, path, filepath))
+        loop = IOLoop.current()
+        deleted = yield [
+            loop.run_in_executor(
+                options.listing_executor, self.delete_files,
+                directory, [(path, filepath) for i, path, filepath in targets]
+            )
+            for directory, targets in directories.items()
+        ]
+        for targets, outcomes in zip(directories.values(), deleted):
+            for (i, path, _), (_, filepath, result) in zip(targets, outcomes):
+                results[i] = result
+                if filepath:
+                    options.change_feeds.notify(filepath, 'deleted')
+                    options.file_catalogs.remove(self.export_dir, filepath)
+                    self.deleted_paths.append(filepath)
+                    logging.info('user: %s, deleted file: %s', self.requestor, filepath)
+        return [results[i] for i in range(len(paths))]
+
+
+    def on_finish(self):
+        if options.maintenance_mode_enabled:
+            return
+        for filepath in getattr(self, 'deleted_paths', []):
+            try:
+                message_data = {
+                    'path': filepath,
+                    'requestor': self.requestor,
+                    'group': None
+                }
+                self.handle_mq_publication(
+                    mq_config=self.mq_config,
+                    data=message_data,
+                    method='DELETE'
+                )
+            except Exception as e:
+                logging.error(e)
+
+
 class GenericTableHandler(AuthRequestHandler):
 
     """
@@ -2309,6 +3912,12 @@ class NaclKeyHander(RequestHandler):
         }
         self.write(out)
 
+class MetricsHandler(RequestHandler):
+
+    def get(self):
+        self.write(metrics.snapshot())
+
+
 class RunTimeConfigurationHandler(RequestHandler):
 
     def post(self):
@@ -2335,6 +3944,7 @@ class Backends(object):
             ('/v1/(.*)/files/health', HealthCheckHandler),
         ],
         'runtime_configuration': [
+            ('/v1/admin/metrics', MetricsHandler),
             ('/v1/admin.*', RunTimeConfigurationHandler),
         ]
     }
@@ -2349,6 +3959,8 @@ class Backends(object):
             ('/v1/(.*)/cluster/resumables/(.*)', ResumablesHandler, dict(backend='cluster')),
             ('/v1/(.*)/cluster/export', ProxyHandler, dict(backend='cluster', namespace='cluster', endpoint='export')),
             ('/v1/(.*)/cluster/export/(.*)', ProxyHandler, dict(backend='cluster', namespace='cluster', endpoint='export')),
+            ('/v1/(.*)/cluster/changes', ChangesHandler, dict(backend='cluster')),
+            ('/v1/(.*)/cluster/batch', BatchHandler, dict(backend='cluster', namespace='cluster', endpoint='batch')),
         ],
         'files_import': [
             ('/v1/(.*)/files/upload_stream', StreamHandler, dict(backend='files_import')),
@@ -2361,6 +3973,8 @@ class Backends(object):
         'files_export': [
             ('/v1/(.*)/files/export', ProxyHandler, dict(backend='files_export', namespace='files', endpoint='export')),
             ('/v1/(.*)/files/export/(.*)', ProxyHandler, dict(backend='files_export', namespace='files', endpoint='export')),
+            ('/v1/(.*)/files/changes', ChangesHandler, dict(backend='files_export')),
+            ('/v1/(.*)/files/batch', BatchHandler, dict(backend='files_export', namespace='files', endpoint='batch')),
         ],
         'survey': [
             ('/v1/(.*)/survey/crypto/key', NaclKeyHander),
@@ -2388,6 +4002,8 @@ class Backends(object):
             ('/v1/(.*)/store/resumables/(.*)', ResumablesHandler, dict(backend='store')),
             ('/v1/(.*)/store/export', ProxyHandler, dict(backend='store', namespace='store', endpoint='export')),
             ('/v1/(.*)/store/export/(.*)', ProxyHandler, dict(backend='store', namespace='store', endpoint='export')),
+            ('/v1/(.*)/store/changes', ChangesHandler, dict(backend='store')),
+            ('/v1/(.*)/store/batch', BatchHandler, dict(backend='store', namespace='store', endpoint='batch')),
         ],
         'apps_files' : [
             ('/v1/(.*)/apps/.+/resumables', ResumablesHandler, dict(backend='apps_files')),
@@ -2469,6 +4085,52 @@ class Backends(object):
             self.exchanges[name] = mq_config
 
 
+def resumable_work_dirs(config):
+    """Find all tenant directories which can contain resumables."""
+    patterns = set()
+    for backend_config in config['backends'].get('disk', {}).values():
+        for key in ['import_path', 'admin_path']:
+            path = backend_config.get(key)
+            if path:
+                patterns.add(path.replace(options.tenant_string_pattern, '*'))
+    work_dirs = set()
+    for pattern in patterns:
+        work_dirs.update([ d for d in glob.glob(pattern) if os.path.isdir(d) ])
+    return sorted(work_dirs)
+
+
+_GC_STATE = {'running': False}
+
+
+@gen.coroutine
+def collect_resumables_garbage(repair=False):
+    """
+    Expire stale resumables, reclaiming disk space and compacting
+    resumable dbs, optionally repairing inconsistent resumables.
+    File system work is done in a thread pool.
+
+    """
+    if _GC_STATE['running']:
+        return
+    _GC_STATE['running'] = True
+    try:
+        max_age = options.resumables_gc.get('max_age', 604800)
+        min_idle = options.resumables_gc.get('min_idle', 300)
+        for work_dir in resumable_work_dirs(options.config):
+            try:
+                summary = yield IOLoop.current().run_in_executor(
+                    None, collect_garbage, work_dir, max_age, repair, min_idle
+                )
+                if summary['expired'] or summary['orphans']:
+                    logging.info('resumables gc: %s, %s', work_dir, summary)
+            except Exception as e:
+                logging.error(e)
+                logging.error('resumables gc failed for %s', work_dir)
+        metrics.set_value('resumables_gc', 'last_run', time.time())
+    finally:
+        _GC_STATE['running'] = False
+
+
 def main():
     tornado.log.enable_pretty_logging()
     backends = Backends(options.config)
@@ -2484,6 +4146,22 @@ def main():
     ioloop = IOLoop.instance()
     if pika_client:
         ioloop.add_timeout(time.time() + .1, pika_client.connect)
+    if options.resumables_gc.get('enabled'):
+        ioloop.add_callback(collect_resumables_garbage, repair=True)
+        PeriodicCallback(
+            collect_resumables_garbage,
+            options.resumables_gc.get('interval', 3600) * 1000
+        ).start()
+    if options.file_catalogs.enabled:
+        PeriodicCallback(
+            options.file_catalogs.reconcile_all,
+            options.file_catalog.get('reconcile_interval', 3600) * 1000
+        ).start()
+    if options.export_file_cache.max_entries:
+        PeriodicCallback(
+            options.export_file_cache.sweep,
+            options.export_file_cache.max_idle * 1000
+        ).start()
     ioloop.start()
 
 
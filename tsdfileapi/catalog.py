@@ -0,0 +1,464 @@
+
+"""
+Persistent catalogs of file metadata, per tenant directory.
+
+MIME types detected with libmagic are cached in memory, see metacache,
+so each process, after each restart, reads the content of every file
+it lists, or exports, again. A catalog keeps the size, modification
+time, inode, MIME type, and content digest of the files below a tenant
+directory in SQLite, updated when uploads complete, and when files are
+deleted through the API, so metadata is detected once, at write time.
+
+Entries are only used while the inode, size, and mtime of the file
+match, so files changed out-of-band are detected again. A reconciler
+rescans catalogued directories periodically, adding files written
+out-of-band, and removing entries for files which are gone.
+
+The recursive size, and number of files, of each directory are kept
+too, so listings do not have to walk directory trees. They are updated
+with each file entry, and recomputed when reconciling, and only used
+once the catalog has been reconciled by this process.
+
+Catalogs are used from listing, and catalog threads, and opened in the
+catalog executor. Writes are serialised with a lock, on one connection.
+Lookups use a connection per thread, without the lock. Databases are
+kept in the tenant directory, in rollback journal mode, since WAL needs
+shared memory, which network filesystems do not provide, or in a local
+directory, given by path, in WAL mode, so lookups read the last
+committed state while a write, such as a reconcile, is in progress,
+instead of waiting for it.
+
+"""
+
+import logging
+import os
+import stat
+import threading
+import time
+
+from urllib.parse import quote
+
+import etags
+import metrics
+
+from changes import reserved
+from db import sqlite_init, sqlite_session
+
+_RW______ = stat.S_IREAD | stat.S_IWRITE
+_SCHEMA = [
+    """create table if not exists files(
+        path text primary key,
+        size integer not null,
+        mtime_ns integer not null,
+        inode integer not null,
+        mime_type text,
+        digest text,
+        updated real not null)""",
+    """create table if not exists directories(
+        path text primary key,
+        size integer not null,
+        files integer not null)""",
+]
+_JOURNAL_MODES = ('delete', 'truncate', 'persist', 'wal')
+_ADD_TO_DIRECTORIES = """insert into directories values (?, ?, ?)
+    on conflict(path) do update set
+        size = size + excluded.size, files = files + excluded.files"""
+
+
+def _version(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def _ancestors(relative):
+    """Directories containing a relative path, up to the root, which is ''."""
+    parent = os.path.dirname(relative)
+    while parent:
+        yield parent
+        parent = os.path.dirname(parent)
+    yield ''
+
+
+class FileCatalog(object):
+
+    """
+    Metadata of the files below root, by path relative to root,
+    in the database root/name, or, given a local directory as path,
+    in path/name, prefixed with the quoted root.
+
+    The journal mode defaults to rollback, in root, and to WAL in path.
+
+    """
+
+    def __init__(self, root, name='.file-catalog.db', path=None, journal_mode=None):
+        self.root = os.path.normpath(root)
+        if path:
+            self.directory, self.name = path, quote(self.root, safe='') + name
+        else:
+            self.directory, self.name = self.root, name
+        journal_mode = journal_mode or ('wal' if path else 'delete')
+        if journal_mode not in _JOURNAL_MODES:
+            raise ValueError('unsupported journal mode: %s' % journal_mode)
+        self.lock = threading.Lock()
+        self.reconciling = False
+        self.reconciled = False
+        self.readers = threading.local()
+        self.engine = sqlite_init(self.directory, name=self.name, builtin=True, check_same_thread=False)
+        os.chmod(os.path.join(self.directory, self.name), _RW______)
+        with self.lock, sqlite_session(self.engine) as session:
+            session.execute('pragma journal_mode=%s' % journal_mode)
+            for statement in _SCHEMA:
+                session.execute(statement)
+
+    def relative(self, path):
+        """The catalog key of path, or None if it is not catalogued."""
+        relative = os.path.relpath(path, self.root)
+        if relative.startswith('..') or relative == '.' or reserved(relative):
+            return None
+        return relative
+
+    def _reader(self):
+        """The read connection of the calling thread."""
+        engine = getattr(self.readers, 'engine', None)
+        if not engine:
+            engine = sqlite_init(self.directory, name=self.name, builtin=True)
+            self.readers.engine = engine
+        return engine
+
+    def lookup(self, path, st):
+        """
+        Returns
+        -------
+        dict, with mime_type and digest, or None if the file
+        is not catalogued, or has changed since
+
+        """
+        row = self._row(path)
+        if not row:
+            metrics.incr('file_catalog', 'misses')
+            return None
+        if tuple(row[:3]) != _version(st):
+            metrics.incr('file_catalog', 'stale')
+            return None
+        metrics.incr('file_catalog', 'hits')
+        return {'mime_type': row[3], 'digest': row[4]}
+
+    def _row(self, path):
+        relative = self.relative(path)
+        if not relative:
+            return None
+        with sqlite_session(self._reader()) as session:
+            return session.execute(
+                'select size, mtime_ns, inode, mime_type, digest from files where path = ?',
+                (relative,)
+            ).fetchone()
+
+    def update(self, entries):
+        """
+        Insert, or replace entries, given as (path, st, mime_type, digest).
+        Values of None are kept from the entry for the same version
+        of the file, if any.
+
+        """
+        rows = {}
+        for path, st, mime_type, digest in entries:
+            relative = self.relative(path)
+            if relative:
+                rows[relative] = (relative, st.st_size, st.st_mtime_ns, st.st_ino, mime_type, digest, time.time())
+        if not rows:
+            return
+        with self.lock, sqlite_session(self.engine) as session:
+            deltas = {}
+            for relative, row in rows.items():
+                previous = session.execute('select size from files where path = ?', (relative,)).fetchone()
+                size, files = (row[1] - previous[0], 0) if previous else (row[1], 1)
+                for directory in _ancestors(relative):
+                    total = deltas.setdefault(directory, [0, 0])
+                    total[0] += size
+                    total[1] += files
+            session.executemany(
+                """insert into files values (?, ?, ?, ?, ?, ?, ?)
+                   on conflict(path) do update set
+                       mime_type = case when (size, mtime_ns, inode) = (excluded.size, excluded.mtime_ns, excluded.inode)
+                                   then coalesce(excluded.mime_type, mime_type) else excluded.mime_type end,
+                       digest = case when (size, mtime_ns, inode) = (excluded.size, excluded.mtime_ns, excluded.inode)
+                                then coalesce(excluded.digest, digest) else excluded.digest end,
+                       size = excluded.size, mtime_ns = excluded.mtime_ns,
+                       inode = excluded.inode, updated = excluded.updated""",
+                list(rows.values())
+            )
+            session.executemany(_ADD_TO_DIRECTORIES, [(d, size, files) for d, (size, files) in deltas.items()])
+        metrics.incr('file_catalog', 'recorded', len(rows))
+
+    def remove(self, path):
+        """Remove the entry for path, and any entries below it."""
+        relative = self.relative(path)
+        if not relative:
+            return
+        # '0' sorts right after '/', so this is everything below the path
+        below = (relative, relative + '/', relative + '0')
+        with self.lock, sqlite_session(self.engine) as session:
+            size, files = session.execute(
+                'select coalesce(sum(size), 0), count(*) from files where path = ? or (path > ? and path < ?)',
+                below
+            ).fetchone()
+            session.execute('delete from files where path = ? or (path > ? and path < ?)', below)
+            session.execute('delete from directories where path = ? or (path > ? and path < ?)', below)
+            session.executemany(_ADD_TO_DIRECTORIES, [(d, -size, -files) for d in _ancestors(relative)])
+        metrics.incr('file_catalog', 'removed')
+
+    def directory_size(self, path):
+        """
+        Returns
+        -------
+        (int, int), the size, and number of catalogued files in and
+        below the directory, or None if not known
+
+        """
+        relative = '' if os.path.normpath(path) == self.root else self.relative(path)
+        if relative is None or not self.reconciled:
+            return None
+        with sqlite_session(self._reader()) as session:
+            row = session.execute('select size, files from directories where path = ?', (relative,)).fetchone()
+        return tuple(row) if row else (0, 0)
+
+    def _rebuild_directories(self):
+        with self.lock, sqlite_session(self.engine) as session:
+            totals = {}
+            for relative, size in session.execute('select path, size from files'):
+                for directory in _ancestors(relative):
+                    total = totals.setdefault(directory, [0, 0])
+                    total[0] += size
+                    total[1] += 1
+            session.execute('delete from directories')
+            session.executemany(
+                'insert into directories values (?, ?, ?)',
+                [(d, size, files) for d, (size, files) in totals.items()]
+            )
+
+    def record(self, path, detect_mime_type):
+        """
+        Catalog a file, or the files below a directory, detecting MIME
+        types for new versions of files. Blocking.
+
+        """
+        entries = []
+        if os.path.isdir(path):
+            for directory, dirs, files in os.walk(path):
+                dirs[:] = [d for d in dirs if not reserved(d)]
+                entries.extend(os.path.join(directory, name) for name in files)
+        else:
+            entries.append(path)
+        self.update(self._describe(entries, detect_mime_type))
+
+    def _describe(self, paths, detect_mime_type):
+        described = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                if not stat.S_ISREG(st.st_mode) or not self.relative(path):
+                    continue
+                row = self._row(path)
+                mime_type = row[3] if row and tuple(row[:3]) == _version(st) else None
+                if not mime_type:
+                    mime_type = detect_mime_type(path.encode('utf-8'))
+                digest = etags.cached_digest(path, st)
+                if _version(os.stat(path)) != _version(st):
+                    continue # changed meanwhile, left to the next scan
+                described.append((path, st, mime_type, digest))
+            except OSError as e:
+                logging.debug('could not catalog %s: %s', path, e)
+        return described
+
+    def reconcile(self, detect_mime_type):
+        """
+        Rescan the directory, cataloguing new, and changed files,
+        and removing entries for files which are gone. Blocking.
+
+        Returns
+        -------
+        dict, counts of added, updated, and removed entries
+
+        """
+        with self.lock:
+            if self.reconciling:
+                return {}
+            self.reconciling = True
+        try:
+            present = {}
+            for directory, dirs, files in os.walk(self.root):
+                dirs[:] = [d for d in dirs if not reserved(d)]
+                for name in files:
+                    path = os.path.join(directory, name)
+                    relative = self.relative(path)
+                    if not relative:
+                        continue
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    if stat.S_ISREG(st.st_mode):
+                        present[relative] = _version(st)
+            with self.lock, sqlite_session(self.engine) as session:
+                catalogued = {
+                    row[0]: tuple(row[1:])
+                    for row in session.execute('select path, size, mtime_ns, inode from files')
+                }
+            gone = [(relative,) for relative in catalogued if relative not in present]
+            if gone:
+                with self.lock, sqlite_session(self.engine) as session:
+                    session.executemany('delete from files where path = ?', gone)
+            added = [relative for relative in present if relative not in catalogued]
+            updated = [
+                relative for relative in present
+                if relative in catalogued and catalogued[relative] != present[relative]
+            ]
+            changed = [os.path.join(self.root, relative) for relative in added + updated]
+            self.update(self._describe(changed, detect_mime_type))
+            self._rebuild_directories()
+            self.reconciled = True
+            summary = {'added': len(added), 'updated': len(updated), 'removed': len(gone)}
+            for key, value in summary.items():
+                metrics.incr('file_catalog', 'reconciled_%s' % key, value)
+            return summary
+        finally:
+            self.reconciling = False
+
+
+class FileCatalogs(object):
+
+    """
+    Catalogs per tenant directory, opened in the executor when first
+    used, and maintained there. Lookups do not wait for a catalog to be
+    opened, and return None until it is. When disabled, every method is
+    a no-op, and lookups return None. Lookups block on the database,
+    so they are made from threads. See FileCatalog for path, and
+    journal_mode.
+
+    """
+
+    def __init__(self, enabled=False, detect_mime_type=None, executor=None,
+                 name='.file-catalog.db', path=None, journal_mode=None):
+        self.enabled = enabled
+        self.detect_mime_type = detect_mime_type
+        self.executor = executor
+        self.name = name
+        self.path = path
+        self.journal_mode = journal_mode
+        self.lock = threading.Lock()
+        self.catalogs = {}
+        self.opening = set()
+
+    def catalog(self, root):
+        """
+        Open the catalog of root, if not open already. Blocking.
+
+        Returns
+        -------
+        FileCatalog, or None if disabled, or it cannot be opened
+
+        """
+        if not self.enabled:
+            return None
+        root = os.path.normpath(root)
+        with self.lock:
+            catalog = self.catalogs.get(root)
+            if catalog:
+                return catalog
+            try:
+                catalog = FileCatalog(root, self.name, self.path, self.journal_mode)
+            except Exception as e:
+                logging.error('could not open file catalog in %s: %s', root, e)
+                return None
+            finally:
+                self.opening.discard(root)
+            self.catalogs[root] = catalog
+        # files written before the catalog was opened
+        self._submit(catalog.reconcile, self.detect_mime_type)
+        return catalog
+
+    def opened(self, root):
+        """
+        Returns
+        -------
+        FileCatalog, or None if disabled, or not open yet, in which
+        case it is opened in the background
+
+        """
+        if not self.enabled:
+            return None
+        root = os.path.normpath(root)
+        with self.lock:
+            catalog = self.catalogs.get(root)
+            if catalog or root in self.opening:
+                return catalog
+            self.opening.add(root)
+        self._submit(self.catalog, root)
+        return None
+
+    def _in_catalog(self, root, method, *args):
+        catalog = self.catalog(root)
+        if catalog:
+            getattr(catalog, method)(*args)
+
+    def _submit(self, fn, *args):
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def _log_failure(self, future):
+        if future.exception():
+            logging.error('file catalog: %s', future.exception())
+
+    def lookup(self, root, path, st):
+        catalog = self.opened(root)
+        if not catalog:
+            return None
+        try:
+            return catalog.lookup(path, st)
+        except Exception as e:
+            logging.error(e)
+            return None
+
+    def record(self, root, path, digest=None):
+        """
+        Catalog a new file, or directory, in the background. If digest
+        is a Future, resolving to the content digest, it is catalogued
+        once computed.
+
+        """
+        if not self.enabled:
+            return
+        self._submit(self._in_catalog, root, 'record', path, self.detect_mime_type)
+        if digest is not None:
+            digest.add_done_callback(lambda f: self._record_digest(root, path, f))
+
+    def _record_digest(self, root, path, future):
+        if future.exception() or not future.result():
+            return
+        # queued after the record, which catalogs cached digests
+        self._submit(self._in_catalog, root, 'record', path, self.detect_mime_type)
+
+    def remove(self, root, path):
+        if self.enabled:
+            self._submit(self._in_catalog, root, 'remove', path)
+
+    def directory_size(self, root, path):
+        catalog = self.opened(root)
+        if not catalog:
+            return None
+        try:
+            return catalog.directory_size(path)
+        except Exception as e:
+            logging.error(e)
+            return None
+
+    def reconcile(self, root):
+        if self.enabled:
+            self._submit(self._in_catalog, root, 'reconcile', self.detect_mime_type)
+
+    def reconcile_all(self):
+        with self.lock:
+            catalogs = list(self.catalogs.values())
+        for catalog in catalogs:
+            self._submit(catalog.reconcile, self.detect_mime_type)
+        metrics.set_value('file_catalog', 'last_reconciled', time.time())
@@ -0,0 +1,445 @@
+
+"""
+Change feeds for export directories.
+
+Clients which poll export listings to find new files rescan the
+directory, and detect MIME types for every entry, each time. A change
+feed records created, modified, and deleted paths below a directory,
+so that clients only ask for what changed since their last token.
+
+Feeds are fed by inotify watches, where available, and by the API
+itself, when uploads complete, or files are deleted. Events are kept
+in memory, up to max_events per feed; a token older than that, or
+from before a restart, or an inotify queue overflow, is answered with
+reset, and the client should list the directory again.
+
+Files are reported as created when they are closed after writing, so
+that clients do not fetch them half written. Files which are never
+written, e.g. links, are reported when max_events other files have been
+created since, or after an hour, whichever comes first.
+
+Directory trees are walked in a thread pool, but feeds are only used
+from the IOLoop.
+
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import re
+import struct
+import time
+
+from collections import deque, OrderedDict
+from uuid import uuid4
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+import metrics
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+_WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+               IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+_EVENT_HEADER = struct.Struct('iIII')
+_DEDUPLICATE_SECONDS = 2
+_CREATING_SECONDS = 3600
+
+_RESERVED = [
+    re.compile(r'^\.'),
+    re.compile(r'(.+).([a-f\d0-9-]{32,36})$'),
+    re.compile(r'(.+).([a-f\d0-9-]{32,36}).part$'),
+    re.compile(r'^[a-f\d0-9-]{32,36}$'),
+    re.compile(r'(.+).chunk.[0-9]+$'),
+]
+
+
+def reserved(relative_path):
+    """Whether the path is, or is below, an API-owned resource."""
+    for part in relative_path.split('/'):
+        for pattern in _RESERVED:
+            if pattern.match(part):
+                return True
+    return False
+
+
+class Inotify(object):
+
+    """
+    Minimal inotify binding, with ctypes. Raises OSError
+    if inotify is not available.
+
+    """
+
+    def __init__(self):
+        name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(name or 'libc.so.6', use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify not available')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path, mask=_WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: %s' % path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """
+        Returns
+        -------
+        list of (wd, mask, cookie, name)
+
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+
+class Feed(object):
+
+    """
+    Events below one directory, with sequence numbers from the
+    process wide counter of the ChangeFeeds.
+
+    """
+
+    def __init__(self, feeds, root, max_events):
+        self.feeds = feeds
+        self.root = root
+        self.events = deque(maxlen=max_events)
+        self.reset_seq = feeds.seq
+        self.waiters = []
+        self.creating = OrderedDict()
+        self.recent = {}
+        self.watch_count = 0
+
+    def add(self, kind, path):
+        relative = os.path.relpath(path, self.root)
+        if relative.startswith('..') or relative == '.' or reserved(relative):
+            return
+        now = time.time()
+        previous = self.recent.get(relative)
+        if previous and previous[0] == kind and now - previous[1] < _DEDUPLICATE_SECONDS:
+            return
+        self.recent[relative] = (kind, now)
+        if len(self.recent) > self.events.maxlen:
+            self.recent.clear()
+        self.feeds.seq += 1
+        self.events.append((self.feeds.seq, kind, relative, now))
+        metrics.incr('change_feed', kind)
+        self.wake()
+
+    def creating_file(self, path):
+        """
+        A file was created, and is reported as created when it is
+        closed, or when it has been waiting for too long.
+
+        """
+        now = time.time()
+        self.creating[path] = now
+        self.creating.move_to_end(path)
+        while self.creating:
+            oldest, since = next(iter(self.creating.items()))
+            if len(self.creating) <= self.events.maxlen and now - since < _CREATING_SECONDS:
+                break
+            del self.creating[oldest]
+            self.add('created', oldest)
+
+    def reset(self):
+        # tokens issued before the reset, even the latest, are stale
+        self.feeds.seq += 1
+        self.reset_seq = self.feeds.seq
+        metrics.incr('change_feed', 'resets')
+        self.wake()
+
+    def wake(self):
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def wait(self):
+        """
+        Returns
+        -------
+        Future, resolved at the next event
+
+        """
+        waiter = Future()
+        self.waiters.append(waiter)
+        return waiter
+
+    def cancel(self, waiter):
+        """Stop waiting, e.g. after a timeout, or a disconnect."""
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def token(self, seq=None):
+        return '%s-%d' % (self.feeds.epoch, self.feeds.seq if seq is None else seq)
+
+    def since(self, token):
+        """
+        Events after a token.
+
+        Returns
+        -------
+        (list, str, bool), (changes, next token, reset)
+
+        """
+        try:
+            epoch, seq = token.rsplit('-', 1)
+            seq = int(seq)
+            assert epoch == self.feeds.epoch
+        except (ValueError, AssertionError):
+            return [], self.token(), True
+        oldest = self.events[0][0] if self.events else self.feeds.seq + 1
+        if seq < self.reset_seq or (seq < oldest - 1 and len(self.events) == self.events.maxlen):
+            return [], self.token(), True
+        changes = [
+            {'path': path, 'event': kind, 'time': when}
+            for event_seq, kind, path, when in self.events if event_seq > seq
+        ]
+        return changes, self.token(max(seq, self.events[-1][0] if self.events else seq)), False
+
+
+class ChangeFeeds(object):
+
+    """
+    Feeds per directory, created when they are first requested,
+    watching the directory tree with inotify, if enabled, and
+    available, up to max_watches directories per feed.
+
+    """
+
+    def __init__(self, max_events=10000, use_inotify=True, max_watches=8192, executor=None):
+        self.max_events = max_events
+        self.max_watches = max_watches
+        self.executor = executor
+        self.epoch = uuid4().hex[:12]
+        self.seq = 0
+        self.feeds = {}
+        self.watches = {}
+        self.use_inotify = use_inotify
+        self.inotify = None
+        # events for watches which are being added in the executor
+        self.walking = 0
+        self.early_events = deque(maxlen=max_events)
+
+    def _start_inotify(self):
+        self.use_inotify = False
+        try:
+            self.inotify = Inotify()
+            IOLoop.current().add_handler(self.inotify.fd, self._handle_events, IOLoop.READ)
+        except (OSError, AttributeError) as e:
+            logging.warning('change feeds without inotify: %s', e)
+            self.inotify = None
+
+    @gen.coroutine
+    def feed(self, root):
+        """
+        Get the feed for a directory, creating it, and
+        watching the tree below it, if necessary.
+
+        Returns
+        -------
+        Feed
+
+        """
+        root = os.path.normpath(root)
+        feed = self.feeds.get(root)
+        if feed:
+            return feed
+        if self.use_inotify:
+            self._start_inotify()
+        feed = Feed(self, root, self.max_events)
+        self.feeds[root] = feed
+        if self.inotify:
+            directories = yield IOLoop.current().run_in_executor(self.executor, self._directories, root)
+            for directory in directories:
+                self._watch(feed, directory)
+        return feed
+
+    def notify(self, path, kind):
+        """Record an event, for the feed with a root above the path, if any."""
+        path = os.path.normpath(path)
+        for root, feed in self.feeds.items():
+            if path.startswith(root + os.sep):
+                feed.add(kind, path)
+
+    def reset(self, path):
+        """
+        Reset feeds which cover the directory, when files were written
+        below it which are not known one by one, e.g. extracted from an
+        archive, unless inotify reports them.
+
+        """
+        if self.inotify:
+            return
+        path = os.path.normpath(path)
+        for root, feed in self.feeds.items():
+            if path == root or path.startswith(root + os.sep) or root.startswith(path + os.sep):
+                feed.reset()
+
+    def _directories(self, root):
+        directories = []
+        for directory, dirs, files in os.walk(root):
+            dirs[:] = [d for d in dirs if not reserved(d)]
+            directories.append(directory)
+            if len(directories) >= self.max_watches:
+                logging.warning('change feed for %s watches the first %d directories', root, self.max_watches)
+                break
+        return directories
+
+    def _watch(self, feed, directory):
+        if feed.watch_count >= self.max_watches:
+            metrics.incr('change_feed', 'unwatched_directories')
+            return
+        try:
+            wd = self.inotify.add_watch(directory)
+        except OSError as e:
+            logging.error(e)
+            metrics.incr('change_feed', 'unwatched_directories')
+            return
+        self._add_watch(feed, wd, directory)
+
+    def _add_watch(self, feed, wd, directory):
+        if wd not in self.watches:
+            feed.watch_count += 1
+        self.watches[wd] = (feed, directory)
+        metrics.set_value('change_feed', 'watches', len(self.watches))
+
+    def _handle_events(self, fd, events):
+        self._dispatch(self.inotify.read_events())
+
+    def _dispatch(self, events):
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                logging.warning('inotify queue overflow, resetting change feeds')
+                for feed in self.feeds.values():
+                    feed.reset()
+                continue
+            if mask & IN_IGNORED:
+                watch = self.watches.pop(wd, None)
+                if watch:
+                    watch[0].watch_count -= 1
+                continue
+            watch = self.watches.get(wd)
+            if not watch and self.walking:
+                # perhaps from a watch which is not registered yet
+                self.early_events.append((wd, mask, cookie, name))
+                continue
+            if not watch or not name:
+                continue
+            feed, directory = watch
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    feed.add('created', path)
+                    IOLoop.current().spawn_callback(self._watch_new_directory, feed, path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    feed.add('deleted', path)
+                    self._unwatch_moved_directory(path)
+            elif mask & IN_CREATE:
+                if not reserved(os.path.relpath(path, feed.root)):
+                    feed.creating_file(path)
+            elif mask & IN_CLOSE_WRITE:
+                if feed.creating.pop(path, None):
+                    feed.add('created', path)
+                else:
+                    feed.add('modified', path)
+            elif mask & IN_MOVED_TO:
+                feed.add('created', path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                feed.creating.pop(path, None)
+                feed.add('deleted', path)
+
+    def _unwatch_moved_directory(self, path):
+        # watches follow moved directories, so their paths would be wrong
+        for wd, (feed, directory) in list(self.watches.items()):
+            if directory == path or directory.startswith(path + os.sep):
+                self.inotify.rm_watch(wd)
+
+    @gen.coroutine
+    def _watch_new_directory(self, feed, path):
+        # entries created before the watch was added are reported too
+        if reserved(os.path.relpath(path, feed.root)):
+            return
+        self.walking += 1
+        try:
+            watches, entries = yield IOLoop.current().run_in_executor(
+                self.executor, self._walk_new_directory, path, self.max_watches - feed.watch_count
+            )
+        finally:
+            self.walking -= 1
+        for wd, directory in watches:
+            self._add_watch(feed, wd, directory)
+        for entry in entries:
+            feed.add('created', entry)
+        if not self.walking:
+            early, self.early_events = list(self.early_events), deque(maxlen=self.max_events)
+            self._dispatch(early)
+
+    def _walk_new_directory(self, path, max_watches):
+        """
+        Watch a new directory tree, adding each watch before listing
+        the directory, so that no entry is missed.
+
+        Returns
+        -------
+        (list, list), ((wd, directory) for each watch, paths of entries)
+
+        """
+        watches, entries = [], []
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+            if len(watches) >= max_watches:
+                metrics.incr('change_feed', 'unwatched_directories')
+            else:
+                try:
+                    watches.append((self.inotify.add_watch(directory), directory))
+                except OSError as e:
+                    logging.error(e)
+                    metrics.incr('change_feed', 'unwatched_directories')
+            try:
+                with os.scandir(directory) as scanned:
+                    for entry in scanned:
+                        entries.append(entry.path)
+                        if entry.is_dir(follow_symlinks=False) and not reserved(entry.name):
+                            pending.append(entry.path)
+            except OSError as e:
+                logging.error(e)
+        return watches, entries
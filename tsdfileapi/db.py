@@ -25,13 +25,13 @@ from squril import SqliteQueryGenerator, PostgresQueryGenerator
 from utils import check_filename, IllegalFilenameException
 
 
-def sqlite_init(path, name='api-data.db', builtin=False):
+def sqlite_init(path, name='api-data.db', builtin=False, check_same_thread=True):
     dbname = name
     if not builtin:
         dburl = 'sqlite:///' + path + '/' + dbname
         engine = create_engine(dburl, poolclass=QueuePool)
     else:
-        engine = sqlite3.connect(path + '/' + dbname)
+        engine = sqlite3.connect(path + '/' + dbname, check_same_thread=check_same_thread)
     return engine
 
 
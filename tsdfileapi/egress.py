@@ -0,0 +1,213 @@
+
+"""
+Fair sharing of export bandwidth between tenants.
+
+Without it, each export connection is written as fast as the client
+drains it, so one tenant with many parallel connections can saturate
+the node, while interactive downloads from other tenants queue behind.
+
+The export loops ask the scheduler for permission before writing each
+chunk. Tenants which are waiting are served in deficit round robin
+order, weighted per tenant, out of a token bucket for the whole node,
+and each tenant can additionally be capped by its own token bucket.
+Streams of the same tenant are served in turn, since each stream has
+at most one chunk waiting. So that weights also apply to tenants with
+few streams, a tenant whose queue empties keeps the rest of its deficit,
+and a chunk which arrives while the deficit covers it resumes the turn.
+
+The scheduler is only used from the IOLoop, and limits are per process.
+
+"""
+
+import time
+
+from collections import deque, OrderedDict
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+import metrics
+
+
+class TokenBucket(object):
+
+    """
+    Refilled at rate bytes per second, holding at most capacity bytes.
+    A rate of 0 means no limit.
+
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def allows(self, nbytes):
+        # chunks larger than the bucket are let through when it is full,
+        # and the debt is repaid before anything else is sent
+        return not self.rate or self.tokens >= min(nbytes, self.capacity)
+
+    def take(self, nbytes):
+        if self.rate:
+            self.tokens -= nbytes
+
+    def delay(self, nbytes):
+        """Seconds until nbytes are allowed."""
+        if self.allows(nbytes):
+            return 0
+        return (min(nbytes, self.capacity) - self.tokens) / self.rate
+
+
+class _Tenant(object):
+
+    def __init__(self, name, weight, bucket, metric):
+        self.name = name
+        self.metric = metric
+        self.weight = weight
+        self.bucket = bucket
+        self.deficit = 0
+        self.waiting = deque()
+
+
+class EgressScheduler(object):
+
+    """
+    Weighted deficit round robin, over per tenant queues of chunks,
+    limited by a node wide token bucket, and optional per tenant caps.
+
+    Configuration:
+
+        rate: bytes per second for the node, 0 means unlimited
+        burst: seconds of rate which can be sent at once
+        quantum: bytes added to a tenant's deficit per round, per unit weight
+        tenants: per tenant weight, and rate (a cap in bytes per second)
+        default_weight, default_rate: for tenants not listed
+        max_metric_tenants: tenants beyond these, and not listed,
+            share the 'other' metrics, to bound the number of keys
+
+    With no rate, and no caps, chunks are never delayed.
+
+    """
+
+    def __init__(self, rate=0, burst=1, quantum=1024*1024, tenants=None,
+                 default_weight=1, default_rate=0, max_metric_tenants=100):
+        self.rate = rate
+        self.burst = burst
+        self.quantum = quantum
+        self.tenant_config = tenants or {}
+        self.default_weight = default_weight
+        self.default_rate = default_rate
+        self.max_metric_tenants = max_metric_tenants
+        self.metric_tenants = set()
+        self.bucket = TokenBucket(rate, max(rate * burst, quantum))
+        self.tenants = {}
+        self.active = OrderedDict()
+        self.timer = None
+
+    def tenant(self, name):
+        t = self.tenants.get(name)
+        if t is None:
+            config = self.tenant_config.get(name, {})
+            # a weight of 0 would never accumulate a deficit
+            weight = max(config.get('weight', self.default_weight), 0.01)
+            rate = config.get('rate', self.default_rate)
+            if name in self.tenant_config or len(self.metric_tenants) < self.max_metric_tenants:
+                self.metric_tenants.add(name)
+                metric = name
+            else:
+                metric = 'other'
+            t = _Tenant(name, weight, TokenBucket(rate, max(rate * self.burst, self.quantum)), metric)
+            self.tenants[name] = t
+        return t
+
+    def limited(self, name):
+        """Whether chunks sent by the tenant can be delayed."""
+        return bool(self.rate or self.tenant(name).bucket.rate)
+
+    def acquire(self, name, nbytes):
+        """
+        Wait for permission to send nbytes for the tenant.
+
+        Returns
+        -------
+        Future, resolved when the bytes may be sent
+
+        """
+        future = Future()
+        t = self.tenant(name)
+        metrics.incr('egress', '%s_bytes' % t.metric, nbytes)
+        if not self.limited(name):
+            future.set_result(None)
+            return future
+        t.waiting.append((future, nbytes, time.monotonic()))
+        if name not in self.active:
+            self.active[name] = t
+            if t.deficit >= nbytes:
+                self.active.move_to_end(name, last=False)
+        self.dispatch()
+        return future
+
+    def dispatch(self):
+        """
+        Grant chunks, in deficit round robin order, until the node
+        bucket is empty, or every waiting tenant is capped, and then
+        wait until enough tokens have accumulated.
+
+        """
+        if self.timer is not None:
+            IOLoop.current().remove_timeout(self.timer)
+            self.timer = None
+        now = time.monotonic()
+        self.bucket.refill(now)
+        for t in self.active.values():
+            t.bucket.refill(now)
+        delay = None
+        capped = 0
+        while self.active and capped < len(self.active):
+            name, t = next(iter(self.active.items()))
+            future, nbytes, queued = t.waiting[0]
+            if future.done():
+                # the stream stopped waiting, e.g. it was cancelled
+                t.waiting.popleft()
+                if not t.waiting:
+                    t.deficit = 0
+                    del self.active[name]
+                continue
+            if not t.bucket.allows(nbytes):
+                # the tenant keeps its deficit, and waits for its cap
+                delay = min(delay, t.bucket.delay(nbytes)) if delay is not None else t.bucket.delay(nbytes)
+                self.active.move_to_end(name)
+                capped += 1
+                continue
+            if not self.bucket.allows(nbytes):
+                delay = min(delay, self.bucket.delay(nbytes)) if delay is not None else self.bucket.delay(nbytes)
+                break
+            if t.deficit < nbytes:
+                t.deficit += self.quantum * t.weight
+                if t.deficit < nbytes:
+                    self.active.move_to_end(name)
+                    continue
+            t.deficit -= nbytes
+            t.waiting.popleft()
+            self.bucket.take(nbytes)
+            t.bucket.take(nbytes)
+            capped = 0
+            waited = now - queued
+            if waited > 0.001:
+                metrics.incr('egress', '%s_delayed' % t.metric)
+                metrics.incr('egress', '%s_wait_ms' % t.metric, int(waited * 1000))
+            future.set_result(None)
+            if not t.waiting:
+                del self.active[name]
+            elif t.deficit < t.waiting[0][1]:
+                self.active.move_to_end(name)
+        metrics.set_value('egress', 'waiting_streams',
+                          sum(len(t.waiting) for t in self.active.values()))
+        if self.active and delay is not None:
+            self.timer = IOLoop.current().call_later(max(delay, 0.001), self.dispatch)
@@ -0,0 +1,113 @@
+
+"""
+Content digests for strong ETags, cached in extended attributes.
+
+The sha256 of a file is computed once, and stored in an xattr,
+together with the device, inode, size, and mtime of the file when
+it was hashed. The cached value is only used while those match,
+so copies, and modified files are hashed again. If the filesystem,
+or file permissions do not allow xattrs, digests are kept in a
+bounded in-memory cache instead.
+
+"""
+
+import hashlib
+import logging
+import os
+
+from collections import OrderedDict
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import metrics
+
+_XATTR = 'user.tsdfileapi.sha256'
+_FALLBACK_SIZE = 10000
+_FALLBACK = OrderedDict()
+_PENDING = {}
+
+
+def _stat_key(st):
+    return '%d:%d:%d:%d' % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def cached_digest(path, st=None):
+    st = st or os.stat(path)
+    key = _stat_key(st)
+    try:
+        cached_key, digest = os.getxattr(path, _XATTR).decode('utf-8').split(' ')
+        if cached_key == key:
+            return digest
+    except (OSError, ValueError):
+        pass
+    return _FALLBACK.get(key)
+
+
+def compute_digest(path, blocksize=1048576):
+    """
+    Hash the file, and cache the digest. Blocking.
+
+    Returns
+    -------
+    str, or None if the file changed while being hashed
+
+    """
+    before = _stat_key(os.stat(path))
+    _hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            _hash.update(block)
+    key = _stat_key(os.stat(path))
+    if key != before:
+        logging.info('%s changed while computing digest', path)
+        return None
+    digest = _hash.hexdigest()
+    try:
+        os.setxattr(path, _XATTR, ('%s %s' % (key, digest)).encode('utf-8'))
+    except OSError:
+        _FALLBACK[key] = digest
+        while len(_FALLBACK) > _FALLBACK_SIZE:
+            _FALLBACK.popitem(last=False)
+    metrics.incr('etags', 'computed')
+    return digest
+
+
+def schedule_digest(path, executor, st=None):
+    """
+    Start computing the digest in the executor, unless the same
+    version of the file is already being hashed.
+
+    Returns
+    -------
+    Future
+
+    """
+    key = _stat_key(st or os.stat(path))
+    future = _PENDING.get(key)
+    if future is None:
+        future = IOLoop.current().run_in_executor(executor, compute_digest, path)
+        _PENDING[key] = future
+        future.add_done_callback(lambda f: _PENDING.pop(key, None))
+    return future
+
+
+@gen.coroutine
+def content_digest(path, executor, max_sync_size=None):
+    """
+    Get the digest from the cache, or compute it, off the IOLoop.
+    Files larger than max_sync_size are hashed in the background,
+    and None is returned until that is done.
+
+    """
+    st = os.stat(path)
+    digest = cached_digest(path, st)
+    if digest:
+        metrics.incr('etags', 'hits')
+        return digest
+    metrics.incr('etags', 'misses')
+    future = schedule_digest(path, executor, st)
+    if max_sync_size is not None and st.st_size > max_sync_size:
+        return None
+    digest = yield future
+    return digest
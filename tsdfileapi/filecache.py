@@ -0,0 +1,144 @@
+
+"""
+Cache of open files, with validated export metadata.
+
+Parallel download clients request many ranges of the same file,
+and each request would otherwise repeat the existence check, MIME
+type detection, export policy checks, and open the file again. An
+entry is only used while the path still refers to the same version
+of the file: same device, inode, size, and mtime.
+
+Backends can share a directory, but have different export policies,
+so entries are cached per scope (the backend), and an entry which
+passed one backend's checks is never returned for another.
+
+Entries are reference counted, so that a file is never closed while
+a request is reading from it. The cache is only used from the IOLoop.
+
+"""
+
+import os
+import time
+
+from collections import OrderedDict
+
+import metrics
+
+
+def _file_key(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class OpenFile(object):
+
+    def __init__(self, key, path, file, size, mime_type, mtime):
+        self.key = key
+        self.path = path
+        self.file = file
+        self.size = size
+        self.mime_type = mime_type
+        self.mtime = mtime
+        self.content_digest = None
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.evicted = False
+
+
+class OpenFileCache(object):
+
+    """
+    LRU cache of OpenFile entries, capped by count, and idle time.
+    With max_entries=0 nothing is cached, but the same interface
+    can be used: entries are closed when released.
+
+    """
+
+    def __init__(self, max_entries=256, max_idle=30):
+        self.max_entries = max_entries
+        self.max_idle = max_idle
+        self.entries = OrderedDict()
+
+    def acquire(self, path, scope=None):
+        """
+        Get the cached entry for the path, in the given scope,
+        if it is still current. Entries must be released after use.
+
+        Returns
+        -------
+        OpenFile, or None
+
+        """
+        key = (scope, path)
+        entry = self.entries.get(key)
+        if entry is None:
+            metrics.incr('export_file_cache', 'misses')
+            return None
+        try:
+            current = _file_key(os.stat(path))
+        except OSError:
+            current = None
+        if current != entry.key:
+            self._evict(key)
+            metrics.incr('export_file_cache', 'misses')
+            return None
+        self.entries.move_to_end(key)
+        entry.users += 1
+        entry.last_used = time.monotonic()
+        metrics.incr('export_file_cache', 'hits')
+        return entry
+
+    def insert(self, path, size, mime_type, scope=None):
+        """
+        Open a file, which has passed the export checks of the
+        given scope, and cache it. If the file changed since
+        it was checked, it is not cached.
+
+        Returns
+        -------
+        OpenFile, acquired
+
+        """
+        file = open(path, 'rb')
+        st = os.fstat(file.fileno())
+        entry = OpenFile(_file_key(st), path, file, size, mime_type, int(st.st_mtime))
+        entry.users = 1
+        key = (scope, path)
+        self._evict(key)
+        if self.max_entries > 0 and st.st_size == size:
+            self.entries[key] = entry
+            self._shrink()
+        else:
+            entry.evicted = True
+        return entry
+
+    def release(self, entry):
+        entry.users -= 1
+        entry.last_used = time.monotonic()
+        if entry.evicted and entry.users == 0:
+            entry.file.close()
+
+    def sweep(self):
+        """
+        Close entries which have not been used for max_idle seconds.
+
+        """
+        cutoff = time.monotonic() - self.max_idle
+        for key, entry in list(self.entries.items()):
+            if entry.users == 0 and entry.last_used < cutoff:
+                self._evict(key)
+        metrics.set_value('export_file_cache', 'open_files', len(self.entries))
+
+    def _shrink(self):
+        for key in list(self.entries.keys()):
+            if len(self.entries) <= self.max_entries:
+                break
+            self._evict(key)
+
+    def _evict(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        entry.evicted = True
+        metrics.incr('export_file_cache', 'evictions')
+        if entry.users == 0:
+            entry.file.close()
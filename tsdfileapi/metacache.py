@@ -0,0 +1,87 @@
+
+"""
+Cache of file metadata, for listing, HEAD, and export policy checks.
+
+Detecting the MIME type of a file with libmagic reads its content,
+which is slow when listing large directories, and repeated for each
+listing, HEAD, and GET. MIME types are cached per version of a file:
+device, inode, size, and mtime, so any change to the file is a miss.
+
+Export policy verdicts only depend on the policy, the tenant, the file
+name, its size, and its MIME type, so they are cached by those.
+
+The cache is used from the IOLoop, and from archive threads.
+
+"""
+
+import threading
+
+from collections import OrderedDict
+
+import metrics
+
+
+def file_key(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class _LRU(object):
+
+    def __init__(self, max_entries, name):
+        self.max_entries = max_entries
+        self.name = name
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            metrics.incr('file_metadata_cache', '%s_misses' % self.name)
+            return None
+        self.entries.move_to_end(key)
+        metrics.incr('file_metadata_cache', '%s_hits' % self.name)
+        return value
+
+    def put(self, key, value):
+        if not self.max_entries:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            metrics.incr('file_metadata_cache', '%s_evictions' % self.name)
+
+
+class FileMetadataCache(object):
+
+    """
+    Bounded LRU caches of MIME types, and export policy verdicts.
+    With max_entries=0 nothing is cached.
+
+    """
+
+    def __init__(self, max_entries=10000):
+        self.lock = threading.Lock()
+        self.mime_types = _LRU(max_entries, 'mime_type')
+        self.verdicts = _LRU(max_entries, 'verdict')
+
+    def mime_type(self, st):
+        with self.lock:
+            return self.mime_types.get(file_key(st))
+
+    def set_mime_type(self, st, mime_type):
+        with self.lock:
+            self.mime_types.put(file_key(st), mime_type)
+
+    def verdict(self, key):
+        """
+        Returns
+        -------
+        (bool, <str,None>), (is_conformant, message), or None
+
+        """
+        with self.lock:
+            return self.verdicts.get(key)
+
+    def set_verdict(self, key, verdict):
+        with self.lock:
+            self.verdicts.put(key, verdict)
@@ -0,0 +1,24 @@
+
+"""Process-wide counters, reported by the admin metrics endpoint."""
+
+import threading
+
+
+_LOCK = threading.Lock()
+_COUNTERS = {}
+
+
+def incr(group, name, value=1):
+    with _LOCK:
+        counters = _COUNTERS.setdefault(group, {})
+        counters[name] = counters.get(name, 0) + value
+
+
+def set_value(group, name, value):
+    with _LOCK:
+        _COUNTERS.setdefault(group, {})[name] = value
+
+
+def snapshot():
+    with _LOCK:
+        return {group: dict(counters) for group, counters in _COUNTERS.items()}
@@ -0,0 +1,121 @@
+
+"""
+Page cache hints for bulk transfers.
+
+Large uploads and exports pass through the page cache, and would
+otherwise evict the hot working set of the service: SQLite databases
+for tables and resumables, and small files which are read often.
+
+Exports are advised as sequential, and read ahead a window at a time.
+Uploads drop the pages they have written, once the upload is larger
+than a threshold. Dirty pages cannot be dropped, so dropping lags one
+window behind the write position, giving the kernel time to write
+them back, and the rest is flushed to disk, and dropped, at the end.
+
+Hints are ignored where posix_fadvise is not available.
+
+"""
+
+import logging
+import os
+
+import metrics
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    Give the kernel a hint about how a range of a file will be used.
+    A length of 0 means until the end of the file.
+
+    Returns
+    -------
+    bool, whether the hint was given
+
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    try:
+        os.posix_fadvise(fd.fileno(), offset, length, getattr(os, 'POSIX_FADV_%s' % advice.upper()))
+    except (OSError, ValueError, AttributeError) as e:
+        logging.debug('could not fadvise %s: %s', advice, e)
+        return False
+    metrics.incr('page_cache', advice)
+    if length:
+        metrics.incr('page_cache', '%s_bytes' % advice, length)
+    return True
+
+
+class ExportAdvice(object):
+
+    """
+    Read-ahead for an export of a range of a file, if the file is
+    at least min_size bytes. Used from export threads, one per request.
+
+    """
+
+    def __init__(self, config, fd, size):
+        self.enabled = config.get('enabled', False) and size >= config.get('export_min_size', 16*1024*1024)
+        self.window = config.get('export_readahead', 8*1024*1024)
+        self.fd = fd
+        self.advised_to = 0
+        if self.enabled:
+            fadvise(fd, 0, 0, 'sequential')
+
+    def reading(self, position, end):
+        """Called before reading from position, ahead of the advised window."""
+        if not self.enabled or position + self.window // 2 < self.advised_to:
+            return
+        start = max(position, self.advised_to)
+        length = min(position + self.window, end) - start
+        if length > 0:
+            fadvise(self.fd, start, length, 'willneed')
+            self.advised_to = start + length
+
+
+class UploadAdvice(object):
+
+    """
+    Drop pages of a file being uploaded, a window at a time, once
+    more than min_size bytes have been written to it.
+
+    """
+
+    def __init__(self, config, fd):
+        self.enabled = config.get('enabled', False)
+        self.min_size = config.get('upload_min_size', 64*1024*1024)
+        self.window = config.get('upload_window', 16*1024*1024)
+        self.fd = fd
+        self.start = fd.tell() if self.enabled else 0
+        self.written = 0
+        self.dropped_to = self.start
+
+    def wrote(self, nbytes):
+        if not self.enabled:
+            return
+        self.written += nbytes
+        if self.written < self.min_size:
+            return
+        position = self.start + self.written
+        # dirty pages are skipped by the kernel, so leave the last window
+        if position - self.dropped_to >= 2 * self.window:
+            self.fd.flush()
+            end = position - self.window
+            fadvise(self.fd, self.dropped_to, end - self.dropped_to, 'dontneed')
+            self.dropped_to = end
+
+    @property
+    def pending(self):
+        """Whether flushed has anything to do."""
+        return self.enabled and self.written >= self.min_size
+
+    def flushed(self):
+        """
+        Called when all data has been written, before closing the file.
+        The rest of the file is flushed to disk, so that it can be dropped.
+        This waits for the disk, so callers run it in a thread pool.
+
+        """
+        if self.pending:
+            self.fd.flush()
+            os.fdatasync(self.fd.fileno())
+            fadvise(self.fd, self.dropped_to, 0, 'dontneed')
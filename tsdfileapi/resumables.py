@@ -1,4 +1,6 @@
 
+import datetime
+import fcntl
 import re
 import logging
 import os
@@ -7,18 +9,33 @@ import uuid
 import stat
 import sqlite3
 import hashlib
+import threading
+import time
 
 from abc import ABC, abstractmethod
 from contextlib import contextmanager
 
+import tornado.queues
+
+from tornado import gen
+from tornado.ioloop import IOLoop
 from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
 from sqlalchemy.exc import OperationalError, IntegrityError, StatementError
 
+import metrics
+
+
+class ResumableNotFound(Exception):
+    pass
+
 
 _IS_VALID_UUID = re.compile(r'([a-f\d0-9-]{32,36})')
+_IS_MERGED_FILE = re.compile(r'(.+)\.([a-f\d0-9-]{32,36})(\.lock)?$')
+_IS_RESUMABLE_DB = re.compile(r'^\.resumables-(.+)\.db$')
 _RW______ = stat.S_IREAD | stat.S_IWRITE
+_MERGE_LOCKS = [ threading.Lock() for _ in range(64) ]
 
 
 def _atoi(text):
@@ -76,6 +93,64 @@ def md5sum(filename, blocksize=65536):
     return _hash.hexdigest()
 
 
+def _copy_and_hash(fin, fout, blocksize=1048576):
+    _hash = hashlib.sha256()
+    for block in iter(lambda: fin.read(blocksize), b''):
+        _hash.update(block)
+        fout.write(block)
+    return _hash.hexdigest()
+
+
+def _merge_lock_path(work_dir, upload_id):
+    return os.path.normpath(work_dir + '/.' + upload_id + '.merge.lock')
+
+
+@contextmanager
+def _merge_lock(work_dir, upload_id):
+    """
+    Serialise merges of an upload, between threads, with one of
+    a fixed set of locks, and between processes, with a POSIX lock
+    on a hidden file next to the merged file, which works over NFS.
+
+    """
+    with _MERGE_LOCKS[hash(upload_id) % len(_MERGE_LOCKS)]:
+        fd = os.open(_merge_lock_path(work_dir, upload_id), os.O_WRONLY | os.O_CREAT, _RW______)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd) # releases the lock
+
+
+def merkle_levels(digests):
+    """
+    Build a binary Merkle tree over hex sha256 chunk digests.
+
+    Interior nodes are the sha256 of the concatenated (raw) digests
+    of their children, and a node without a sibling is promoted to
+    the next level unchanged.
+
+    Returns
+    -------
+    list, of levels, from the leaves to the root
+
+    """
+    if not digests:
+        return []
+    levels = [list(digests)]
+    while len(levels[-1]) > 1:
+        current = levels[-1]
+        parents = []
+        for i in range(0, len(current), 2):
+            if i + 1 < len(current):
+                pair = bytes.fromhex(current[i]) + bytes.fromhex(current[i + 1])
+                parents.append(hashlib.sha256(pair).hexdigest())
+            else:
+                parents.append(current[i])
+        levels.append(parents)
+    return levels
+
+
 class AbstractResumable(ABC):
 
     def __init__(self, work_dir=None, owner=None):
@@ -141,8 +216,20 @@ class SerialResumable(AbstractResumable):
 
             list_all
             info
+            merkle_tree
             delete
 
+        c) for merging chunks in the background:
+
+            record_received_chunk
+            merge_received_chunk
+            merge_pending
+
+        d) for maintenance:
+
+            expire
+            repair_all
+
     """
 
     def __init__(self, work_dir=None, owner=None):
@@ -185,9 +272,16 @@ class SerialResumable(AbstractResumable):
         upload_id = str(uuid.uuid4()) if url_upload_id == 'None' else url_upload_id
         chunk_filename = in_filename + '.chunk.' + url_chunk_num
         filename = upload_id + '/' + chunk_filename
+        if url_upload_id != 'None' and (not _IS_VALID_UUID.fullmatch(upload_id)
+                                        or (chunk_num != 1 and not self._upload_exists(upload_id))):
+            logging.error('unknown upload id: %s', upload_id)
+            return chunk_num, upload_id, None, False, filename
         if chunk_num == 'end':
             completed_resumable_file = True
             chunk_order_correct = True
+        elif url_upload_id != 'None' and self._db_get_merge_failure(upload_id) is not None:
+            chunk_order_correct = self._resume_failed_merge(work_dir, upload_id, chunk_num)
+            completed_resumable_file = None
         elif chunk_num == 1:
             os.makedirs(work_dir + '/' + upload_id)
             assert self._db_insert_new_for_owner(upload_id, url_group)
@@ -198,6 +292,48 @@ class SerialResumable(AbstractResumable):
             completed_resumable_file = None
         return chunk_num, upload_id, completed_resumable_file, chunk_order_correct, filename
 
+    def prepare_offset(self, work_dir, in_filename, upload_offset, url_upload_id, url_group, owner):
+        """
+        Offset-based alternative to prepare, where chunks can have
+        any size, and the server assigns chunk numbers.
+
+        Clients send the number of bytes which they think the server
+        has stored, and the chunk is only accepted if that matches.
+        New uploads are started with an offset of 0, and no upload id.
+
+        Returns
+        -------
+        tuple, the same as prepare, with the current offset appended
+
+        """
+        if url_upload_id == 'None':
+            if upload_offset != 0:
+                logging.error('new uploads must start at offset 0')
+                return None, url_upload_id, None, False, None, 0
+            return self.prepare(work_dir, in_filename, '1', url_upload_id, url_group, owner) + (0,)
+        if not self._upload_exists(url_upload_id):
+            logging.error('unknown upload id: %s', url_upload_id)
+            return None, url_upload_id, None, False, None, 0
+        current_offset, last_chunk_num = self._db_get_upload_state(url_upload_id)
+        if upload_offset != current_offset:
+            logging.error('upload offset %d does not match stored offset %d', upload_offset, current_offset)
+            return None, url_upload_id, None, False, None, current_offset
+        chunk_num = last_chunk_num + 1
+        if self._db_get_merge_failure(url_upload_id) is not None:
+            self._resume_failed_merge(work_dir, url_upload_id, chunk_num)
+        filename = url_upload_id + '/' + in_filename + '.chunk.' + str(chunk_num)
+        return chunk_num, url_upload_id, None, True, filename, current_offset
+
+    def upload_offset(self, upload_id):
+        """
+        Number of bytes stored for the upload, merged or not.
+
+        """
+        if not self._upload_exists(upload_id):
+            raise ResumableNotFound(upload_id)
+        offset, _ = self._db_get_upload_state(upload_id)
+        return offset
+
     def open_file(self, filename, mode):
         fd = open(filename, mode)
         os.chmod(filename, _RW______)
@@ -209,7 +345,10 @@ class SerialResumable(AbstractResumable):
         else:
             fd.write(chunk)
 
-    def close_file(self, fd):
+    def close_file(self, fd, sync=False):
+        if sync:
+            fd.flush()
+            os.fsync(fd.fileno())
         fd.close()
 
     def _refuse_upload_if_not_in_sequential_order(self, work_dir, upload_id, chunk_num):
@@ -279,7 +418,8 @@ class SerialResumable(AbstractResumable):
                     chunk_size, max_chunk, md5sum, \
                         previous_offset, next_offset, \
                         warning, recommendation, \
-                        filename = self._get_resumable_chunk_info(current_pr, work_dir)
+                        filename, received_offset, \
+                        merged_offset = self._get_resumable_chunk_info(current_pr, work_dir)
                     if recommendation == 'end':
                         next_offset = 'end'
                 except (OSError, Exception):
@@ -289,7 +429,9 @@ class SerialResumable(AbstractResumable):
                     info.append({'chunk_size': chunk_size, 'max_chunk': max_chunk,
                                  'md5sum': md5sum, 'previous_offset': previous_offset,
                                  'next_offset': next_offset, 'id': pr,
-                                 'filename': filename, 'group': group})
+                                 'filename': filename, 'group': group,
+                                 'received_offset': received_offset,
+                                 'merged_offset': merged_offset})
         return {'resumables': info}
 
     def _repair_inconsistent_resumable(self, merged_file, chunks, merged_file_size,
@@ -344,18 +486,34 @@ class SerialResumable(AbstractResumable):
         we try to fix it by successively dropping the last
         chunk and truncating the merged file.
 
+        When chunks are merged in the background, the chunks
+        which have been received, but not yet merged, are
+        reported as part of the upload, since they are already
+        stored durably. The merged file is expected to lag
+        behind in that case, so no repair is attempted.
+
         Returns
         -------
-        tuple, (size, chunknum, md5sum, previous_offset, next_offset)
+        tuple, (size, chunknum, md5sum, previous_offset, next_offset,
+                warning, recommendation, filename,
+                received_offset, merged_offset)
 
         """
         def info(chunks, recommendation=None, warning=None):
             num = int(chunks[-1].split('.')[-1])
             latest_size = bytes(chunks[-1])
             upload_id = os.path.basename(resumable_dir)
-            next_offset = self._db_get_total_size(upload_id)
-            previous_offset = next_offset - latest_size
+            merged_offset = self._db_get_total_size(upload_id) or 0
+            pending_size = self._db_get_pending_size(upload_id)
             filename = os.path.basename(chunks[-1].split('.chunk')[0])
+            if pending_size:
+                next_offset = merged_offset + pending_size
+                previous_offset = next_offset - latest_size
+                return latest_size, num, md5sum(chunks[-1]), \
+                       previous_offset, next_offset, recommendation, \
+                       warning, filename, next_offset, merged_offset
+            next_offset = merged_offset
+            previous_offset = next_offset - latest_size
             merged_file = os.path.normpath(work_dir + '/' + filename + '.' + upload_id)
             try:
                 # check that the size of the merge file
@@ -371,10 +529,10 @@ class SerialResumable(AbstractResumable):
                     return info(chunks)
                 except Exception as e:
                     logging.error(e)
-                    return None, None, None, None, None, None, None, None
+                    return None, None, None, None, None, None, None, None, None, None
             return latest_size, num, md5sum(chunks[-1]), \
                    previous_offset, next_offset, recommendation, \
-                   warning, filename
+                   warning, filename, next_offset, merged_offset
         def bytes(chunk):
             size = os.stat(chunk).st_size
             return size
@@ -382,6 +540,11 @@ class SerialResumable(AbstractResumable):
         all_chunks = [ '%s/%s' % (resumable_dir, i) for i in os.listdir(resumable_dir) ]
         all_chunks.sort(key=_natural_keys)
         chunks = [ c for c in all_chunks if '.part' not in c ]
+        upload_id = os.path.basename(resumable_dir)
+        if self._db_get_merge_failure(upload_id) is not None:
+            # chunks after a failed merge are sent again when the client resumes
+            last_merged = self._db_get_last_merged_chunk_num(upload_id)
+            chunks = [ c for c in chunks if int(c.split('.chunk.')[-1]) <= last_merged ]
         return info(chunks)
 
     def info(self, work_dir, filename, upload_id, owner):
@@ -391,7 +554,8 @@ class SerialResumable(AbstractResumable):
         resumable_dir = '%s/%s' % (work_dir, relevant_dir)
         chunk_size, max_chunk, md5sum, \
             previous_offset, next_offset, \
-            warning, recommendation, filename = self._get_resumable_chunk_info(resumable_dir, work_dir)
+            warning, recommendation, filename, \
+            received_offset, merged_offset = self._get_resumable_chunk_info(resumable_dir, work_dir)
         group = self._db_get_group(upload_id)
         if recommendation == 'end':
             next_offset = 'end'
@@ -399,7 +563,9 @@ class SerialResumable(AbstractResumable):
                 'chunk_size': chunk_size, 'max_chunk': max_chunk,
                 'md5sum': md5sum, 'previous_offset': previous_offset,
                 'next_offset': next_offset, 'warning': warning,
-                'filename': filename, 'group': group}
+                'filename': filename, 'group': group,
+                'received_offset': received_offset,
+                'merged_offset': merged_offset}
         return info
 
     def _get_full_chunks_on_disk(self, work_dir, upload_id, chunk_num):
@@ -415,6 +581,7 @@ class SerialResumable(AbstractResumable):
             relevant_merged_file = work_dir + '/' + filename + '.' + upload_id
             shutil.rmtree(relevant_dir)
             os.remove(relevant_merged_file)
+            _remove_paths([_merge_lock_path(work_dir, upload_id)])
             assert self._db_remove_completed_for_owner(upload_id)
             return True
         except Exception as e:
@@ -433,6 +600,7 @@ class SerialResumable(AbstractResumable):
             os.rename(out, final)
             try:
                 shutil.rmtree(chunks_dir) # do not need to fail upload if this does not work
+                os.remove(_merge_lock_path(work_dir, upload_id))
             except OSError as e:
                 logging.error(e)
             assert self._db_remove_completed_for_owner(upload_id)
@@ -485,9 +653,9 @@ class SerialResumable(AbstractResumable):
             with open(out, 'ab') as fout:
                 with open(chunk, 'rb') as fin:
                     size_before_merge = os.stat(out).st_size
-                    shutil.copyfileobj(fin, fout)
+                    digest = _copy_and_hash(fin, fout)
             chunk_size = os.stat(chunk).st_size
-            assert self._db_update_with_chunk_info(upload_id, chunk_num, chunk_size)
+            assert self._db_update_with_chunk_info(upload_id, chunk_num, chunk_size, digest)
         except Exception as e:
             logging.error(e)
             try:
@@ -507,29 +675,380 @@ class SerialResumable(AbstractResumable):
             os.remove(old_chunk)
         return final
 
+    def merkle_tree(self, upload_id):
+        """
+        Merkle tree over the sha256 digests of merged chunks, recorded
+        while merging, so clients can verify the upload, or find the
+        first chunk which differs, without re-reading the whole file.
+
+        The root is None if any chunk was merged without a digest.
+
+        Returns
+        -------
+        dict
+
+        """
+        if not self._upload_exists(upload_id):
+            raise ResumableNotFound(upload_id)
+        chunks = self._db_get_chunk_digests(upload_id)
+        digests = [ digest for chunk_num, chunk_size, digest in chunks ]
+        if None in digests:
+            levels = []
+        else:
+            levels = merkle_levels(digests)
+        return {'id': upload_id, 'algorithm': 'sha256',
+                'root': levels[-1][0] if levels else None,
+                'chunks': [ {'chunk_num': chunk_num, 'chunk_size': chunk_size, 'digest': digest}
+                            for chunk_num, chunk_size, digest in chunks ],
+                'levels': levels}
+
+    def record_received_chunk(self, upload_id, chunk_num, chunk_size):
+        """
+        Record that a chunk has been stored durably, before it is merged.
+
+        """
+        return self._db_insert_received_chunk(upload_id, chunk_num, chunk_size)
+
+    def record_content_type(self, upload_id, content_type):
+        """
+        Record the custom content type sent with the first chunk,
+        which decides how the upload is decoded when it ends.
+
+        """
+        return self._db_insert_content_type(upload_id, content_type)
+
+    def content_type(self, upload_id, default=None):
+        """
+        Custom content type recorded for the upload, None if it has none,
+        or default for uploads started before content types were recorded.
+
+        """
+        return self._db_get_content_type(upload_id, default)
+
+    def merge_received_chunk(self, work_dir, chunk_filename, upload_id, owner):
+        """
+        Merge a chunk which has already been received, and acknowledged.
+
+        Chunks must be merged in order, so if a chunk cannot be merged,
+        the failure is recorded, and later chunks are kept, but not merged.
+        The upload then reports the merged offset, so clients can resume
+        from there, sending the remaining chunks again.
+
+        Merges hold the upload's merge lock, since chunks of one upload
+        can be received by different processes. Blocking.
+
+        Returns
+        -------
+        bool
+
+        """
+        with _merge_lock(work_dir, upload_id):
+            return self._merge_received_chunk(work_dir, chunk_filename, upload_id, owner)
+
+    def _merge_received_chunk(self, work_dir, chunk_filename, upload_id, owner):
+        chunk_num = int(chunk_filename.split('.chunk.')[-1])
+        if self._db_get_merge_failure(upload_id) is not None:
+            logging.error('not merging chunk %d, since an earlier merge failed', chunk_num)
+            return False
+        last_merged = self._db_get_last_merged_chunk_num(upload_id)
+        if chunk_num <= last_merged:
+            return True # merged by another process meanwhile
+        if chunk_num != last_merged + 1:
+            logging.error('cannot merge chunk %d after chunk %d', chunk_num, last_merged)
+            self._db_insert_merge_failure(upload_id, chunk_num)
+            return False
+        try:
+            self.merge_chunk(work_dir, chunk_filename, upload_id, owner)
+        except Exception as e:
+            logging.error(e)
+        if self._db_get_last_merged_chunk_num(upload_id) != chunk_num:
+            self._db_insert_merge_failure(upload_id, chunk_num)
+            return False
+        return True
+
+    def merge_pending(self, work_dir, filename, upload_id, owner):
+        """
+        Merge chunks which were received but never merged,
+        e.g. if the server restarted while merges were queued.
+        Holds the upload's merge lock, so merges running in other
+        processes are waited for. Blocking.
+
+        Returns
+        -------
+        bool, True if all received chunks are merged
+
+        """
+        with _merge_lock(work_dir, upload_id):
+            if self._db_get_merge_failure(upload_id) is not None:
+                return False
+            for chunk_num in self._db_get_pending_chunk_nums(upload_id):
+                chunk_filename = '%s.chunk.%d' % (filename, chunk_num)
+                if not self._merge_received_chunk(work_dir, chunk_filename, upload_id, owner):
+                    return False
+        return True
+
+    def merged_state(self, upload_id):
+        """
+        Number of bytes, and chunks, merged for the upload.
+
+        Returns
+        -------
+        tuple, (merged_offset, last_merged_chunk_num)
+
+        """
+        return self._db_get_total_size(upload_id) or 0, self._db_get_last_merged_chunk_num(upload_id)
+
+    def expire(self, work_dir, max_age, merged_files=None):
+        """
+        Delete resumables which have not been active for max_age seconds,
+        removing chunks, partially merged files and db entries, and
+        then compact the db.
+
+        Returns
+        -------
+        tuple, (num_expired, bytes_reclaimed)
+
+        """
+        if merged_files is None:
+            merged_files = _find_merged_files(work_dir)
+        now = time.time()
+        expired, reclaimed = 0, 0
+        for item in self._db_get_all_resumable_ids_for_owner(strict=True):
+            upload_id = item[0]
+            if not _IS_VALID_UUID.match(upload_id):
+                continue
+            paths = [os.path.normpath(work_dir + '/' + upload_id)] + merged_files.get(upload_id, [])
+            last_active = _last_modified(paths)
+            if last_active and (now - last_active) < max_age:
+                continue
+            logging.info('expiring resumable: %s', upload_id)
+            paths.append(_merge_lock_path(work_dir, upload_id))
+            reclaimed += _remove_paths(paths)
+            try:
+                self._db_remove_completed_for_owner(upload_id)
+            except OperationalError as e:
+                logging.error(e)
+            expired += 1
+        if expired:
+            self._db_compact()
+        return expired, reclaimed
+
+    def repair_all(self, work_dir, min_idle=300):
+        """
+        Check the consistency of all resumables which have been idle for
+        at least min_idle seconds, repairing merged files where possible.
+
+        Returns
+        -------
+        int, number of resumables checked
+
+        """
+        now = time.time()
+        checked = 0
+        for item in self._db_get_all_resumable_ids_for_owner(strict=True):
+            upload_id = item[0]
+            resumable_dir = os.path.normpath(work_dir + '/' + upload_id)
+            if not _IS_VALID_UUID.match(upload_id) or not os.path.lexists(resumable_dir):
+                continue
+            last_active = _last_modified([resumable_dir])
+            if last_active and (now - last_active) < min_idle:
+                continue
+            try:
+                self._get_resumable_chunk_info(resumable_dir, work_dir)
+                checked += 1
+            except Exception as e:
+                logging.error(e)
+                logging.error('could not check resumable: %s', upload_id)
+        return checked
+
+    def _upload_exists(self, upload_id):
+        # checked before the id is used in table names
+        if not _IS_VALID_UUID.fullmatch(str(upload_id)):
+            return False
+        try:
+            return self._db_upload_belongs_to_owner(upload_id)
+        except OperationalError:
+            return False # no uploads yet
+
+    def _resume_failed_merge(self, work_dir, upload_id, chunk_num):
+        """
+        Accept the chunk after the last merged one, once a merge
+        has failed, removing chunks received after the failure.
+
+        """
+        last_merged = self._db_get_last_merged_chunk_num(upload_id)
+        if chunk_num != last_merged + 1:
+            logging.error('resume upload %s from chunk %d, after a failed merge', upload_id, last_merged + 1)
+            return False
+        chunks_dir = work_dir + '/' + upload_id
+        for chunk in os.listdir(chunks_dir):
+            if '.part' in chunk or int(chunk.split('.chunk.')[-1]) <= last_merged:
+                continue
+            try:
+                os.remove(chunks_dir + '/' + chunk)
+            except OSError:
+                pass
+        self._db_clear_merge_failure(upload_id, last_merged)
+        return True
+
     def _db_insert_new_for_owner(self, resumable_id, group):
         resumable_table = 'resumable_%s' % resumable_id
+        received_table = 'received_%s' % resumable_id
         with session_scope(self.engine) as session:
             session.execute('create table if not exists resumable_uploads(id text, upload_group text)')
             session.execute('insert into resumable_uploads (id, upload_group) values (:resumable_id, :upload_group)',
                             {'resumable_id': resumable_id, 'upload_group': group})
             session.execute('create table "%s"(chunk_num int, chunk_size int)' % resumable_table) # want an exception if exists
+            session.execute('create table if not exists "%s"(chunk_num int, chunk_size int)' % received_table)
         return True
 
-    def _db_update_with_chunk_info(self, resumable_id, chunk_num, chunk_size):
+    def _db_insert_received_chunk(self, resumable_id, chunk_num, chunk_size):
+        received_table = 'received_%s' % resumable_id
+        with session_scope(self.engine) as session:
+            session.execute('create table if not exists "%s"(chunk_num int, chunk_size int)' % received_table)
+            session.execute('insert into "%s"(chunk_num, chunk_size) values (:chunk_num, :chunk_size)' % received_table,
+                            {'chunk_num': chunk_num, 'chunk_size': chunk_size})
+        return True
+
+    def _db_insert_content_type(self, resumable_id, content_type):
+        with session_scope(self.engine) as session:
+            session.execute('create table if not exists resumable_content_types(id text, content_type text)')
+            session.execute('delete from resumable_content_types where id = :resumable_id',
+                            {'resumable_id': resumable_id})
+            session.execute('insert into resumable_content_types (id, content_type) values (:resumable_id, :content_type)',
+                            {'resumable_id': resumable_id, 'content_type': content_type})
+        return True
+
+    def _db_get_content_type(self, resumable_id, default=None):
+        try:
+            with session_scope(self.engine) as session:
+                res = session.execute('select content_type from resumable_content_types where id = :resumable_id',
+                                      {'resumable_id': resumable_id}).fetchone()
+        except OperationalError:
+            return default
+        return res[0] if res else default
+
+    def _db_insert_merge_failure(self, resumable_id, chunk_num):
+        failed_table = 'failed_%s' % resumable_id
+        with session_scope(self.engine) as session:
+            session.execute('create table if not exists "%s"(chunk_num int)' % failed_table)
+            session.execute('insert into "%s"(chunk_num) values (:chunk_num)' % failed_table,
+                            {'chunk_num': chunk_num})
+        return True
+
+    def _db_get_merge_failure(self, resumable_id):
+        failed_table = 'failed_%s' % resumable_id
+        try:
+            with session_scope(self.engine) as session:
+                res = session.execute('select min(chunk_num) from "%s"' % failed_table).fetchone()[0]
+        except OperationalError:
+            return None # no merge has failed
+        return res
+
+    def _db_clear_merge_failure(self, resumable_id, last_merged):
+        received_table = 'received_%s' % resumable_id
+        failed_table = 'failed_%s' % resumable_id
+        with session_scope(self.engine) as session:
+            session.execute('delete from "%s" where chunk_num > :chunk_num' % received_table,
+                            {'chunk_num': last_merged})
+            session.execute('drop table if exists "%s"' % failed_table)
+        return True
+
+    def _db_get_last_merged_chunk_num(self, resumable_id):
+        resumable_table = 'resumable_%s' % resumable_id
+        with session_scope(self.engine) as session:
+            res = session.execute('select max(chunk_num) from "%s"' % resumable_table).fetchone()[0]
+        return res if res else 0
+
+    def _db_get_pending_chunk_nums(self, resumable_id):
+        resumable_table = 'resumable_%s' % resumable_id
+        received_table = 'received_%s' % resumable_id
+        try:
+            with session_scope(self.engine) as session:
+                res = session.execute('''select chunk_num from "%s"
+                    where chunk_num > (select coalesce(max(chunk_num), 0) from "%s")
+                    order by chunk_num''' % (received_table, resumable_table)).fetchall()
+        except OperationalError:
+            return []
+        return [ row[0] for row in res ]
+
+    def _db_get_upload_state(self, resumable_id):
+        resumable_table = 'resumable_%s' % resumable_id
+        received_table = 'received_%s' % resumable_id
+        merged_size = '(select coalesce(sum(chunk_size), 0) from "%s")' % resumable_table
+        last_merged = '(select coalesce(max(chunk_num), 0) from "%s")' % resumable_table
+        if self._db_get_merge_failure(resumable_id) is not None:
+            # clients resume from the merged offset
+            with session_scope(self.engine) as session:
+                res = session.execute('select %s, %s' % (merged_size, last_merged)).fetchone()
+            return res[0], res[1]
+        try:
+            with session_scope(self.engine) as session:
+                res = session.execute('''select
+                    %s + (select coalesce(sum(chunk_size), 0) from "%s" where chunk_num > %s),
+                    max(%s, (select coalesce(max(chunk_num), 0) from "%s"))''' %
+                    (merged_size, received_table, last_merged, last_merged, received_table)).fetchone()
+        except OperationalError:
+            # uploads started before background merging existed
+            with session_scope(self.engine) as session:
+                res = session.execute('select %s, %s' % (merged_size, last_merged)).fetchone()
+        return res[0], res[1]
+
+    def _db_get_pending_size(self, resumable_id):
         resumable_table = 'resumable_%s' % resumable_id
+        received_table = 'received_%s' % resumable_id
+        if self._db_get_merge_failure(resumable_id) is not None:
+            return 0
+        try:
+            with session_scope(self.engine) as session:
+                res = session.execute('''select sum(chunk_size) from "%s"
+                    where chunk_num > (select coalesce(max(chunk_num), 0) from "%s")''' %
+                    (received_table, resumable_table)).fetchone()[0]
+        except OperationalError:
+            return 0
+        return res if res else 0
+
+    def _db_update_with_chunk_info(self, resumable_id, chunk_num, chunk_size, digest=None):
+        resumable_table = 'resumable_%s' % resumable_id
+        digests_table = 'digests_%s' % resumable_id
         with session_scope(self.engine) as session:
             session.execute('insert into "%s"(chunk_num, chunk_size) values (:chunk_num, :chunk_size)' % resumable_table,
                             {'chunk_num': chunk_num, 'chunk_size': chunk_size})
+            if digest:
+                session.execute('create table if not exists "%s"(chunk_num int, digest text)' % digests_table)
+                session.execute('insert into "%s"(chunk_num, digest) values (:chunk_num, :digest)' % digests_table,
+                                {'chunk_num': chunk_num, 'digest': digest})
         return True
 
     def _db_pop_chunk(self, resumable_id, chunk_num):
         resumable_table = 'resumable_%s' % resumable_id
+        digests_table = 'digests_%s' % resumable_id
         with session_scope(self.engine) as session:
             res = session.execute('delete from "%s" where chunk_num = :chunk_num' % resumable_table,
                                   {'chunk_num': chunk_num})
+        try:
+            with session_scope(self.engine) as session:
+                session.execute('delete from "%s" where chunk_num = :chunk_num' % digests_table,
+                                {'chunk_num': chunk_num})
+        except OperationalError:
+            pass # no digests recorded
         return True
 
+    def _db_get_chunk_digests(self, resumable_id):
+        resumable_table = 'resumable_%s' % resumable_id
+        digests_table = 'digests_%s' % resumable_id
+        try:
+            with session_scope(self.engine) as session:
+                res = session.execute('''select r.chunk_num, r.chunk_size, d.digest from "%s" r
+                    left join "%s" d on r.chunk_num = d.chunk_num
+                    order by r.chunk_num''' % (resumable_table, digests_table)).fetchall()
+        except OperationalError:
+            # uploads started before digests were recorded
+            with session_scope(self.engine) as session:
+                res = session.execute('''select chunk_num, chunk_size, null from "%s"
+                    order by chunk_num''' % resumable_table).fetchall()
+        return [ tuple(row) for row in res ]
+
     def _db_get_total_size(self, resumable_id):
         resumable_table = 'resumable_%s' % resumable_id
         with session_scope(self.engine) as session:
@@ -549,18 +1068,227 @@ class SerialResumable(AbstractResumable):
                                   {'resumable_id': resumable_id}).fetchone()[0]
         return True if res > 0 else False
 
-    def _db_get_all_resumable_ids_for_owner(self):
+    def _db_get_all_resumable_ids_for_owner(self, strict=False):
+        # when strict, only a missing table means there are no uploads,
+        # so maintenance does not mistake an unreadable db for an empty one
         try:
             with session_scope(self.engine) as session:
                 res = session.execute('select id from resumable_uploads').fetchall()
-        except Exception:
+        except Exception as e:
+            if strict and 'no such table' not in str(e):
+                raise e
             return []
         return res # [(id,), (id,)]
 
+    def _db_compact(self):
+        with self.engine.connect() as conn:
+            conn.execute('vacuum')
+        return True
+
     def _db_remove_completed_for_owner(self, resumable_id):
         resumable_table = 'resumable_%s' % resumable_id
+        received_table = 'received_%s' % resumable_id
         with session_scope(self.engine) as session:
             session.execute('delete from resumable_uploads where id = :resumable_id',
                             {'resumable_id': resumable_id})
+            session.execute('create table if not exists resumable_content_types(id text, content_type text)')
+            session.execute('delete from resumable_content_types where id = :resumable_id',
+                            {'resumable_id': resumable_id})
             session.execute('drop table "%s"' % resumable_table)
+            session.execute('drop table if exists "%s"' % received_table)
+            session.execute('drop table if exists "digests_%s"' % resumable_id)
+            session.execute('drop table if exists "failed_%s"' % resumable_id)
         return True
+
+
+def _find_merged_files(work_dir):
+    """Map upload ids to partially merged files, and their locks."""
+    merged_files = {}
+    for entry in os.scandir(work_dir):
+        match = _IS_MERGED_FILE.match(entry.name)
+        if match and entry.is_file(follow_symlinks=False):
+            merged_files.setdefault(match.group(2), []).append(entry.path)
+    return merged_files
+
+
+def _last_modified(paths):
+    latest = None
+    for path in paths:
+        candidates = [path]
+        if os.path.isdir(path):
+            candidates.extend([ entry.path for entry in os.scandir(path) ])
+        for candidate in candidates:
+            try:
+                mtime = os.stat(candidate).st_mtime
+            except OSError:
+                continue
+            latest = mtime if latest is None else max(latest, mtime)
+    return latest
+
+
+def _remove_paths(paths):
+    reclaimed = 0
+    for path in paths:
+        try:
+            if os.path.isdir(path):
+                for entry in os.scandir(path):
+                    reclaimed += entry.stat(follow_symlinks=False).st_size
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                reclaimed += os.stat(path).st_size
+                os.remove(path)
+        except OSError as e:
+            logging.error(e)
+    return reclaimed
+
+
+def collect_garbage(work_dir, max_age, repair=False, min_idle=300):
+    """
+    Expire stale resumables in work_dir, for all owners, and
+    remove orphaned chunk directories which are not known to
+    any resumable db. Optionally repair the remaining resumables.
+
+    Returns
+    -------
+    dict
+
+    """
+    summary = {'expired': 0, 'orphans': 0, 'reclaimed_bytes': 0, 'checked': 0}
+    if not os.path.isdir(work_dir):
+        return summary
+    merged_files = _find_merged_files(work_dir)
+    known_ids = set()
+    failed_owners = []
+    for entry in os.scandir(work_dir):
+        match = _IS_RESUMABLE_DB.match(entry.name)
+        if not match:
+            continue
+        owner = match.group(1)
+        try:
+            res = SerialResumable(work_dir, owner)
+            expired, reclaimed = res.expire(work_dir, max_age, merged_files=merged_files)
+            summary['expired'] += expired
+            summary['reclaimed_bytes'] += reclaimed
+            if repair:
+                summary['checked'] += res.repair_all(work_dir, min_idle=min_idle)
+            known_ids.update([ item[0] for item in res._db_get_all_resumable_ids_for_owner(strict=True) ])
+        except Exception as e:
+            logging.error(e)
+            logging.error('garbage collection failed for %s in %s', owner, work_dir)
+            failed_owners.append(owner)
+            continue
+    now = time.time()
+    for entry in os.scandir(work_dir):
+        if failed_owners:
+            # uploads of owners whose db could not be read would look orphaned
+            logging.info('not removing orphaned resumable data in %s', work_dir)
+            break
+        if (not _IS_VALID_UUID.fullmatch(entry.name) or entry.name in known_ids
+                or not entry.is_dir(follow_symlinks=False)):
+            continue
+        chunks = [ f for f in os.listdir(entry.path) if '.chunk.' in f ]
+        if not chunks:
+            continue
+        paths = [entry.path] + merged_files.get(entry.name, [])
+        last_active = _last_modified(paths)
+        if last_active and (now - last_active) < max_age:
+            continue
+        logging.info('removing orphaned resumable data: %s', entry.path)
+        paths.append(_merge_lock_path(work_dir, entry.name))
+        summary['reclaimed_bytes'] += _remove_paths(paths)
+        summary['orphans'] += 1
+    for name, value in summary.items():
+        metrics.incr('resumables_gc', name, value)
+    return summary
+
+
+def _merge_in_background(work_dir, chunk_filename, upload_id, owner):
+    # each thread gets its own engine, sqlite connections
+    # cannot be shared between threads
+    res = SerialResumable(work_dir, owner)
+    return res.merge_received_chunk(work_dir, chunk_filename, upload_id, owner)
+
+
+def _merge_pending_in_background(work_dir, filename, upload_id, owner):
+    res = SerialResumable(work_dir, owner)
+    return res.merge_pending(work_dir, filename, upload_id, owner)
+
+
+def _close_in_background(fd):
+    fd.flush()
+    os.fsync(fd.fileno())
+    fd.close()
+
+
+class BackgroundMerger(object):
+
+    """
+    Merge resumable chunks in the background, so that clients
+    can send the next chunk while the previous one is merged.
+
+    Each active upload gets its own queue, and a worker which
+    merges chunks in the order in which they were received.
+    The file operations run in a thread pool, keeping the IOLoop
+    free, and workers exit after being idle for idle_timeout seconds.
+
+    """
+
+    def __init__(self, executor=None, idle_timeout=60):
+        self.executor = executor
+        self.idle_timeout = idle_timeout
+        self.queues = {}
+
+    def submit(self, work_dir, chunk_filename, upload_id, owner):
+        queue = self.queues.get(upload_id)
+        if not queue:
+            queue = tornado.queues.Queue()
+            self.queues[upload_id] = queue
+            IOLoop.current().spawn_callback(self._worker, upload_id, queue)
+        queue.put_nowait((work_dir, chunk_filename, upload_id, owner))
+
+    @gen.coroutine
+    def drain(self, upload_id):
+        """Wait until all queued chunks for upload_id have been merged."""
+        queue = self.queues.get(upload_id)
+        if queue:
+            yield queue.join()
+
+    @gen.coroutine
+    def merge_pending(self, work_dir, filename, upload_id, owner):
+        """
+        Wait until queued chunks for upload_id have been merged, here,
+        and in other processes, and merge any left pending.
+
+        Returns
+        -------
+        bool, True if all received chunks are merged
+
+        """
+        yield self.drain(upload_id)
+        merged = yield IOLoop.current().run_in_executor(
+            self.executor, _merge_pending_in_background, work_dir, filename, upload_id, owner
+        )
+        return merged
+
+    @gen.coroutine
+    def close_file(self, fd):
+        """Close a chunk, once it is on disk, in the executor."""
+        yield IOLoop.current().run_in_executor(self.executor, _close_in_background, fd)
+
+    @gen.coroutine
+    def _worker(self, upload_id, queue):
+        while True:
+            try:
+                item = yield queue.get(timeout=datetime.timedelta(seconds=self.idle_timeout))
+            except gen.TimeoutError:
+                if queue.empty():
+                    del self.queues[upload_id]
+                    return
+                continue
+            try:
+                yield IOLoop.current().run_in_executor(self.executor, _merge_in_background, *item)
+            except Exception as e:
+                logging.error(e)
+                logging.error('background merge failed for upload: %s', upload_id)
+            finally:
+                queue.task_done()
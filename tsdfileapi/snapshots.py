@@ -0,0 +1,261 @@
+
+"""
+Sorted, short-lived snapshots of directories, for paginated listings.
+
+Listing a page used to scan the directory from the start, and skip the
+entries of previous pages, so paging through a large directory was
+quadratic, and since scandir order is arbitrary, pages could overlap,
+or miss entries. A listing now takes a sorted snapshot of the entry
+names, cached per tenant and path for a short time, and each page is
+a slice of it. Pages requested with a cursor reuse the snapshot while
+it is cached. Other pages only reuse it if the directory's mtime shows
+that no entry has been added, removed, or renamed since it was taken,
+so new, and deleted, files are seen at once.
+
+Listings can be filtered, and sorted, see ListingQuery. Each distinct
+query is a view of the snapshot, computed once, and cached with it.
+Sizes and modification times, needed by some queries, are collected
+once per snapshot, so the entries of each page are checked against
+the filters again when they are listed.
+
+Pages after the first are requested with an opaque cursor, which refers
+to the snapshot, the query, the position in its view, and the sort key
+of the last entry listed. If the snapshot has expired, a new one is
+taken, and the listing continues after that key, so no entry is listed
+twice.
+
+Directories are scanned, and sorted, in a thread pool, but snapshots
+are only used from the IOLoop.
+
+"""
+
+import base64
+import bisect
+import datetime
+import fnmatch
+import json
+import os
+import time
+
+from collections import OrderedDict
+from uuid import uuid4
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import metrics
+
+
+# directories modified this recently before a scan started can change
+# again within the resolution of their mtime, unnoticed
+_MTIME_RESOLUTION = 2
+
+
+def _scan(path):
+    st = os.stat(path)
+    started = time.time()
+    with os.scandir(path) as entries:
+        names = sorted(entry.name for entry in entries)
+    return names, st.st_mtime_ns, started
+
+
+class InvalidCursor(Exception):
+    message = 'invalid cursor'
+
+
+class ListingQuery(object):
+
+    """
+    Filters, and sort order, for a listing, from query arguments:
+
+        name: glob pattern for file names, e.g. *.csv
+        mime_type: glob pattern for MIME types, e.g. text/*
+        min_size, max_size: in bytes, inclusive
+        modified_after, modified_before: ISO 8601 datetimes, inclusive
+        order: name, mtime, or size, with .asc (default) or .desc,
+               e.g. order=mtime.desc
+
+    Raises ValueError for invalid arguments.
+
+    """
+
+    ARGUMENTS = ['name', 'mime_type', 'min_size', 'max_size',
+                 'modified_after', 'modified_before', 'order']
+    ORDERS = ['name', 'mtime', 'size']
+
+    def __init__(self, get_argument):
+        self.arguments = OrderedDict()
+        for argument in self.ARGUMENTS:
+            value = get_argument(argument, None)
+            if value:
+                self.arguments[argument] = value
+        self.name = self.arguments.get('name')
+        self.mime_type = self.arguments.get('mime_type')
+        self.min_size = self._int('min_size')
+        self.max_size = self._int('max_size')
+        self.modified_after = self._timestamp('modified_after')
+        self.modified_before = self._timestamp('modified_before')
+        order = self.arguments.get('order', 'name.asc')
+        self.sort, _, direction = order.partition('.')
+        direction = direction or 'asc'
+        if self.sort not in self.ORDERS or direction not in ['asc', 'desc']:
+            raise ValueError('order must be one of %s, with .asc or .desc' % ', '.join(self.ORDERS))
+        self.descending = direction == 'desc'
+        self.key = json.dumps(self.arguments)
+        self.needs_stats = self.sort != 'name' or any(
+            value is not None for value in
+            [self.min_size, self.max_size, self.modified_after, self.modified_before]
+        )
+
+    def _int(self, argument):
+        value = self.arguments.get(argument)
+        return int(value) if value is not None else None
+
+    def _timestamp(self, argument):
+        value = self.arguments.get(argument)
+        if value is None:
+            return None
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+    def matches_name(self, name):
+        return not self.name or fnmatch.fnmatchcase(name, self.name)
+
+    def matches_stat(self, size, mtime):
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        if self.modified_after is not None and mtime < self.modified_after:
+            return False
+        if self.modified_before is not None and mtime > self.modified_before:
+            return False
+        return True
+
+    def matches_mime_type(self, mime_type):
+        return not self.mime_type or fnmatch.fnmatchcase(mime_type, self.mime_type)
+
+    def sort_key(self, name, stats):
+        if self.sort == 'name':
+            return (name, name)
+        size, mtime = stats[name]
+        return (size if self.sort == 'size' else mtime, name)
+
+
+class View(object):
+
+    """
+    The entries of a snapshot matching a query, in the query's order.
+
+    """
+
+    def __init__(self, snapshot, query, names):
+        self.snapshot = snapshot
+        self.query = query
+        # ascending sort keys, and names in the requested order
+        self.keys = sorted(query.sort_key(name, snapshot.stats) for name in names)
+        self.names = [key[1] for key in self.keys]
+        if query.descending:
+            self.names.reverse()
+
+    def cursor(self, position):
+        """Opaque reference to the listing, after position entries."""
+        last = self.names[position - 1]
+        state = {
+            's': self.snapshot.id,
+            'q': self.query.key,
+            'o': position,
+            'k': list(self.query.sort_key(last, self.snapshot.stats)),
+        }
+        return base64.urlsafe_b64encode(json.dumps(state).encode('utf-8')).decode('ascii').rstrip('=')
+
+    def position(self, cursor):
+        """
+        Where to continue listing, given a cursor.
+
+        Returns
+        -------
+        int
+
+        """
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            state = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+            snapshot_id, query_key, position = state['s'], state['q'], int(state['o'])
+            last = tuple(state['k'])
+            order = json.loads(query_key).get('order')
+        except Exception:
+            raise InvalidCursor
+        if position < 0 or len(last) != 2 or order != self.query.arguments.get('order'):
+            raise InvalidCursor
+        if snapshot_id == self.snapshot.id and query_key == self.query.key:
+            return position
+        metrics.incr('listing_snapshots', 'resumed')
+        try:
+            if self.query.descending:
+                return len(self.keys) - bisect.bisect_left(self.keys, last)
+            return bisect.bisect_right(self.keys, last)
+        except TypeError:
+            raise InvalidCursor
+
+
+class Snapshot(object):
+
+    def __init__(self, tenant, path, names, mtime_ns=None, started=None):
+        self.id = uuid4().hex
+        self.tenant = tenant
+        self.path = path
+        self.names = names
+        self.mtime_ns = mtime_ns
+        self.started = started
+        self.created = time.monotonic()
+        self.stats = {}
+        self.views = {}
+
+
+class DirectorySnapshots(object):
+
+    """
+    Snapshots per (tenant, path), valid for ttl seconds, keeping
+    at most max_snapshots, taken in the executor.
+
+    """
+
+    def __init__(self, ttl=60, max_snapshots=64, executor=None):
+        self.ttl = ttl
+        self.max_snapshots = max_snapshots
+        self.executor = executor
+        self.snapshots = OrderedDict()
+
+    @gen.coroutine
+    def get(self, tenant, path, current=False):
+        """
+        The cached snapshot of the path, unless it has expired. If a
+        current one is requested, the cached snapshot is only used if
+        the directory has not changed since it was taken.
+
+        Returns
+        -------
+        Snapshot
+
+        """
+        key = (tenant, path)
+        loop = IOLoop.current()
+        snapshot = self.snapshots.get(key)
+        if snapshot and time.monotonic() - snapshot.created < self.ttl:
+            unchanged = True
+            if current:
+                st = yield loop.run_in_executor(self.executor, os.stat, path)
+                unchanged = (st.st_mtime_ns == snapshot.mtime_ns
+                             and snapshot.started - st.st_mtime_ns / 1e9 > _MTIME_RESOLUTION)
+            if unchanged:
+                self.snapshots.move_to_end(key)
+                metrics.incr('listing_snapshots', 'hits')
+                return snapshot
+        metrics.incr('listing_snapshots', 'misses')
+        names, mtime_ns, started = yield loop.run_in_executor(self.executor, _scan, path)
+        snapshot = Snapshot(tenant, path, names, mtime_ns, started)
+        self.snapshots[key] = snapshot
+        self.snapshots.move_to_end(key)
+        while len(self.snapshots) > self.max_snapshots:
+            self.snapshots.popitem(last=False)
+        return snapshot
@@ -65,6 +65,9 @@ https://github.com/kennethreitz/requests/issues/713
 # pylint: disable=invalid-name
 
 import base64
+import gzip
+import hashlib
+import io
 import json
 import logging
 import os
@@ -75,14 +78,24 @@ import unittest
 import pwd
 import uuid
 import shutil
+import sqlite3
+import subprocess
+import tarfile
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from unittest import mock
 
 from pretty_bad_protocol import gnupg
 import requests
 import yaml
 from sqlalchemy.exc import OperationalError
 from tsdapiclient import fileapi
+from tornado import gen
 from tornado.escape import url_escape
+from tornado.ioloop import IOLoop
 
 import pretty_bad_protocol._parsers
 pretty_bad_protocol._parsers.Verify.TRUST_LEVELS["ENCRYPTION_COMPLIANCE_MODE"] = 23
@@ -92,8 +105,14 @@ from auth import process_access_token
 from tokens import gen_test_tokens, get_test_token_for_p12, gen_test_token_for_user
 from db import session_scope, sqlite_init, postgres_init, SqliteBackend, \
                sqlite_session, PostgresBackend, postgres_session
-from resumables import SerialResumable
-from utils import sns_dir, md5sum, IllegalFilenameException
+from catalog import FileCatalog, FileCatalogs
+from filecache import OpenFileCache
+from snapshots import DirectorySnapshots
+from metacache import FileMetadataCache
+from egress import EgressScheduler
+from changes import ChangeFeeds, Feed, reserved
+from resumables import SerialResumable, BackgroundMerger, collect_garbage, merkle_levels
+from utils import sns_dir, md5sum, merge_tree, IllegalFilenameException, MergeConflict, zstandard
 from pgp import _import_keys
 from squril import SqliteQueryGenerator, PostgresQueryGenerator
 
@@ -867,6 +886,52 @@ class TestFileApi(unittest.TestCase):
                              headers=headers)
         self.assertEqual(resp1.status_code, 201)
 
+    def test_Zi_resumable_gz_decompressed_at_end(self):
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['VALID'],
+                   'Content-Type': 'application/gz'}
+        with open(self.example_gz, 'rb') as f:
+            data = f.read()
+        chunksize = len(data) // 3 + 1
+        upload_id = None
+        for num in range(3):
+            chunk = data[num*chunksize:(num+1)*chunksize]
+            resp = requests.patch(f'{self.store_import}/resumed-ungz1?chunk={num+1}&id={upload_id}',
+                                  data=chunk, headers=headers)
+            self.assertEqual(resp.status_code, 201)
+            upload_id = json.loads(resp.text)['id']
+        resp = requests.patch(f'{self.store_import}/resumed-ungz1?chunk=end&id={upload_id}',
+                              headers=headers)
+        self.assertEqual(resp.status_code, 201)
+        with open(f'{self.store_import_folder}/resumed-ungz1', 'r') as uploaded_file:
+           self.assertEqual('x,y\n4,5\n2,1\n', uploaded_file.read())
+
+
+    def test_Zi1_resumable_content_type_fixed_by_first_chunk(self):
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['VALID'],
+                   'Content-Type': 'application/gz'}
+        with open(self.example_gz, 'rb') as f:
+            data = f.read()
+        chunksize = len(data) // 2 + 1
+        resp = requests.patch(f'{self.store_import}/resumed-ungz2?chunk=1&id=None',
+                              data=data[:chunksize], headers=headers)
+        self.assertEqual(resp.status_code, 201)
+        upload_id = json.loads(resp.text)['id']
+        other = dict(headers, **{'Content-Type': 'application/octet-stream'})
+        resp = requests.patch(f'{self.store_import}/resumed-ungz2?chunk=2&id={upload_id}',
+                              data=data[chunksize:], headers=other)
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(json.loads(resp.text)['message'], 'content_type_mismatch')
+        resp = requests.patch(f'{self.store_import}/resumed-ungz2?chunk=2&id={upload_id}',
+                              data=data[chunksize:], headers=headers)
+        self.assertEqual(resp.status_code, 201)
+        # decoded as sent with the first chunk
+        resp = requests.patch(f'{self.store_import}/resumed-ungz2?chunk=end&id={upload_id}',
+                              headers=other)
+        self.assertEqual(resp.status_code, 201)
+        with open(f'{self.store_import_folder}/resumed-ungz2', 'r') as uploaded_file:
+           self.assertEqual('x,y\n4,5\n2,1\n', uploaded_file.read())
+
+
     def test_ZA_choosing_file_upload_directories_based_on_tenant_works(self):
         newfilename = 'uploaded-example-p12.csv'
         try:
@@ -1155,6 +1220,243 @@ class TestFileApi(unittest.TestCase):
             pass
 
 
+    def test_ZT1_resumables_report_received_and_merged_offsets(self):
+        filepath = self.resume_file2
+        filename = os.path.basename(filepath)
+        cs = 5
+        upload_id = self.start_new_resumable(filepath, chunksize=cs, stop_at=2)
+        token = TEST_TOKENS['VALID']
+        url = '%s/%s?id=%s' % (self.resumables, filename, upload_id)
+        resp = requests.get(url, headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.text)
+        self.assertEqual(data['received_offset'], cs * 2)
+        self.assertTrue(data['merged_offset'] <= data['received_offset'])
+        self.assertEqual(data['next_offset'], data['received_offset'])
+        resp = requests.delete(url, headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual(resp.status_code, 200)
+
+
+    def test_ZT2_offset_based_resumable(self):
+        filepath = self.resume_file2
+        filename = os.path.basename(filepath)
+        with open(filepath, 'rb') as f:
+            content = f.read()
+        token = TEST_TOKENS['VALID']
+        headers = {'Authorization': 'Bearer ' + token}
+        offset, upload_id = 0, None
+        for size in [1, 7, 3]:
+            url = '%s/%s' % (self.stream, filename)
+            if upload_id:
+                url = '%s?id=%s' % (url, upload_id)
+            resp = requests.patch(url, data=content[offset:offset + size],
+                                  headers=dict(headers, **{'Upload-Offset': str(offset)}))
+            self.assertEqual(resp.status_code, 201)
+            offset += size
+            self.assertEqual(int(resp.headers['Upload-Offset']), offset)
+            upload_id = json.loads(resp.text)['id']
+        url = '%s/%s?id=%s' % (self.resumables, filename, upload_id)
+        resp = requests.head(url, headers=headers)
+        self.assertEqual(int(resp.headers['Upload-Offset']), offset)
+        url = '%s/%s?id=%s' % (self.stream, filename, upload_id)
+        resp = requests.patch(url, data=content[offset:],
+                              headers=dict(headers, **{'Upload-Offset': '1'}))
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(int(resp.headers['Upload-Offset']), offset)
+        resp = requests.patch(url, data=content[offset:],
+                              headers=dict(headers, **{'Upload-Offset': str(offset)}))
+        self.assertEqual(resp.status_code, 201)
+        resp = requests.patch('%s&chunk=end' % url, headers=headers)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(md5sum(filepath),
+                md5sum(self.uploads_folder + '/' + self.test_group + '/' + filename))
+
+
+    def test_ZT3_resumable_merkle_tree(self):
+        filepath = self.resume_file2
+        filename = os.path.basename(filepath)
+        cs = 5
+        upload_id = self.start_new_resumable(filepath, chunksize=cs, stop_at=2)
+        with open(filepath, 'rb') as f:
+            content = f.read()
+        digests = [ hashlib.sha256(content[i:i + cs]).hexdigest() for i in (0, cs) ]
+        token = TEST_TOKENS['VALID']
+        headers = {'Authorization': 'Bearer ' + token}
+        url = '%s/%s?id=%s&tree=true' % (self.resumables, filename, upload_id)
+        resp = requests.get(url, headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        tree = json.loads(resp.text)
+        self.assertEqual([ c['digest'] for c in tree['chunks'] ], digests)
+        self.assertEqual(tree['root'], merkle_levels(digests)[-1][0])
+        url = '%s/%s?id=%s&chunk=end' % (self.stream, filename, upload_id)
+        resp = requests.patch(url, headers=headers)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(json.loads(resp.text)['merkle_root'], tree['root'])
+
+
+    def test_ZT4_async_merge_failure_is_resumable(self):
+        work_dir = tempfile.mkdtemp()
+        owner = 'p11-import_user'
+        res = SerialResumable(work_dir, owner)
+        merger = BackgroundMerger()
+        def send(chunk_num, upload_id, data):
+            chunk_num, upload_id, _, chunk_order_correct, filename = \
+                res.prepare(work_dir, 'file', str(chunk_num), upload_id, self.test_group, owner)
+            if not chunk_order_correct:
+                return upload_id, False
+            with open(work_dir + '/' + filename, 'wb') as f:
+                f.write(data)
+            res.record_received_chunk(upload_id, chunk_num, len(data))
+            merger.submit(work_dir, os.path.basename(filename), upload_id, owner)
+            return upload_id, True
+        try:
+            upload_id, _ = send(1, 'None', b'aaa')
+            IOLoop.current().run_sync(lambda: merger.drain(upload_id))
+            # the merge of chunk 2 fails, after chunks 2 and 3 were acknowledged
+            merged_file = work_dir + '/file.' + upload_id
+            os.rename(merged_file, merged_file + '.saved')
+            os.makedirs(merged_file)
+            send(2, upload_id, b'bbb')
+            send(3, upload_id, b'ccc')
+            IOLoop.current().run_sync(lambda: merger.drain(upload_id))
+            os.rmdir(merged_file)
+            os.rename(merged_file + '.saved', merged_file)
+            self.assertFalse(res.merge_pending(work_dir, 'file', upload_id, owner))
+            self.assertEqual(res.upload_offset(upload_id), 3)
+            self.assertEqual(res.merged_state(upload_id), (3, 1))
+            self.assertEqual(res.info(work_dir, 'file', upload_id, owner)['max_chunk'], 1)
+            # later chunks are refused, until the client resumes after the merged chunk
+            self.assertFalse(send(4, upload_id, b'ddd')[1])
+            for chunk_num, data in [(2, b'bbb'), (3, b'ccc')]:
+                self.assertTrue(send(chunk_num, upload_id, data)[1])
+            IOLoop.current().run_sync(lambda: merger.drain(upload_id))
+            self.assertTrue(res.merge_pending(work_dir, 'file', upload_id, owner))
+            final = res.finalise(work_dir, 'file.chunk.end', upload_id, owner)
+            with open(final, 'rb') as f:
+                self.assertEqual(f.read(), b'aaabbbccc')
+        finally:
+            shutil.rmtree(work_dir)
+
+
+    def test_ZT5_merges_wait_for_other_processes(self):
+        work_dir = tempfile.mkdtemp()
+        owner = 'p11-import_user'
+        res = SerialResumable(work_dir, owner)
+        try:
+            upload_id = None
+            for chunk_num, data in [(1, b'aaa'), (2, b'bbb')]:
+                chunk_num, upload_id, _, _, filename = \
+                    res.prepare(work_dir, 'file', str(chunk_num), upload_id or 'None', self.test_group, owner)
+                with open(work_dir + '/' + filename, 'wb') as f:
+                    f.write(data)
+                res.record_received_chunk(upload_id, chunk_num, len(data))
+            self.assertTrue(res.merge_received_chunk(work_dir, 'file.chunk.1', upload_id, owner))
+            # another process holds the merge lock, as if merging chunk 2
+            holder = subprocess.Popen(
+                [sys.executable, '-c', 'import fcntl, os, sys, time; '
+                 'fd = os.open(sys.argv[1], os.O_WRONLY | os.O_CREAT); '
+                 'fcntl.lockf(fd, fcntl.LOCK_EX); print(flush=True); time.sleep(1)',
+                 f'{work_dir}/.{upload_id}.merge.lock'],
+                stdout=subprocess.PIPE
+            )
+            holder.stdout.readline()
+            start = time.time()
+            self.assertTrue(res.merge_pending(work_dir, 'file', upload_id, owner))
+            self.assertTrue(time.time() - start > 0.5)
+            holder.wait()
+            # chunks merged meanwhile are not merged again
+            self.assertTrue(res.merge_received_chunk(work_dir, 'file.chunk.2', upload_id, owner))
+            final = res.finalise(work_dir, 'file.chunk.end', upload_id, owner)
+            with open(final, 'rb') as f:
+                self.assertEqual(f.read(), b'aaabbb')
+            self.assertFalse(os.path.lexists(f'{work_dir}/.{upload_id}.merge.lock'))
+        finally:
+            shutil.rmtree(work_dir)
+
+
+    def _stale_resumable(self, work_dir, owner, chunks, age=3600):
+        res = SerialResumable(work_dir, owner)
+        upload_id = 'None'
+        for chunk_num, data in enumerate(chunks, start=1):
+            chunk_num, upload_id, _, _, filename = \
+                res.prepare(work_dir, 'file', str(chunk_num), upload_id, self.test_group, owner)
+            with open(work_dir + '/' + filename, 'wb') as f:
+                f.write(data)
+            res.merge_chunk(work_dir, os.path.basename(filename), upload_id, owner)
+        then = time.time() - age
+        for path in [f'{work_dir}/{upload_id}', f'{work_dir}/file.{upload_id}'] + \
+                    [ f'{work_dir}/{upload_id}/{name}' for name in os.listdir(f'{work_dir}/{upload_id}') ]:
+            os.utime(path, (then, then))
+        return res, upload_id
+
+
+    def test_ZT6_resumables_expire(self):
+        work_dir = tempfile.mkdtemp()
+        owner = 'p11-import_user'
+        try:
+            res, stale_id = self._stale_resumable(work_dir, owner, [b'aaa', b'bb'])
+            _, active_id = self._stale_resumable(work_dir, owner, [b'c'], age=0)
+            self.assertEqual(res.expire(work_dir, 60), (1, 10))
+            self.assertFalse(os.path.lexists(f'{work_dir}/{stale_id}'))
+            self.assertFalse(os.path.lexists(f'{work_dir}/file.{stale_id}'))
+            self.assertEqual([ item[0] for item in res._db_get_all_resumable_ids_for_owner() ], [active_id])
+            tables = sqlite3.connect(f'{work_dir}/.resumables-{owner}.db').execute(
+                'select name from sqlite_master where type = "table"'
+            ).fetchall()
+            self.assertFalse([ t for t in tables if stale_id in t[0] ])
+            self.assertTrue(os.path.lexists(f'{work_dir}/{active_id}'))
+        finally:
+            shutil.rmtree(work_dir)
+
+
+    def test_ZT7_resumables_repair(self):
+        work_dir = tempfile.mkdtemp()
+        owner = 'p11-import_user'
+        try:
+            res, upload_id = self._stale_resumable(work_dir, owner, [b'aaa', b'bbb'])
+            # as if the server stopped while merging the last chunk
+            merged_file = f'{work_dir}/file.{upload_id}'
+            with open(merged_file, 'ab') as f:
+                f.truncate(4)
+            self.assertEqual(res.repair_all(work_dir, min_idle=60), 1)
+            with open(merged_file, 'rb') as f:
+                self.assertEqual(f.read(), b'aaabbb')
+            self.assertEqual(res.info(work_dir, 'file', upload_id, owner)['next_offset'], 6)
+            # recently active uploads are left alone
+            _, active_id = self._stale_resumable(work_dir, owner, [b'c'], age=0)
+            self.assertEqual(res.repair_all(work_dir, min_idle=60), 1)
+        finally:
+            shutil.rmtree(work_dir)
+
+
+    def test_ZT8_resumables_gc_survives_broken_owner_db(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            _, stale_id = self._stale_resumable(work_dir, 'p11-import_user', [b'aaa'])
+            orphan = f'{work_dir}/{uuid.uuid4()}'
+            os.makedirs(orphan)
+            with open(f'{orphan}/file.chunk.1', 'wb') as f:
+                f.write(b'orphaned')
+            then = time.time() - 3600
+            for path in [f'{orphan}/file.chunk.1', orphan]:
+                os.utime(path, (then, then))
+            broken_db = f'{work_dir}/.resumables-p11-broken.db'
+            with open(broken_db, 'wb') as f:
+                f.write(b'not a database' * 100)
+            summary = collect_garbage(work_dir, 60)
+            # the other owner is still collected, but orphans are kept,
+            # since they might belong to the broken db
+            self.assertEqual((summary['expired'], summary['orphans']), (1, 0))
+            self.assertFalse(os.path.lexists(f'{work_dir}/{stale_id}'))
+            self.assertTrue(os.path.lexists(orphan))
+            os.remove(broken_db)
+            summary = collect_garbage(work_dir, 60)
+            self.assertEqual((summary['expired'], summary['orphans']), (0, 1))
+            self.assertFalse(os.path.lexists(orphan))
+        finally:
+            shutil.rmtree(work_dir)
+
+
     def test_ZU_sending_uneven_chunks_resume_works(self):
         filepath = self.resume_file2
         filename = os.path.basename(filepath)
@@ -1295,6 +1597,67 @@ class TestFileApi(unittest.TestCase):
         self.assertEqual(resp3.status_code, 400)
 
 
+    def test_ZZa1_content_etag_and_not_modified(self):
+        url = self.export + '/file1'
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT'],
+                   'Accept-Encoding': 'identity'}
+        resp = requests.head(url, headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['Etag']
+        self.assertEqual(etag, '"%s"' % hashlib.sha256(b'some data\n').hexdigest())
+        resp = requests.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.text, '')
+        resp = requests.get(url, headers=dict(headers, **{'If-Modified-Since': resp.headers['Last-Modified']}))
+        self.assertEqual(resp.status_code, 304)
+        resp = requests.get(url, headers=dict(headers, **{'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'}))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.text, 'some data\n')
+
+
+    def test_ZZa2_compressed_export(self):
+        export_dir = os.path.expanduser(
+            self.config['backends']['disk']['files']['export_path'].replace('pXX', self.config['test_project'])
+        )
+        data = b''.join(b'%d,some data\n' % i for i in range(10000))
+        with open(f'{export_dir}/compressible.txt', 'wb') as f:
+            f.write(data)
+        with open(f'{export_dir}/incompressible.bin', 'wb') as f:
+            f.write(os.urandom(10000))
+        url = self.export + '/compressible.txt'
+        auth = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}
+        try:
+            resp = requests.get(url, headers=dict(auth, **{'Accept-Encoding': 'identity'}))
+            self.assertFalse('Content-Encoding' in resp.headers)
+            self.assertEqual(resp.content, data)
+            etags = {resp.headers['Etag']}
+            decompressors = {'gzip': gzip.decompress}
+            if zstandard:
+                decompressors['zstd'] = lambda body: zstandard.ZstdDecompressor().decompressobj().decompress(body)
+            for encoding, decompress in decompressors.items():
+                resp = requests.get(url, headers=dict(auth, **{'Accept-Encoding': encoding}), stream=True)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.headers['Content-Encoding'], encoding)
+                self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+                body = resp.raw.read(decode_content=False)
+                self.assertTrue(len(body) < len(data))
+                self.assertEqual(decompress(body), data)
+                etags.add(resp.headers['Etag'])
+            # each representation has its own Etag
+            self.assertEqual(len(etags), len(decompressors) + 1)
+            # ranges, and types which are not configured, are sent as they are
+            resp = requests.get(url, headers=dict(auth, **{'Accept-Encoding': 'gzip', 'Range': 'bytes=0-99'}))
+            self.assertFalse('Content-Encoding' in resp.headers)
+            self.assertEqual(resp.content, data[:100])
+            resp = requests.get(self.export + '/incompressible.bin', headers=dict(auth, **{'Accept-Encoding': 'gzip'}))
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse('Content-Encoding' in resp.headers)
+            self.assertEqual(resp.headers['Content-Length'], '10000')
+        finally:
+            os.remove(f'{export_dir}/compressible.txt')
+            os.remove(f'{export_dir}/incompressible.bin')
+
+
     def test_ZZb_get_range_out_of_bounds_returns_correct_error(self):
         url = self.export + '/file1'
         headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT'],
@@ -1303,14 +1666,203 @@ class TestFileApi(unittest.TestCase):
         self.assertEqual(resp.status_code, 416)
 
 
-    def test_ZZc_requesting_multiple_ranges_not_supported_error(self):
+    def test_ZZc_requesting_multiple_ranges(self):
         url = self.export + '/file1'
+        # adjacent ranges are coalesced into one
         headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT'],
                    'Range': 'bytes=1-4, 5-10'}
         resp = requests.get(url, headers=headers)
-        self.assertEqual(resp.status_code, 405)
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 1-9/10')
+        self.assertEqual(resp.text, 'ome data\n')
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT'],
+                   'Range': 'bytes=0-3, 8-9'}
+        resp = requests.get(url, headers=headers)
+        self.assertEqual(resp.status_code, 206)
+        content_type = resp.headers['Content-Type']
+        self.assertTrue(content_type.startswith('multipart/byteranges; boundary='))
+        boundary = content_type.split('boundary=')[-1]
+        self.assertTrue('Content-Range: bytes 0-3/10\r\n\r\nsome\r\n' in resp.text)
+        self.assertTrue('Content-Range: bytes 8-9/10\r\n\r\na\n\r\n' in resp.text)
+        self.assertTrue(resp.text.endswith('--%s--\r\n' % boundary))
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT'],
+                   'Range': 'bytes=' + ','.join(['0-0'] * 100)}
+        resp = requests.get(url, headers=headers)
+        self.assertEqual(resp.status_code, 416)
 
 
+    def test_ZZd_open_file_cache(self):
+        root = tempfile.mkdtemp()
+        path = f'{root}/file'
+        try:
+            with open(path, 'w') as f:
+                f.write('some data\n')
+            cache = OpenFileCache(max_entries=2, max_idle=30)
+            self.assertIsNone(cache.acquire(path, scope='files'))
+            entry = cache.insert(path, 10, 'text/plain', scope='files')
+            self.assertEqual(entry.users, 1)
+            self.assertEqual(cache.acquire(path, scope='files'), entry)
+            self.assertEqual(entry.users, 2)
+            # entries which passed one backend's checks are not used by another
+            self.assertIsNone(cache.acquire(path, scope='store'))
+            cache.release(entry)
+            cache.release(entry)
+            self.assertEqual(entry.users, 0)
+            # any change to size, or mtime, is a miss, but open entries stay open
+            self.assertEqual(cache.acquire(path, scope='files'), entry)
+            st = os.stat(path)
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+            self.assertIsNone(cache.acquire(path, scope='files'))
+            self.assertTrue(entry.evicted)
+            self.assertFalse(entry.file.closed)
+            cache.release(entry)
+            self.assertTrue(entry.file.closed)
+            # so is a new file at the same path
+            entry = cache.insert(path, 10, 'text/plain', scope='files')
+            cache.release(entry)
+            os.rename(path, f'{path}.old')
+            with open(path, 'w') as f:
+                f.write('some data\n')
+            self.assertIsNone(cache.acquire(path, scope='files'))
+            self.assertTrue(entry.file.closed)
+            # files which changed since they were checked are not cached
+            entry = cache.insert(path, 5, 'text/plain', scope='files')
+            self.assertTrue(entry.evicted)
+            self.assertIsNone(cache.acquire(path, scope='files'))
+            cache.release(entry)
+            self.assertTrue(entry.file.closed)
+            # least recently used entries are closed first
+            entries = [cache.insert(path, 10, 'text/plain', scope=scope) for scope in ['a', 'b']]
+            for entry in entries:
+                cache.release(entry)
+            cache.acquire(path, scope='a')
+            cache.release(entries[0])
+            entry = cache.insert(path, 10, 'text/plain', scope='c')
+            cache.release(entry)
+            self.assertFalse(entries[0].file.closed)
+            self.assertTrue(entries[1].file.closed)
+            self.assertEqual(sorted(scope for scope, _ in cache.entries), ['a', 'c'])
+            # idle entries are swept, unless in use
+            in_use = cache.acquire(path, scope='a')
+            cache.max_idle = 0
+            time.sleep(0.01)
+            cache.sweep()
+            self.assertEqual(list(cache.entries), [('a', path)])
+            self.assertTrue(entry.file.closed)
+            cache.release(in_use)
+            time.sleep(0.01)
+            cache.sweep()
+            self.assertEqual(list(cache.entries), [])
+            self.assertTrue(in_use.file.closed)
+            # without caching, files are closed when released
+            cache = OpenFileCache(max_entries=0)
+            entry = cache.insert(path, 10, 'text/plain', scope='files')
+            self.assertIsNone(cache.acquire(path, scope='files'))
+            cache.release(entry)
+            self.assertTrue(entry.file.closed)
+        finally:
+            shutil.rmtree(root)
+
+    def test_ZZd1_file_metadata_cache(self):
+        root = tempfile.mkdtemp()
+        path = f'{root}/file'
+        try:
+            with open(path, 'w') as f:
+                f.write('some data\n')
+            cache = FileMetadataCache(max_entries=2)
+            st = os.stat(path)
+            self.assertIsNone(cache.mime_type(st))
+            cache.set_mime_type(st, 'text/plain')
+            self.assertEqual(cache.mime_type(os.stat(path)), 'text/plain')
+            # MIME types are cached per version of the file
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+            self.assertIsNone(cache.mime_type(os.stat(path)))
+            with open(path, 'a') as f:
+                f.write('more data\n')
+            self.assertIsNone(cache.mime_type(os.stat(path)))
+            os.rename(path, f'{path}.old')
+            with open(path, 'w') as f:
+                f.write('some data\n')
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            self.assertIsNone(cache.mime_type(os.stat(path)))
+            # verdicts are cached per policy, tenant, name, size, and MIME type
+            policy, other_policy = {'enabled': True}, {'enabled': True}
+            key = (id(policy), 'p11', 'file', 10, 'text/plain')
+            cache.set_verdict(key, (False, 'not allowed'))
+            self.assertEqual(cache.verdict(key), (False, 'not allowed'))
+            for other in [(id(other_policy), 'p11', 'file', 10, 'text/plain'),
+                          (id(policy), 'p12', 'file', 10, 'text/plain'),
+                          (id(policy), 'p11', 'file', 11, 'text/plain')]:
+                self.assertIsNone(cache.verdict(other))
+            # both caches are bounded, least recently used first
+            cache.set_verdict(('a',), (True, None))
+            cache.verdict(key)
+            cache.set_verdict(('b',), (True, None))
+            self.assertIsNone(cache.verdict(('a',)))
+            self.assertEqual(cache.verdict(key), (False, 'not allowed'))
+            self.assertEqual(len(cache.verdicts.entries), 2)
+            for name in ['a', 'b', 'c']:
+                with open(f'{root}/{name}', 'w') as f:
+                    f.write(name)
+                cache.set_mime_type(os.stat(f'{root}/{name}'), 'text/plain')
+            self.assertEqual(len(cache.mime_types.entries), 2)
+            self.assertIsNone(cache.mime_type(os.stat(f'{root}/a')))
+            # with max_entries=0 nothing is cached
+            cache = FileMetadataCache(max_entries=0)
+            cache.set_mime_type(st, 'text/plain')
+            cache.set_verdict(key, (True, None))
+            self.assertIsNone(cache.mime_type(st))
+            self.assertIsNone(cache.verdict(key))
+        finally:
+            shutil.rmtree(root)
+
+    def test_ZZd2_egress_scheduler(self):
+        chunk = 20000
+        scheduler = EgressScheduler(rate=2000000, burst=0.05, quantum=chunk,
+                                    tenants={'p12': {'weight': 2}, 'p13': {'rate': 200000}},
+                                    max_metric_tenants=3)
+        granted = []
+        @gen.coroutine
+        def stream(tenant, until):
+            while time.monotonic() < until:
+                yield scheduler.acquire(tenant, chunk)
+                granted.append((time.monotonic(), tenant))
+        @gen.coroutine
+        def run():
+            start = time.monotonic()
+            # p11 has more streams than p14, but the same weight
+            yield [stream(tenant, start + 1) for tenant in ['p11', 'p11', 'p11', 'p14', 'p12', 'p13']]
+            return start
+        start = IOLoop.current().run_sync(run)
+        sent = lambda tenant, since, until: chunk * len([t for when, t in granted
+                                                         if t == tenant and since < when <= until])
+        # the node bucket holds at most burst seconds of rate
+        self.assertTrue(sum(sent(t, start, start + 0.01) for t in ['p11', 'p12', 'p13', 'p14']) <= 100000 + chunk)
+        elapsed = granted[-1][0] - start
+        self.assertTrue(chunk * len(granted) <= 2000000 * elapsed + 100000 + chunk)
+        # after the initial burst, capped tenants get no more than their rate,
+        # and the rest is shared by weight
+        since, until = start + 0.1, start + 1
+        self.assertTrue(sent('p13', since, until) <= 200000 * 0.9 + 20000 + chunk)
+        self.assertTrue(0.8 < sent('p11', since, until) / sent('p14', since, until) < 1.25)
+        self.assertTrue(1.6 < sent('p12', since, until) / sent('p14', since, until) < 2.5)
+        # tenants beyond max_metric_tenants, and not configured, share metrics
+        self.assertEqual(scheduler.tenant('p11').metric, 'p11')
+        self.assertEqual(scheduler.tenant('p14').metric, 'p14')
+        self.assertEqual(scheduler.tenant('p15').metric, 'other')
+        self.assertEqual(scheduler.tenant('p13').metric, 'p13')
+        # waiters which were cancelled are skipped
+        @gen.coroutine
+        def cancelled():
+            first = scheduler.acquire('p11', 200000)
+            yield first
+            gone = scheduler.acquire('p11', 200000)
+            waiting = scheduler.acquire('p11', chunk)
+            gone.cancel()
+            yield gen.with_timeout(IOLoop.current().time() + 1, waiting)
+            self.assertEqual(list(scheduler.active), [])
+        IOLoop.current().run_sync(cancelled)
+
     def test_ZZe_filename_rules_with_uploads(self):
         headers = {'Authorization': 'Bearer ' + TEST_TOKENS['VALID']}
         resp = requests.put(self.stream + '/' + url_escape('så_søt(1).txt'),
@@ -1348,6 +1900,62 @@ class TestFileApi(unittest.TestCase):
         resp2 = requests.get(url, headers=headers)
         self.assertEqual(resp2.status_code, 200)
 
+    def test_ZZf1_sendfile_export_matches_chunked_export(self):
+        # the cluster backend sends files with sendfile, the files backend does not
+        export_dir = os.path.expanduser(
+            self.config['backends']['disk']['cluster']['export_path'].replace('pXX', self.config['test_project'])
+        )
+        data = os.urandom(5 * 1024 * 1024 + 7)
+        filename = 'sendfile-test.bin'
+        with open(f'{export_dir}/{filename}', 'wb') as f:
+            f.write(data)
+        try:
+            # If-Range keeps the cluster backend from redirecting to nginx
+            etag = requests.head(f'{self.export_cluster}/{filename}', headers={
+                'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}).headers['Etag']
+            for extra in [{}, {'Range': 'bytes=1000-3000000'}, {'Range': 'bytes=0-9, 4000000-'}]:
+                headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT'], 'If-Range': etag, **extra}
+                chunked = requests.get(f'{self.export}/{filename}', headers=headers)
+                sent = requests.get(f'{self.export_cluster}/{filename}', headers=headers)
+                self.assertEqual(sent.status_code, chunked.status_code)
+                self.assertEqual(sent.headers['Content-Length'], chunked.headers['Content-Length'])
+                self.assertEqual(sent.headers['Connection'], 'close')
+                if 'multipart' in chunked.headers['Content-Type']:
+                    # part boundaries are random
+                    boundary = lambda resp: resp.headers['Content-Type'].split('boundary=')[-1].encode()
+                    self.assertEqual(sent.content.replace(boundary(sent), b''),
+                                     chunked.content.replace(boundary(chunked), b''))
+                else:
+                    self.assertEqual(sent.content, chunked.content)
+            self.assertEqual(sent.status_code, 206)
+            self.assertEqual(requests.get(f'{self.export_cluster}/{filename}', headers={
+                'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT'], 'If-Range': etag}).content, data)
+        finally:
+            os.remove(f'{export_dir}/{filename}')
+
+    def test_ZZf2_accel_redirect_export(self):
+        # the cluster backend lets nginx send files
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}
+        resp = requests.get(self.export_cluster + '/file1', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['X-Accel-Redirect'],
+                         '/internal/cluster/%s/export/file1' % self.config['test_project'])
+        etag = requests.head(self.export + '/file1', headers=headers).headers['Etag']
+        self.assertEqual(resp.headers['Etag'], etag)
+        self.assertEqual(resp.content, b'')
+        resp = requests.get(self.export_cluster + '/file1', headers={**headers, 'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertFalse('X-Accel-Redirect' in resp.headers)
+        resp = requests.get(self.export_cluster + '/not-there', headers=headers)
+        self.assertEqual(resp.status_code, 404)
+        self.assertFalse('X-Accel-Redirect' in resp.headers)
+        # nginx cannot evaluate If-Range against our Etag
+        resp = requests.get(self.export_cluster + '/file1',
+                            headers={**headers, 'Range': 'bytes=0-3', 'If-Range': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse('X-Accel-Redirect' in resp.headers)
+        self.assertEqual(resp.text, 'some')
+
     # TODO: store system backend
 
     def test_ZZg_store_import_and_export(self):
@@ -1497,6 +2105,37 @@ class TestFileApi(unittest.TestCase):
         data = json.loads(resp.text)
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(len(data['files']), 101)
+        # follow cursors through a sorted snapshot
+        listed = []
+        nextref = f'{self.store_export}/topdir/bottomdir?per_page=40'
+        while nextref:
+            resp = requests.get(nextref, headers=headers)
+            self.assertEqual(resp.status_code, 200)
+            data = json.loads(resp.text)
+            listed.extend(f['filename'] for f in data['files'])
+            nextref = data['page'] and f"http://localhost:{self.config['port']}{data['page']}"
+        self.assertEqual(listed, sorted(f'file{i}' for i in range(101)))
+        resp = requests.get(f'{self.store_export}/topdir/bottomdir?cursor=blabla', headers=headers)
+        self.assertEqual(resp.status_code, 400)
+        # filter, and sort on the server
+        resp = requests.get(f'{self.store_export}/topdir/bottomdir?name=file1?&order=name.desc', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.text)
+        self.assertEqual([f['filename'] for f in data['files']], [f'file{i}' for i in range(19, 9, -1)])
+        resp = requests.get(f'{self.store_export}/topdir/bottomdir?min_size=19&order=size.asc', headers=headers)
+        data = json.loads(resp.text)
+        self.assertEqual([f['filename'] for f in data['files']], ['file100'])
+        resp = requests.get(f'{self.store_export}/topdir/bottomdir?order=owner', headers=headers)
+        self.assertEqual(resp.status_code, 400)
+        # stream the whole listing, one entry per line
+        resp = requests.get(f'{self.store_export}/topdir/bottomdir?format=ndjson', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'application/x-ndjson')
+        entries = [json.loads(line) for line in resp.text.splitlines()]
+        self.assertEqual(sorted(e['filename'] for e in entries), sorted(f'file{i}' for i in range(101)))
+        resp = requests.get(f'{self.store_export}/topdir/bottomdir?format=ndjson&name=file1?&order=name.desc', headers=headers)
+        entries = [json.loads(line) for line in resp.text.splitlines()]
+        self.assertEqual([e['filename'] for e in entries], [f'file{i}' for i in range(19, 9, -1)])
         # fail gracefully
         resp = requests.get(f'{self.store_export}/topdir/bottomdir?page=-1', headers=headers)
         self.assertEqual(resp.status_code, 400)
@@ -1538,6 +2177,65 @@ class TestFileApi(unittest.TestCase):
             pass
 
 
+    def test_ZZZ_get_dir_as_archive(self):
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}
+        dirs = f'{self.store_import_folder}/topdir/bottomdir'
+        try:
+            os.makedirs(dirs)
+        except OSError:
+            pass
+        with open(f'{dirs}/file1', 'w') as f:
+            f.write('hi there')
+        with open(f'{dirs}/.hidden', 'w') as f:
+            f.write('not for export')
+        resp = requests.get(f'{self.store_export}/topdir?format=tar', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        archive = tarfile.open(fileobj=io.BytesIO(resp.content))
+        self.assertEqual(archive.getnames(), ['topdir/bottomdir/file1'])
+        self.assertEqual(archive.extractfile('topdir/bottomdir/file1').read(), b'hi there')
+        resp = requests.get(f'{self.store_export}/topdir?format=zip', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        archive = zipfile.ZipFile(io.BytesIO(resp.content))
+        self.assertEqual(archive.namelist(), ['topdir/bottomdir/file1'])
+        self.assertEqual(archive.read('topdir/bottomdir/file1'), b'hi there')
+        try:
+            shutil.rmtree(f'{dirs}')
+        except OSError as e:
+            pass
+
+
+    def test_ZZZ_recursive_listing(self):
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT'], 'Accept-Encoding': 'identity'}
+        dirs = f'{self.store_import_folder}/topdir/bottomdir'
+        try:
+            os.makedirs(dirs)
+        except OSError:
+            pass
+        with open(f'{dirs}/file1', 'w') as f:
+            f.write('hi there')
+        with open(f'{dirs}/.hidden', 'w') as f:
+            f.write('not for export')
+        resp = requests.head(f'{self.store_export}/topdir/bottomdir/file1', headers=headers)
+        etag = resp.headers['Etag']
+        resp = requests.get(f'{self.store_export}/topdir?recursive=true', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.text)
+        entries = {e['path']: e for e in data['files']}
+        self.assertEqual(sorted(entries.keys()), ['bottomdir', 'bottomdir/file1'])
+        self.assertEqual(entries['bottomdir']['type'], 'directory')
+        self.assertEqual(entries['bottomdir/file1']['size'], 8)
+        self.assertEqual(entries['bottomdir/file1']['etag'], etag)
+        resp = requests.get(f'{self.store_export}/topdir?recursive=true&depth=1', headers=headers)
+        data = json.loads(resp.text)
+        self.assertEqual([e['path'] for e in data['files']], ['bottomdir'])
+        resp = requests.get(f'{self.store_export}/topdir?recursive=true&depth=0', headers=headers)
+        self.assertEqual(resp.status_code, 400)
+        try:
+            shutil.rmtree(f'{dirs}')
+        except OSError as e:
+            pass
+
+
     def test_ZZZ_delete(self):
         headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}
         dirs = f'{self.store_import_folder}/topdir/bottomdir'
@@ -1558,6 +2256,422 @@ class TestFileApi(unittest.TestCase):
             pass
 
 
+    def test_directory_snapshots(self):
+        root = tempfile.mkdtemp()
+        try:
+            for name in ['b', 'a']:
+                with open(f'{root}/{name}', 'w') as f:
+                    f.write(name)
+            # directories are scanned off the IOLoop
+            scanned_in = []
+            def scandir(path, scandir=os.scandir):
+                scanned_in.append(threading.current_thread())
+                return scandir(path)
+            snapshots = DirectorySnapshots(ttl=60, executor=ThreadPoolExecutor(1))
+            get = lambda **kwargs: IOLoop.current().run_sync(lambda: snapshots.get('p11', root, **kwargs))
+            with mock.patch('os.scandir', scandir):
+                first = get(current=True)
+                self.assertEqual(first.names, ['a', 'b'])
+                self.assertFalse(threading.current_thread() in scanned_in)
+                # a directory modified right before it was scanned can change unnoticed
+                self.assertIsNot(get(current=True), first)
+                st = os.stat(root)
+                os.utime(root, ns=(st.st_atime_ns, st.st_mtime_ns - 10 * 10**9))
+                first = get(current=True)
+                self.assertIs(get(current=True), first)
+                self.assertEqual(len(scanned_in), 3)
+                # new entries are seen at once, except when continuing
+                with open(f'{root}/c', 'w') as f:
+                    f.write('c')
+                self.assertIs(get(), first)
+                second = get(current=True)
+                self.assertEqual(second.names, ['a', 'b', 'c'])
+                snapshots.ttl = 0
+                self.assertIsNot(get(), second)
+        finally:
+            shutil.rmtree(root)
+
+    def test_change_feed_since(self):
+        feeds = ChangeFeeds(max_events=3, use_inotify=False)
+        root = '/tmp/export'
+        feed = Feed(feeds, root, feeds.max_events)
+        start = feed.token()
+        feed.add('created', root + '/file1')
+        feed.add('created', root + '/.hidden')
+        feed.add('created', root + '/file1.chunk.1')
+        changes, token, reset = feed.since(start)
+        self.assertEqual([c['path'] for c in changes], ['file1'])
+        self.assertFalse(reset)
+        changes, token, reset = feed.since(token)
+        self.assertEqual((changes, reset), ([], False))
+        # tokens from another epoch, e.g. before a restart, or garbage
+        for stale in ['0123456789ab-1', 'garbage']:
+            changes, new_token, reset = feed.since(stale)
+            self.assertEqual((changes, reset), ([], True))
+            self.assertEqual(new_token, feed.token())
+        # events dropped after wrapping past max_events
+        for i in range(2, 6):
+            feed.add('created', '%s/file%d' % (root, i))
+        self.assertTrue(feed.since(start)[2])
+        changes, _, reset = feed.since(token)
+        self.assertTrue(reset)
+        changes, _, reset = feed.since(feed.token(feed.events[0][0] - 1))
+        self.assertEqual([c['path'] for c in changes], ['file3', 'file4', 'file5'])
+        self.assertFalse(reset)
+        # resets, e.g. after losing inotify events
+        token = feed.token()
+        feed.reset()
+        self.assertTrue(feed.since(token)[2])
+        self.assertEqual(feed.since(feed.token()), ([], feed.token(), False))
+
+
+    def test_merge_tree(self):
+        def tree(root):
+            found = {}
+            for directory, dirs, files in os.walk(root):
+                for name in files:
+                    with open(os.path.join(directory, name)) as f:
+                        found[os.path.relpath(os.path.join(directory, name), root)] = f.read()
+            return found
+        def write(root, files):
+            for path, data in files.items():
+                os.makedirs(os.path.dirname(f'{root}/{path}'), exist_ok=True)
+                with open(f'{root}/{path}', 'w') as f:
+                    f.write(data)
+        work_dir = tempfile.mkdtemp()
+        dst, src = f'{work_dir}/dst', f'{work_dir}/src'
+        try:
+            write(dst, {'a/x': 'x', 'b': 'old', 'keep/data': 'data'})
+            write(src, {'a/y': 'y', 'b': 'new', 'c/z': 'z'})
+            merge_tree(src, dst)
+            self.assertEqual(tree(dst), {'a/x': 'x', 'a/y': 'y', 'b': 'new', 'c/z': 'z', 'keep/data': 'data'})
+            self.assertEqual((tree(src), sorted(os.listdir(work_dir))), ({}, ['dst', 'src']))
+            shutil.rmtree(src)
+            # directories are not replaced by files, nor files by directories
+            for conflict in [{'keep': 'file'}, {'b/d': 'directory'}]:
+                write(src, dict(conflict, **{'new': 'new'}))
+                with self.assertRaises(MergeConflict):
+                    merge_tree(src, dst)
+                self.assertEqual(tree(dst), {'a/x': 'x', 'a/y': 'y', 'b': 'new', 'c/z': 'z', 'keep/data': 'data'})
+                shutil.rmtree(src)
+            # a failed move undoes the merge
+            write(src, {'a/x': 'replaced', 'b': 'replaced', 'c/z2': 'fails'})
+            rename = os.rename
+            def failing_rename(source, target):
+                if target.endswith('z2'):
+                    raise OSError('no space left on device')
+                rename(source, target)
+            with mock.patch('os.rename', failing_rename):
+                with self.assertRaises(OSError):
+                    merge_tree(src, dst)
+            self.assertEqual(tree(dst), {'a/x': 'x', 'a/y': 'y', 'b': 'new', 'c/z': 'z', 'keep/data': 'data'})
+            self.assertEqual(tree(src), {'a/x': 'replaced', 'b': 'replaced', 'c/z2': 'fails'})
+            self.assertEqual(sorted(os.listdir(work_dir)), ['dst', 'src'])
+        finally:
+            shutil.rmtree(work_dir)
+
+
+    def test_change_feed_inotify(self):
+        root = tempfile.mkdtemp()
+        walked_in = []
+        def scandir(path, scandir=os.scandir):
+            walked_in.append(threading.current_thread())
+            return scandir(path)
+        try:
+            feeds = ChangeFeeds(max_events=5, executor=ThreadPoolExecutor(1))
+            @gen.coroutine
+            def changes():
+                feed = yield feeds.feed(root)
+                start = feed.token()
+                with mock.patch('os.scandir', scandir):
+                    # a tree created before its directories are watched
+                    os.makedirs(f'{root}/new/sub')
+                    with open(f'{root}/new/sub/file', 'w') as f:
+                        f.write('data')
+                    yield gen.sleep(0.5)
+                with open(f'{root}/new/sub/later', 'w') as f:
+                    f.write('data')
+                # links are never closed after writing
+                os.symlink(f'{root}/new/sub/file', f'{root}/link')
+                yield gen.sleep(0.5)
+                return feed, feed.since(start)[0]
+            feed, found = IOLoop.current().run_sync(changes)
+            self.assertTrue(feeds.inotify is not None)
+            self.assertEqual(sorted(c['path'] for c in found),
+                             ['new', 'new/sub', 'new/sub/file', 'new/sub/later'])
+            self.assertFalse(threading.current_thread() in walked_in)
+            self.assertEqual(list(feed.creating), [f'{root}/link'])
+            # files which are not closed are reported eventually
+            token = feed.token()
+            with mock.patch('changes._CREATING_SECONDS', 0):
+                feed.creating_file(f'{root}/other')
+            self.assertEqual([c['path'] for c in feed.since(token)[0]], ['link', 'other'])
+            for i in range(7):
+                feed.creating_file(f'{root}/file{i}')
+            self.assertEqual(list(feed.creating), [f'{root}/file{i}' for i in range(2, 7)])
+        finally:
+            shutil.rmtree(root)
+
+
+    def test_change_feed_reset_by_path(self):
+        feeds = ChangeFeeds(use_inotify=False)
+        feed = IOLoop.current().run_sync(lambda: feeds.feed('/tmp/export/p11'))
+        for path, reset in [('/tmp/export/other', False), ('/tmp/export/p11/sub', True),
+                            ('/tmp/export/p11', True), ('/tmp/export', True)]:
+            token = feed.token()
+            feeds.reset(path)
+            self.assertEqual(feed.since(token)[2], reset, path)
+
+
+    def test_change_feed_reserved(self):
+        upload_id = str(uuid.uuid4())
+        for path in ['.resumables-p11-user.db', 'dir/.hidden/file', upload_id,
+                     'file.%s' % upload_id, 'file.%s.part' % upload_id,
+                     'file.chunk.12', 'dir/%s/file.chunk.1' % upload_id]:
+            self.assertTrue(reserved(path), path)
+        for path in ['file', 'dir/file.csv', 'dir/sub/file.chunk', 'file.tar.gz']:
+            self.assertFalse(reserved(path), path)
+
+
+    def test_file_catalog(self):
+        detect = lambda path: 'text/plain'
+        root = tempfile.mkdtemp()
+        try:
+            os.makedirs(f'{root}/sub/.hidden')
+            for path, data in [('a.txt', 'aaa'), ('sub/b.txt', 'bb'), ('sub/.hidden/c.txt', 'c')]:
+                with open(f'{root}/{path}', 'w') as f:
+                    f.write(data)
+            catalog = FileCatalog(root)
+            catalog.record(root, detect)
+            st = os.stat(f'{root}/a.txt')
+            self.assertEqual(catalog.lookup(f'{root}/a.txt', st)['mime_type'], 'text/plain')
+            self.assertIsNone(catalog.lookup(f'{root}/sub/.hidden/c.txt', os.stat(f'{root}/sub/.hidden/c.txt')))
+            # totals are only used once reconciled
+            self.assertIsNone(catalog.directory_size(root))
+            self.assertEqual(catalog.reconcile(detect), {'added': 0, 'updated': 0, 'removed': 0})
+            self.assertEqual(catalog.directory_size(root), (5, 2))
+            self.assertEqual(catalog.directory_size(f'{root}/sub'), (2, 1))
+            # lookups do not wait for writes
+            with catalog.lock:
+                self.assertIsNotNone(catalog.lookup(f'{root}/a.txt', st))
+                self.assertEqual(catalog.directory_size(root), (5, 2))
+            # new versions are stale until recorded, keeping totals
+            with open(f'{root}/a.txt', 'a') as f:
+                f.write('aa')
+            st = os.stat(f'{root}/a.txt')
+            self.assertIsNone(catalog.lookup(f'{root}/a.txt', st))
+            catalog.update([(f'{root}/a.txt', st, 'text/csv', 'digest')])
+            self.assertEqual(catalog.lookup(f'{root}/a.txt', st), {'mime_type': 'text/csv', 'digest': 'digest'})
+            catalog.update([(f'{root}/a.txt', st, None, None)])
+            self.assertEqual(catalog.lookup(f'{root}/a.txt', st), {'mime_type': 'text/csv', 'digest': 'digest'})
+            self.assertEqual(catalog.directory_size(root), (7, 2))
+            catalog.remove(f'{root}/sub')
+            self.assertIsNone(catalog.lookup(f'{root}/sub/b.txt', os.stat(f'{root}/sub/b.txt')))
+            self.assertEqual(catalog.directory_size(root), (5, 1))
+            self.assertEqual(catalog.directory_size(f'{root}/sub'), (0, 0))
+            # changes made out-of-band
+            os.remove(f'{root}/a.txt')
+            with open(f'{root}/sub/d.txt', 'w') as f:
+                f.write('dddd')
+            self.assertEqual(catalog.reconcile(detect), {'added': 2, 'updated': 0, 'removed': 1})
+            self.assertEqual(catalog.directory_size(root), (6, 2))
+            self.assertEqual(catalog.directory_size(f'{root}/sub'), (6, 2))
+            self.assertIsNone(catalog.directory_size('/elsewhere'))
+        finally:
+            shutil.rmtree(root)
+
+
+    def test_file_catalog_directory_size(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.makedirs(f'{root}/a/b/c')
+            os.makedirs(f'{root}/empty')
+            sizes = {'top': 1, 'a/one': 10, 'a/b/two': 100, 'a/b/c/three': 1000, 'a/b/c/four': 10000}
+            for path, size in sizes.items():
+                with open(f'{root}/{path}', 'w') as f:
+                    f.write('x' * size)
+            catalog = FileCatalog(root)
+            catalog.reconcile(lambda path: 'text/plain')
+            self.assertEqual(catalog.directory_size(root), (11111, 5))
+            self.assertEqual(catalog.directory_size(f'{root}/a'), (11110, 4))
+            self.assertEqual(catalog.directory_size(f'{root}/a/b/'), (11100, 3))
+            self.assertEqual(catalog.directory_size(f'{root}/a/b/c'), (11000, 2))
+            self.assertEqual(catalog.directory_size(f'{root}/empty'), (0, 0))
+            self.assertIsNone(catalog.directory_size(f'{root}/.hidden'))
+            # updates, and removals, are applied to every ancestor
+            with open(f'{root}/a/b/c/four', 'w') as f:
+                f.write('x' * 5)
+            catalog.update([(f'{root}/a/b/c/four', os.stat(f'{root}/a/b/c/four'), None, None)])
+            self.assertEqual(catalog.directory_size(f'{root}/a/b/c'), (1005, 2))
+            self.assertEqual(catalog.directory_size(root), (1116, 5))
+            catalog.remove(f'{root}/a/b')
+            self.assertEqual(catalog.directory_size(f'{root}/a'), (10, 1))
+            self.assertEqual(catalog.directory_size(root), (11, 2))
+            # rebuilt from the files when reconciling
+            self.assertEqual(catalog.reconcile(lambda path: 'text/plain')['added'], 3)
+            self.assertEqual(catalog.directory_size(f'{root}/a'), (1115, 4))
+            self.assertEqual(catalog.directory_size(root), (1116, 5))
+        finally:
+            shutil.rmtree(root)
+
+
+    def test_file_catalog_journal(self):
+        detect = lambda path: 'text/plain'
+        root, local = tempfile.mkdtemp(), tempfile.mkdtemp()
+        try:
+            with open(f'{root}/file.txt', 'w') as f:
+                f.write('data')
+            journal_mode = lambda catalog: catalog.engine.execute('pragma journal_mode').fetchone()[0]
+            catalog = FileCatalog(root, path=local)
+            self.assertEqual(journal_mode(catalog), 'wal')
+            self.assertTrue(catalog.name in os.listdir(local))
+            self.assertEqual(catalog.reconcile(detect), {'added': 1, 'updated': 0, 'removed': 0})
+            self.assertEqual(catalog.directory_size(root), (4, 1))
+            self.assertEqual(os.listdir(root), ['file.txt'])
+            catalog = FileCatalog(root)
+            self.assertEqual(journal_mode(catalog), 'delete')
+            self.assertTrue(os.path.exists(f'{root}/.file-catalog.db'))
+            self.assertEqual(journal_mode(FileCatalog(root, journal_mode='truncate')), 'truncate')
+            self.assertRaises(ValueError, FileCatalog, root, journal_mode='off')
+        finally:
+            shutil.rmtree(root)
+            shutil.rmtree(local)
+
+
+    def test_file_catalogs_open_in_background(self):
+        root = tempfile.mkdtemp()
+        executor = ThreadPoolExecutor(1)
+        try:
+            with open(f'{root}/file.txt', 'w') as f:
+                f.write('data')
+            st = os.stat(f'{root}/file.txt')
+            self.assertIsNone(FileCatalogs(False).lookup(root, f'{root}/file.txt', st))
+            catalogs = FileCatalogs(True, lambda path: 'text/plain', executor)
+            self.assertIsNone(catalogs.lookup(root, f'{root}/file.txt', st))
+            self.assertIsNone(catalogs.directory_size(root, root))
+            # opening, and the first reconcile, are queued
+            executor.submit(lambda: None).result()
+            executor.submit(lambda: None).result()
+            self.assertEqual(catalogs.lookup(root, f'{root}/file.txt', st)['mime_type'], 'text/plain')
+            self.assertEqual(catalogs.directory_size(root, root), (4, 1))
+            catalogs.remove(root, f'{root}/file.txt')
+            executor.submit(lambda: None).result()
+            self.assertIsNone(catalogs.lookup(root, f'{root}/file.txt', st))
+        finally:
+            executor.shutdown()
+            shutil.rmtree(root)
+
+
+    def test_ZZZ_change_feed(self):
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}
+        url = f'{self.base_url}/store/changes'
+        if not self.config.get('change_feed', {}).get('enabled'):
+            resp = requests.get(url, headers=headers)
+            self.assertEqual(resp.status_code, 403)
+            return
+        resp = requests.get(url, headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        token = json.loads(resp.text)['token']
+        # nothing happens, so waiting times out
+        start = time.time()
+        resp = requests.get(url, params={'since': token, 'wait': 1}, headers=headers)
+        self.assertTrue(time.time() - start >= 1)
+        self.assertEqual(json.loads(resp.text)['changes'], [])
+        filename = 'change-feed-%d.txt' % random.randint(0, 10**6)
+        resp = requests.put(f'{self.store_import}/{filename}', data=b'hi',
+                            headers={'Authorization': 'Bearer ' + TEST_TOKENS['VALID']})
+        self.assertEqual(resp.status_code, 201)
+        resp = requests.get(url, params={'since': token, 'wait': 5}, headers=headers)
+        data = json.loads(resp.text)
+        self.assertFalse(data['reset'])
+        self.assertTrue(filename in [c['path'] for c in data['changes']])
+        resp = requests.get(url, params={'since': 'stale-1'}, headers=headers)
+        self.assertTrue(json.loads(resp.text)['reset'])
+        resp = requests.get(url, params={'since': data['token']})
+        self.assertEqual(resp.status_code, 401)
+        os.remove(f'{self.store_import_folder}/{filename}')
+
+
+    def test_ZZZ_directory_totals(self):
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}
+        dirname = 'totals-%d' % random.randint(0, 10**6)
+        os.makedirs(f'{self.store_import_folder}/{dirname}/sub')
+        try:
+            for name, data in [('one', b'x' * 100), ('sub/two', b'x' * 50)]:
+                resp = requests.put(f'{self.store_import}/{dirname}/{name}', data=data,
+                                    headers={'Authorization': 'Bearer ' + TEST_TOKENS['VALID']})
+                self.assertEqual(resp.status_code, 201)
+            listed = lambda: json.loads(requests.get(
+                self.store_export, params={'name': dirname}, headers=headers
+            ).text)['files'][0]
+            if not self.config.get('file_catalog', {}).get('enabled'):
+                resp = requests.head(f'{self.store_export}/{dirname}', headers=headers)
+                self.assertEqual(resp.status_code, 403)
+                self.assertFalse('file_count' in listed())
+                return
+            def totals(path, expected):
+                # the catalog is reconciled, and uploads recorded, in the background
+                for _ in range(50):
+                    resp = requests.head(f'{self.store_export}/{path}', headers=headers)
+                    if resp.status_code == 200 and resp.headers['Directory-File-Count'] == str(expected):
+                        break
+                    time.sleep(0.2)
+                self.assertEqual(resp.status_code, 200)
+                return int(resp.headers['Directory-Size']), int(resp.headers['Directory-File-Count'])
+            self.assertEqual(totals(dirname, 2), (150, 2))
+            entry = listed()
+            self.assertEqual((entry['size'], entry['file_count']), (150, 2))
+            resp = requests.put(f'{self.store_import}/{dirname}/sub/three', data=b'y' * 25,
+                                headers={'Authorization': 'Bearer ' + TEST_TOKENS['VALID']})
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual(totals(f'{dirname}/sub', 2), (75, 2))
+            resp = requests.delete(f'{self.store_export}/{dirname}/one', headers=headers)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(totals(dirname, 2), (75, 2))
+            entry = listed()
+            self.assertEqual((entry['size'], entry['file_count']), (75, 2))
+        finally:
+            shutil.rmtree(f'{self.store_import_folder}/{dirname}', ignore_errors=True)
+
+
+    def test_ZZZ_batch(self):
+        headers = {'Authorization': 'Bearer ' + TEST_TOKENS['EXPORT']}
+        batch = f'{self.base_url}/store/batch'
+        dirs = f'{self.store_import_folder}/topdir/bottomdir'
+        try:
+            os.makedirs(dirs)
+        except OSError:
+            pass
+        for i in range(3):
+            with open(f'{dirs}/file{i}', 'w') as f:
+                f.write('hi there')
+        paths = ['topdir/bottomdir/file0', 'topdir/bottomdir', 'topdir/nofile', '../secret', '.hidden']
+        resp = requests.post(batch, json={'operation': 'metadata', 'paths': paths}, headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        results = json.loads(resp.text)['results']
+        self.assertEqual([r['path'] for r in results], paths)
+        self.assertEqual([r['status'] for r in results], [200, 200, 404, 400, 400])
+        self.assertEqual(results[0]['size'], 8)
+        self.assertEqual(results[1]['mime-type'], 'directory')
+        self.assertTrue(results[0]['etag'])
+        paths = ['topdir/bottomdir/file0', 'topdir/bottomdir/file1', 'topdir/bottomdir', 'topdir/nofile']
+        resp = requests.post(batch, json={'operation': 'delete', 'paths': paths}, headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        results = json.loads(resp.text)['results']
+        self.assertEqual([r['status'] for r in results], [200, 200, 403, 404])
+        self.assertEqual(os.listdir(dirs), ['file2'])
+        resp = requests.post(batch, json={'operation': 'delete', 'paths': ['x'] * 1001}, headers=headers)
+        self.assertEqual(resp.status_code, 413)
+        resp = requests.post(batch, data='not json', headers=headers)
+        self.assertEqual(resp.status_code, 400)
+        resp = requests.post(batch, json={'operation': 'metadata', 'paths': []})
+        self.assertEqual(resp.status_code, 401)
+        try:
+            shutil.rmtree(f'{dirs}')
+        except OSError as e:
+            pass
+
+
     def test_token_signature_validation(self):
         test_header = 'Bearer ' + TEST_TOKENS['TEST_SIG']
         res = process_access_token(
@@ -2119,6 +3233,12 @@ class TestFileApi(unittest.TestCase):
         resp = requests.post(maintenance_off)
 
 
+    def test_admin_metrics(self):
+        resp = requests.get(f'{self.maintenance_url}/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(isinstance(json.loads(resp.text), dict))
+
+
 def main():
     tests = []
     base = [
@@ -2148,12 +3268,22 @@ def main():
         'test_ZR_cancel_resumable',
         'test_ZS_recovering_inconsistent_data_allows_resume_from_previous_chunk',
         'test_ZT_list_all_resumables',
+        'test_ZT1_resumables_report_received_and_merged_offsets',
+        'test_ZT2_offset_based_resumable',
+        'test_ZT3_resumable_merkle_tree',
+        'test_ZT4_async_merge_failure_is_resumable',
+        'test_ZT5_merges_wait_for_other_processes',
+        'test_ZT6_resumables_expire',
+        'test_ZT7_resumables_repair',
+        'test_ZT8_resumables_gc_survives_broken_owner_db',
         'test_ZU_sending_uneven_chunks_resume_works',
         'test_ZV_resume_chunk_order_enforced',
         'test_ZW_resumables_access_control',
         # cluster
         'test_ZZe_cluster_uploads_not_p01',
         'test_ZZf_cluster_export_not_p01_works',
+        'test_ZZf1_sendfile_export_matches_chunked_export',
+        'test_ZZf2_accel_redirect_export',
         # store backend
         'test_ZZg_store_import_and_export',
     ]
@@ -2189,13 +3319,21 @@ def main():
         'test_ZY_get_specific_range_for_export',
         'test_ZZ_get_range_until_end_for_export',
         'test_ZZa_get_specific_range_conditional_on_etag',
+        'test_ZZa1_content_etag_and_not_modified',
+        'test_ZZa2_compressed_export',
         'test_ZZb_get_range_out_of_bounds_returns_correct_error',
+        'test_ZZc_requesting_multiple_ranges',
+        'test_ZZd_open_file_cache',
+        'test_ZZd1_file_metadata_cache',
+        'test_ZZd2_egress_scheduler',
     ]
     pipelines = [
         'test_Za_stream_tar_without_custom_content_type_works',
         'test_Zb_stream_tar_with_custom_content_type_untar_works',
         'test_Zc_stream_tar_gz_with_custom_content_type_untar_works',
         'test_Zg_stream_gz_with_custom_header_decompress_works',
+        'test_Zi_resumable_gz_decompressed_at_end',
+        'test_Zi1_resumable_content_type_fixed_by_first_chunk',
     ]
     gpg_related = [
         'test_Zd_stream_aes_with_custom_content_type_decrypt_works',
@@ -2212,12 +3350,27 @@ def main():
         'test_ZZZ_put_file_to_dir',
         'test_ZZZ_patch_resumable_file_to_dir',
         'test_ZZZ_get_file_from_dir',
+        'test_ZZZ_get_dir_as_archive',
+        'test_ZZZ_recursive_listing',
     ]
     listing = [
         'test_ZZZ_listing_dirs',
+        'test_directory_snapshots',
+        'test_change_feed_since',
+        'test_change_feed_inotify',
+        'test_change_feed_reset_by_path',
+        'test_change_feed_reserved',
+        'test_merge_tree',
+        'test_ZZZ_change_feed',
+        'test_file_catalog',
+        'test_file_catalog_directory_size',
+        'test_file_catalog_journal',
+        'test_file_catalogs_open_in_background',
+        'test_ZZZ_directory_totals',
     ]
     delete = [
         'test_ZZZ_delete',
+        'test_ZZZ_batch',
     ]
     reserved = [
         'test_ZZZ_reserved_resources',
@@ -2242,6 +3395,7 @@ def main():
     ]
     maintenance = [
         'test_maintenance_mode',
+        'test_admin_metrics',
     ]
     if len(sys.argv) == 2:
         print('usage:')
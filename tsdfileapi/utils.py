@@ -6,8 +6,15 @@ import logging
 import hashlib
 import subprocess
 import shlex
+import zlib
 import re
 import shutil
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 _VALID_FORMID = re.compile(r'^[0-9]+$')
@@ -137,3 +144,168 @@ def move_data_to_folder(path, dest):
         logging.error(e)
         logging.error('could not move file: %s', path)
         return False
+
+
+class MergeConflict(Exception):
+    pass
+
+
+def _merge_conflicts(src, dst):
+    # paths in dst which entries in src would replace with another type
+    conflicts = []
+    for entry in os.scandir(src):
+        target = os.path.join(dst, entry.name)
+        target_is_dir = os.path.isdir(target) and not os.path.islink(target)
+        if entry.is_dir(follow_symlinks=False):
+            if target_is_dir:
+                conflicts.extend(_merge_conflicts(entry.path, target))
+            elif os.path.lexists(target):
+                conflicts.append(target)
+        elif target_is_dir:
+            conflicts.append(target)
+    return conflicts
+
+
+def _move_entries(src, dst, replaced, moves):
+    for entry in list(os.scandir(src)):
+        target = os.path.join(dst, entry.name)
+        if entry.is_dir(follow_symlinks=False) and os.path.isdir(target) and not os.path.islink(target):
+            _move_entries(entry.path, target, replaced, moves)
+            continue
+        if os.path.lexists(target):
+            kept = os.path.join(replaced, str(len(moves)))
+            os.rename(target, kept)
+            moves.append((kept, target))
+        os.rename(entry.path, target)
+        moves.append((target, entry.path))
+
+
+def merge_tree(src, dst):
+    """
+    Move the contents of directory src into directory dst,
+    merging directories, and replacing files which exist.
+
+    As with tar -x, a directory is never replaced by a file, nor
+    a file by a directory: MergeConflict is raised before anything
+    is moved. Replaced files are kept aside until every entry has
+    been moved, so if a move fails, the moves done are undone,
+    and dst is left as it was.
+
+    """
+    conflicts = _merge_conflicts(src, dst)
+    if conflicts:
+        raise MergeConflict('cannot replace %s with an entry of another type' % conflicts[0])
+    replaced = f'{src}.{uuid.uuid4()}'
+    os.makedirs(replaced)
+    moves = []
+    try:
+        _move_entries(src, dst, replaced, moves)
+    except Exception as e:
+        logging.error('could not merge %s into %s, undoing: %s', src, dst, e)
+        for moved, origin in reversed(moves):
+            os.rename(moved, origin)
+        os.rmdir(replaced)
+        raise e
+    shutil.rmtree(replaced)
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """
+    Copy up to count bytes, starting at offset, from a file to a
+    non-blocking socket, in the kernel, until the socket is full.
+    This never waits for the socket: callers wait for it to become
+    writable, and call again with what remains.
+
+    Returns
+    -------
+    tuple, (number of bytes sent, whether the end of the file was reached)
+
+    """
+    sent = 0
+    while sent < count:
+        try:
+            num = os.sendfile(out_fd, in_fd, offset + sent, count - sent)
+        except BlockingIOError:
+            break
+        if num == 0:
+            return sent, True
+        sent += num
+    return sent, False
+
+
+def parse_byte_ranges(header, size):
+    """
+    Parse a Range header, e.g. 'bytes=0-99,200-,-50', into sorted,
+    inclusive, (start, end) byte ranges, within a resource of the
+    given size, coalescing ranges which overlap, or are adjacent.
+
+    Raises ValueError if the header is malformed, or if none of
+    the ranges can be satisfied.
+
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes':
+        raise ValueError('unsupported range unit: %s' % unit)
+    ranges = []
+    for byte_range in spec.split(','):
+        start, sep, end = byte_range.strip().partition('-')
+        if not sep:
+            raise ValueError('malformed byte range: %s' % byte_range)
+        if not start:
+            suffix_length = int(end)
+            if suffix_length <= 0 or size == 0:
+                continue
+            ranges.append((max(size - suffix_length, 0), size - 1))
+            continue
+        start = int(start)
+        end = int(end) if end else size - 1
+        if end < start:
+            raise ValueError('malformed byte range: %s' % byte_range)
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+    if not ranges:
+        raise ValueError('no satisfiable byte range')
+    ranges.sort()
+    coalesced = [ranges[0]]
+    for start, end in ranges[1:]:
+        previous_start, previous_end = coalesced[-1]
+        if start <= previous_end + 1:
+            coalesced[-1] = (previous_start, max(previous_end, end))
+        else:
+            coalesced.append((start, end))
+    return coalesced
+
+
+def accepted_encodings(header):
+    """
+    Content codings from an Accept-Encoding header, without those
+    which the client has explicitly refused with q=0.
+
+    """
+    encodings = set()
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        try:
+            quality = float(params.strip().split('=')[-1]) if params.strip().startswith('q=') else 1.0
+        except ValueError:
+            continue
+        if quality > 0:
+            encodings.add(coding)
+    return encodings
+
+
+def stream_compressor(encoding, level=6):
+    """
+    Streaming compressor, with compress and flush methods,
+    for a gzip, or zstd (if zstandard is installed) response.
+
+    """
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    elif encoding == 'zstd' and zstandard:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError('unsupported content encoding: %s' % encoding)